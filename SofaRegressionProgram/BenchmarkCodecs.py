@@ -0,0 +1,113 @@
+import os
+import re
+import sys
+import time
+import argparse
+
+import tools.Codecs as Codecs
+
+reference_file_pattern = re.compile(r"\.reference")
+
+
+def find_reference_files(root_dir, max_files = None):
+    """Return the paths of the reference files under a directory, sorted."""
+    paths = []
+    for root, dirs, files in os.walk(root_dir):
+        for file in files:
+            if reference_file_pattern.search(file) and not file.endswith((".partial", ".benchmark.json")):
+                paths.append(os.path.join(root, file))
+    paths.sort()
+    return paths if max_files is None else paths[:max_files]
+
+
+def default_codec_specs():
+    specs = ["none", "gzip:1", "gzip:6", "gzip:9", "bz2:9", "lzma:6"]
+    if Codecs.codecs["zstd"].available():
+        specs += ["zstd:3", "zstd:19"]
+    return specs
+
+
+def benchmark_codec(spec, contents):
+    """Compress and decompress the raw contents of the reference files with one codec.
+
+    Returns:
+        dict: the compressed size, the encode and decode times in seconds, and
+        whether every file round-tripped exactly.
+    """
+    codec, level = Codecs.parse_codec(spec)
+    compressed_size = 0
+    encode_time = 0.0
+    decode_time = 0.0
+    exact = True
+    for data in contents:
+        start = time.perf_counter()
+        compressed = codec.compress(data, level)
+        encode_time += time.perf_counter() - start
+        start = time.perf_counter()
+        decompressed = codec.decompress(compressed)
+        decode_time += time.perf_counter() - start
+        compressed_size += len(compressed)
+        exact = exact and decompressed == data
+    return {"compressed_size": compressed_size, "encode_time": encode_time, "decode_time": decode_time, "exact": exact}
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Compare the compression codecs on the reference files of a tree: compression ratio, and '
+                    'encode/decode throughput of the uncompressed data. The codec of each file is detected.')
+    parser.add_argument('--input',
+                        dest='input',
+                        help='Root of the reference tree',
+                        type=str,
+                        required=True)
+    parser.add_argument('--codec',
+                        dest='codecs',
+                        help="Codec to benchmark, as <name>[:<level>]. Can be repeated. Defaults to none, gzip:1, "
+                             "gzip:6, gzip:9, bz2:9, lzma:6, and zstd:3, zstd:19 if available.",
+                        action='append',
+                        type=str)
+    parser.add_argument('--max-files',
+                        dest='max_files',
+                        help="Only use the first N reference files (in path order).",
+                        type=int)
+    return parser
+
+
+if __name__ == '__main__':
+    args = make_parser().parse_args()
+
+    if not os.path.isdir(args.input):
+        exit(f"Error: input directory does not exist: {args.input} ! Quitting.")
+    specs = args.codecs if args.codecs is not None else default_codec_specs()
+    for spec in specs:
+        try:
+            Codecs.parse_codec(spec)
+        except ValueError as e:
+            exit(f"Error: {e} ! Quitting.")
+
+    paths = find_reference_files(args.input, args.max_files)
+    if len(paths) == 0:
+        exit(f"Error: no reference file found in {args.input} ! Quitting.")
+
+    contents = []
+    stored_size = 0
+    for path in paths:
+        with Codecs.open_file(path, "rb") as f:
+            contents.append(f.read())
+        stored_size += os.path.getsize(path)
+    raw_size = sum(len(data) for data in contents)
+    print(f"### {len(paths)} reference files: {raw_size / 2**20:.2f} MB uncompressed, {stored_size / 2**20:.2f} MB stored")
+
+    print(f"{'codec':<10} {'size (MB)':>10} {'ratio':>7} {'encode MB/s':>12} {'decode MB/s':>12}")
+    failed = False
+    for spec in specs:
+        result = benchmark_codec(spec, contents)
+        ratio = raw_size / result["compressed_size"] if result["compressed_size"] > 0 else 0.0
+        encode_speed = raw_size / 2**20 / result["encode_time"] if result["encode_time"] > 0 else float("inf")
+        decode_speed = raw_size / 2**20 / result["decode_time"] if result["decode_time"] > 0 else float("inf")
+        print(f"{spec:<10} {result['compressed_size'] / 2**20:>10.2f} {ratio:>7.2f} {encode_speed:>12.1f} {decode_speed:>12.1f}")
+        if not result["exact"]:
+            failed = True
+            print(f"Error: codec {spec} does not round-trip the reference files exactly.", file=sys.stderr)
+
+    sys.exit(1 if failed else 0)
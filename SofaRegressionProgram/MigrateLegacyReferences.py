@@ -0,0 +1,162 @@
+import os
+import re
+import sys
+import json
+import argparse
+import concurrent.futures
+
+import tools.LegacyMigration as LegacyMigration
+import tools.Codecs as Codecs
+import tools.RegressionHelper as helper
+from tools import ProgressBarHandler as pbh
+
+report_version = 1
+
+
+def parse_dof_overrides(overrides):
+    """Parse the "<regex>=<dof>" overrides of the inferred layouts."""
+    parsed = []
+    for override in overrides or []:
+        pattern, sep, dof = override.rpartition("=")
+        if not sep or not dof.isdigit() or int(dof) <= 0:
+            raise ValueError(f"invalid --dof '{override}', expecting <regex>=<dof per point>")
+        parsed.append((re.compile(pattern), int(dof)))
+    return parsed
+
+
+def _convert(task):
+    legacy_path, target_path, format, dof_per_point, overwrite, codec, encoding = task
+    return LegacyMigration.convert_legacy_reference(legacy_path, target_path, format, dof_per_point, overwrite,
+                                                    codec, encoding)
+
+
+def migrate_references(input_dir, output_dir, format, nbr_jobs, dof_overrides, overwrite, disable_progress_bar, codec = None,
+                       encoding = "raw"):
+    """Convert every legacy reference under input_dir, in parallel.
+
+    Returns:
+        list: the report of each conversion, in path order.
+    """
+    tasks = []
+    for legacy_path in LegacyMigration.find_legacy_references(input_dir):
+        dof_per_point = None
+        for pattern, dof in dof_overrides:
+            if pattern.search(legacy_path):
+                dof_per_point = dof
+                break
+        target_path = LegacyMigration.converted_path(legacy_path, format, input_dir, output_dir)
+        tasks.append((legacy_path, target_path, format, dof_per_point, overwrite, codec, encoding))
+
+    pbar = pbh.ProgressBarHandler(total=len(tasks), disable=disable_progress_bar)
+    pbar.set_description(f"Convert legacy references ({nbr_jobs} jobs)")
+    reports = []
+    # conversions are CPU bound (parsing, compression): one process per core
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nbr_jobs) as executor:
+        for report in executor.map(_convert, tasks, chunksize=4):
+            reports.append(report)
+            pbar.update(1)
+    pbar.close()
+    return reports
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Convert the legacy *.reference_<i>_<name>_mstate.txt.gz references of a tree to the current '
+                    'reference formats (*.reference_mstate_<i>_<name>.<format>). SOFA is not needed: the layout '
+                    'of the MechanicalObjects is inferred from the data. Each converted file is read back and '
+                    'checked to be bit-exact, in a verification report.')
+    parser.add_argument('--input',
+                        dest='input',
+                        help='Root of the reference tree to convert',
+                        type=str,
+                        required=True)
+    parser.add_argument('--output',
+                        dest='output',
+                        help='Root of the tree where converted references are written, with the same hierarchy. '
+                             'Defaults to the input tree (next to the legacy files).',
+                        type=str)
+    parser.add_argument('--format',
+                        dest='format',
+                        help="Format of the converted references. Defaults to JSON.",
+                        choices=["JSON", "CSV", "BINARY"],
+                        default="JSON")
+    parser.add_argument('--codec',
+                        dest='codec',
+                        help="Compression of the converted references: gzip[:level], bz2[:level], lzma[:level], "
+                             "zstd[:level] (if available) or none. Defaults to gzip for JSON and CSV, none for BINARY.",
+                        type=str)
+    parser.add_argument('--binary-encoding',
+                        dest='binary_encoding',
+                        help="Encoding of BINARY references: raw or xor (smaller once compressed, see "
+                             "SofaRegressionProgram.py --help). Defaults to raw.",
+                        choices=["raw", "xor"],
+                        default="raw")
+    parser.add_argument('--jobs', '-j',
+                        dest='jobs',
+                        help="Number of files converted in parallel. Defaults to the number of cores.",
+                        type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument('--dof',
+                        dest='dof_overrides',
+                        help="Number of dof per point of the references whose path matches a regex, as <regex>=<dof> "
+                             "(e.g. 'Rigid2D.*=3'), for the layouts which cannot be inferred. Can be repeated.",
+                        action='append',
+                        type=str)
+    parser.add_argument('--report',
+                        dest='report',
+                        help="JSON verification report. Defaults to migration_report.json in the output tree.",
+                        type=str)
+    parser.add_argument(
+        "--overwrite",
+        dest="overwrite",
+        help='If set, converted references which already exist are written again. They are skipped otherwise.',
+        action='store_true'
+    )
+    parser.add_argument(
+        "--disable-progress-bar",
+        dest="progress_bar_is_disabled",
+        help='If set, will disable progress bars',
+        action='store_true'
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    args = make_parser().parse_args()
+
+    if not os.path.isdir(args.input):
+        exit(f"Error: input directory does not exist: {args.input} ! Quitting.")
+    if args.binary_encoding != "raw" and args.format != "BINARY":
+        exit("Error: --binary-encoding requires --format BINARY ! Quitting.")
+    if args.jobs <= 0:
+        exit("Error: --jobs must be strictly positive ! Quitting.")
+    try:
+        dof_overrides = parse_dof_overrides(args.dof_overrides)
+        if args.codec is not None:
+            Codecs.parse_codec(args.codec)
+    except (ValueError, re.error) as e:
+        exit(f"Error: {e} ! Quitting.")
+
+    output_dir = args.output if args.output is not None else args.input
+    reports = migrate_references(args.input, output_dir, args.format, args.jobs, dof_overrides,
+                                 args.overwrite, args.progress_bar_is_disabled, args.codec,
+                                 args.binary_encoding)
+
+    counts = {}
+    for report in reports:
+        counts[report["status"]] = counts.get(report["status"], 0) + 1
+        if report["status"] in ("error", "mismatch"):
+            helper.writeError(f"{report['source']}: {report['error']}")
+
+    report_path = args.report if args.report is not None else os.path.join(output_dir, "migration_report.json")
+    with open(report_path, "w") as f:
+        json.dump({"version": report_version, "input": os.path.abspath(args.input), "output": os.path.abspath(output_dir),
+                   "format": args.format, "codec": args.codec, "counts": counts, "files": reports}, f, indent=1)
+
+    print("### Number of legacy references found:  " + str(len(reports)))
+    print("### Number of references converted and verified bit-exact:  " + str(counts.get("converted", 0)))
+    print("### Number of references skipped (already converted):  " + str(counts.get("skipped", 0)))
+    print("### Number of references failed:  " + str(counts.get("error", 0) + counts.get("mismatch", 0)))
+    print(f"### Verification report: {report_path}")
+
+    sys.exit(1 if counts.get("error", 0) + counts.get("mismatch", 0) > 0 else 0)
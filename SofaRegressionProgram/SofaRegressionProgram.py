@@ -1,46 +1,394 @@
 import os
 import argparse
 import sys
+import json
+import filecmp
+import tempfile
+import threading
+import concurrent.futures
 import numpy as np
 
-if "SOFA_ROOT" not in os.environ:
-    print('SOFA_ROOT environment variable has not been detected, quitting.')
-    exit(1)
-else:
-    sofapython3_path = os.environ["SOFA_ROOT"] + "/lib/python3/site-packages"
-    sys.path.append(sofapython3_path)
-
-import Sofa
-import SofaRuntime # importing SofaRuntime will add the py3 loader to the scene loaders
+# SOFA is only loaded by the workers running the scenes, and by --replay: listing,
+# filtering, sharding and merging results do not need a SOFA build.
 import tools.RegressionSceneList as RegressionSceneList
+import tools.RegressionWorker as RegressionWorker
+import tools.ResultCache as ResultCache
+import tools.TimingHistory as TimingHistory
+import tools.Sharding as Sharding
+import tools.PhaseProfiler as PhaseProfiler
+import tools.Benchmark as Benchmark
+import tools.Codecs as Codecs
+import tools.DiscoveryIndex as DiscoveryIndex
+import tools.BatchRegistry as BatchRegistry
+import tools.ErrorMetrics as ErrorMetrics
+import tools.FieldCapture as FieldCapture
+import tools.RegressionSceneData as RegressionSceneData
+import tools.RegressionHelper as helper
 from tools import ProgressBarHandler as pbh
 
 regression_file_extension = ".regression-tests"
+results_file_version = 2
 
 class RegressionProgram:
-    def __init__(self, input_folder, filter = None, disable_progress_bar = False, verbose = False):
+    def __init__(self, input_folder, filter = None, disable_progress_bar = False, verbose = False, nbr_jobs = 1, format = "JSON",
+                 discovery_index = None):
         """Initialize the RegressionProgram
 
         Args:
-            input_folder (str): Path to the folder containing regression test files.
+            input_folder (str): Path to the folder containing regression test files. If None, the program
+                starts without any set (e.g. to merge results files).
             filter (str): Regex pattern to filter scene files (e.g., '^demo.*.scn$'). If None, no filter is applied. Defaults to None.
             disable_progress_bar (bool, optional): If True, disable progress bars. Defaults to False.
             verbose (bool, optional): If True, enable verbose output. Defaults to False.
+            nbr_jobs (int, optional): Number of scenes simulated concurrently, each one in its own worker process. Defaults to 1.
+            format (str, optional): Reference file format: "JSON", "CSV" or "BINARY". Defaults to "JSON".
+            discovery_index (DiscoveryIndex.DiscoveryIndex, optional): index of the list files of input_folder and of
+                their parsed scenes, reused and updated. If None, the folder is walked and every list file parsed.
         """
+        self.input_folder = input_folder
         self.scene_sets = []  # List <RegressionSceneList>
         self.disable_progress_bar = disable_progress_bar
         self.verbose = verbose
         self.legacy_mode = False
+        self.nbr_jobs = max(1, int(nbr_jobs))
+        self.fork_server = None
+        self.max_failures = None # stop the compare run once this number of scenes failed
+        self.nbr_skipped_scenes = 0 # scenes not run because max_failures was reached
+        self.result_cache = None
+        self.timing_history = None
+        self.batch_registry = None # BatchRegistry.BatchRegistry of the scenes verified batchable, if any
+        self.batch_size = 1 # maximum number of verified scenes run by one worker
+
+        self.shard = None # "i/N" when only a shard of the scenes is run
+        self.nbr_scenes_done = 0 # scenes of a merged run, see merge_results_files()
+
+        if input_folder is None:
+            return
+
+        if discovery_index is not None:
+            file_paths = discovery_index.find_list_files(regression_file_extension)
+        else:
+            file_paths = []
+            for root, dirs, files in os.walk(input_folder):
+                for file in files:
+                    if file.endswith(regression_file_extension):
+                        file_paths.append(os.path.join(root, file))
+            file_paths.sort()
+
+        for file_path in file_paths:
+            scene_list = RegressionSceneList.RegressionSceneList(file_path, filter, self.disable_progress_bar, verbose)
+            scene_list.format = format
+            self.scene_sets.append(scene_list)
+
+        # list files are read and their scene files checked concurrently (I/O
+        # bound), then applied in order so that messages are not interleaved
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            definitions = list(executor.map(lambda scene_list: self.parse_scene_list(scene_list, discovery_index),
+                                            self.scene_sets))
+        for scene_list, definition in zip(self.scene_sets, definitions):
+            scene_list.apply_definition(definition)
+
+        if discovery_index is not None:
+            discovery_index.forget_missing_definitions(file_paths)
+            if verbose:
+                helper.writeLog(f"Discovery: {discovery_index.nbr_listed_directories} directories listed, "
+                                f"{discovery_index.nbr_parsed_files} of {len(file_paths)} list files parsed.")
+            try:
+                discovery_index.save()
+            except OSError as e:
+                helper.writeWarning(f"Could not save the discovery index {discovery_index.index_path}: {e}")
+
+    @staticmethod
+    def parse_scene_list(scene_list, discovery_index):
+        """Return the definition of a list file, reused from the index when still valid."""
+        if discovery_index is None:
+            return scene_list.parse_file()
+        definition = discovery_index.get_definition(scene_list.file_path)
+        if definition is None:
+            stat = os.stat(scene_list.file_path)
+            definition = scene_list.parse_file()
+            discovery_index.set_definition(scene_list.file_path, stat, definition)
+        return definition
+
+    def set_metrics(self, metrics):
+        for scene_list in self.scene_sets:
+            scene_list.metrics = metrics
+
+    def set_fail_fast_scene(self, fail_fast):
+        for scene_list in self.scene_sets:
+            scene_list.fail_fast = fail_fast
+
+    def set_profile(self, profile):
+        for scene_list in self.scene_sets:
+            scene_list.profile = profile
+
+    def set_benchmark_options(self, benchmark_options):
+        for scene_list in self.scene_sets:
+            scene_list.benchmark_options = benchmark_options
+
+    def set_codec(self, codec):
+        """Compression of the written references, overriding the codec= option of the options files of the lists."""
+        for scene_list in self.scene_sets:
+            scene_list.codec = codec
+
+    def set_binary_encoding(self, encoding, precision):
+        """Encoding and precision of the written BINARY references, see ReferenceFileIO.BINARYReferenceWriter."""
+        for scene_list in self.scene_sets:
+            scene_list.encoding = encoding
+            scene_list.precision = precision
+
+    def set_scene_limits(self, timeout, max_memory):
+        """Default time (s) and memory (MB) limits of the scenes, used when their options do not set them."""
+        for scene_list in self.scene_sets:
+            scene_list.timeout = timeout
+            scene_list.max_memory = max_memory
+
+    def check_scene_limits(self):
+        """Warn about the memory limits of the scenes when they cannot be enforced."""
+        if RegressionWorker.memory_limit_is_enforced():
+            return
+        nbr_limited = sum(1 for scene_list, id_scene in self.get_all_scenes()
+                          if scene_list.scene_limits(id_scene)[1] is not None)
+        if nbr_limited > 0:
+            helper.writeWarning(f"The resident memory of the workers cannot be read on this platform (no /proc): "
+                                f"the memory limit of {nbr_limited} scenes is not enforced.")
+
+    def open_result_cache(self, cache_dir, max_entries, clear = False):
+        """Reuse the passing results of scenes whose inputs did not change, see ResultCache."""
+        self.result_cache = ResultCache.ResultCache(cache_dir, max_entries)
+        if clear:
+            self.result_cache.clear()
+        for scene_list in self.scene_sets:
+            scene_list.result_cache = self.result_cache
+
+    def close_result_cache(self):
+        if self.result_cache is not None:
+            self.result_cache.save()
+
+    def open_timing_history(self, history_path):
+        """Record the timings of every scene run and use them to schedule parallel runs longest-first."""
+        self.timing_history = TimingHistory.TimingHistory(history_path, self.input_folder)
+        for scene_list in self.scene_sets:
+            scene_list.timing_history = self.timing_history
+
+    def close_timing_history(self):
+        if self.timing_history is not None:
+            try:
+                self.timing_history.save()
+            except OSError as e:
+                helper.writeWarning(f"Could not save the timing history {self.timing_history.history_path}: {e}")
+
+    def open_batch_registry(self, registry_path):
+        """Read (and record, see verify_batchable()) which scenes can be run in a batch."""
+        self.batch_registry = BatchRegistry.BatchRegistry(registry_path)
+        for scene_list in self.scene_sets:
+            scene_list.batch_registry = self.batch_registry
+
+    def close_batch_registry(self):
+        if self.batch_registry is not None:
+            try:
+                self.batch_registry.save()
+            except OSError as e:
+                helper.writeWarning(f"Could not save the batch registry {self.batch_registry.registry_path}: {e}")
+
+    def set_batch_size(self, batch_size):
+        """Run up to batch_size scenes verified batchable in the same worker. Requires a batch registry."""
+        self.batch_size = max(1, int(batch_size))
+
+    def start_fork_server(self, preload_plugins=()):
+        """Start workers by forking a warm process instead of spawning a new interpreter
+        per scene. Falls back silently to spawning when fork is not available."""
+        self.fork_server = RegressionWorker.start_fork_server(preload_plugins=preload_plugins)
+        for scene_list in self.scene_sets:
+            scene_list.fork_server = self.fork_server
+        return self.fork_server is not None
+
+    def stop_fork_server(self):
+        if self.fork_server is not None:
+            self.fork_server.close()
+            self.fork_server = None
+            for scene_list in self.scene_sets:
+                scene_list.fork_server = None
+
+    def nbr_cached_in_sets(self):
+        return sum(1 for scene_list in self.scene_sets for scene in scene_list.scenes_data_sets if scene.cached)
+
+    def nbr_killed_in_sets(self):
+        return sum(scene_list.get_nbr_killed() for scene_list in self.scene_sets)
+
+    def apply_shard(self, shard):
+        """Only keep the scenes of one shard, see Sharding.
+
+        Args:
+            shard (str): "i/N", keeps the i-th (1-based) of N groups of scenes of
+                roughly equal expected cost. The split only depends on the
+                scenes and their references, not on the timing history of this
+                machine, so that all the shards agree.
+
+        Returns:
+            int: the number of scenes kept.
+        """
+        index, count = Sharding.parse_shard(shard)
+        self.shard = shard
+
+        tasks = self.get_all_scenes()
+        scenes = [scene_list.scenes_data_sets[id_scene] for scene_list, id_scene in tasks]
+        keys = [os.path.relpath(scene.file_scene_path, self.input_folder).replace(os.sep, "/") + f"|{scene.steps}"
+                for scene in scenes]
+        assignment = Sharding.assign_shards(Sharding.estimate_scene_costs(scenes), keys, count)
+
+        kept = {}
+        for (scene_list, id_scene), shard_id in zip(tasks, assignment):
+            if shard_id == index:
+                kept.setdefault(id(scene_list), []).append(id_scene)
+        for scene_list in self.scene_sets:
+            scene_list.keep_scenes(kept.get(id(scene_list), []))
+
+        return sum(scene_list.get_nbr_scenes() for scene_list in self.scene_sets)
+
+    def export_trace(self, trace_path):
+        """Write the phase timings of the run as a Chrome trace, see PhaseProfiler."""
+        scene_results = []
+        for scene_list in self.scene_sets:
+            for id_scene, scene in enumerate(scene_list.scenes_data_sets):
+                scene_results.append((scene.file_scene_path, scene_list.scene_results.get(id_scene)))
+        PhaseProfiler.write_chrome_trace(trace_path, scene_results)
+
+    def phase_summary(self):
+        """Total time spent in each phase by all the scenes which ran."""
+        return PhaseProfiler.merge_summaries(
+            result.get("phases", {}) for scene_list in self.scene_sets
+            for result in scene_list.scene_results.values() if not result.get("cached", False))
+
+    def export_results(self, results_path, mode, nbr_scenes):
+        """Write the outcome of the run to a JSON file, which merge_results_files() can combine."""
+        sets = []
+        for scene_list in self.scene_sets:
+            scenes = []
+            for id_scene, scene in enumerate(scene_list.scenes_data_sets):
+                scenes.append({
+                    "index": scene_list.scene_indices[id_scene],
+                    "scene": scene.file_scene_path,
+                    "ref": scene.file_ref_path,
+                    "steps": scene.steps,
+                    "epsilon": scene.epsilon,
+                    "criterion": scene.criterion,
+                    "fields": scene.fields,
+                    "meca_in_mapping": scene.meca_in_mapping,
+                    "dump_number_step": scene.dump_number_step,
+                    "skipped": scene.skipped,
+                    "result": scene_list.scene_results.get(id_scene),
+                })
+            sets.append({"file_path": scene_list.file_path,
+                         "nbr_listed_scenes": scene_list.nbr_listed_scenes,
+                         "nbr_parsing_errors": scene_list.get_nbr_parsing_errors(),
+                         "parsing_error_messages": scene_list.parsing_error_messages,
+                         "scenes": scenes})
+
+        with open(results_path, "w") as f:
+            json.dump({"version": results_file_version, "mode": mode, "shard": self.shard,
+                       "nbr_scenes": nbr_scenes, "sets": sets}, f, indent=1)
+
+    def merge_results_files(self, results_paths):
+        """Rebuild the sets of a run from the results files of its shards.
+
+        The results are applied to the scene lists exactly as after a local run,
+        so that counts, logs and exit code are the same.
 
-        for root, dirs, files in os.walk(input_folder):
-            for file in files:
-                if file.endswith(regression_file_extension):
-                    file_path = os.path.join(root, file)
+        The results files must be the ones of all the shards of a run, each one
+        given once (or the one of a run without shards): every scene of the
+        lists must have been run by exactly one of them.
+
+        Returns:
+            str: the mode of the merged runs ("write", "compare" or "benchmark").
+
+        Raises:
+            ValueError: if the results files do not cover every scene exactly once.
+        """
+        modes = set()
+        shards = {} # (0-based shard index, number of shards) -> results file
+        nbr_shards = set()
+        sets = {} # file_path -> (RegressionSceneList, [(index, scene, result, skipped)])
+        nbr_listed_scenes = {} # file_path -> number of scenes of the list file
+        for results_path in results_paths:
+            with open(results_path, "r") as f:
+                data = json.load(f)
+            if data.get("version") != results_file_version:
+                raise ValueError(f"{results_path}: unsupported results file version {data.get('version')}")
+            modes.add(data["mode"])
+            self.nbr_scenes_done = self.nbr_scenes_done + data["nbr_scenes"]
 
-                    scene_list = RegressionSceneList.RegressionSceneList(file_path, filter, self.disable_progress_bar, verbose)
+            if data["shard"] is None:
+                shard_index, shard_count = 0, 1
+            else:
+                shard_index, shard_count = Sharding.parse_shard(data["shard"])
+            if (shard_index, shard_count) in shards:
+                raise ValueError(f"{results_path} and {shards[shard_index, shard_count]} are both the results of shard "
+                                 f"{shard_index + 1}/{shard_count}")
+            shards[shard_index, shard_count] = results_path
+            nbr_shards.add(shard_count)
 
-                    scene_list.process_file()
-                    self.scene_sets.append(scene_list)
+            for set_data in data["sets"]:
+                listed = nbr_listed_scenes.setdefault(set_data["file_path"], set_data["nbr_listed_scenes"])
+                if listed != set_data["nbr_listed_scenes"]:
+                    raise ValueError(f"{results_path}: {set_data['file_path']} has {set_data['nbr_listed_scenes']} "
+                                     f"scenes instead of {listed} in the other results files")
+                if set_data["file_path"] not in sets:
+                    scene_list = RegressionSceneList.RegressionSceneList(set_data["file_path"], None,
+                                                                         self.disable_progress_bar, self.verbose)
+                    # every shard parses the whole list file: its invalid lines are reported once
+                    for message in set_data["parsing_error_messages"]:
+                        helper.writeError(message)
+                    scene_list.nbr_parsing_errors = set_data["nbr_parsing_errors"]
+                    scene_list.parsing_error_messages = set_data["parsing_error_messages"]
+                    sets[set_data["file_path"]] = (scene_list, [])
+                scene_list, scenes = sets[set_data["file_path"]]
+
+                for scene_data in set_data["scenes"]:
+                    scene = RegressionSceneData.RegressionSceneData(scene_data["scene"], scene_data["ref"],
+                                                                    scene_data["steps"], scene_data["epsilon"],
+                                                                    scene_data["meca_in_mapping"], scene_data["dump_number_step"],
+                                                                    self.disable_progress_bar, self.verbose,
+                                                                    criterion=scene_data.get("criterion", ErrorMetrics.default_criterion),
+                                                                    fields=scene_data.get("fields"))
+                    scenes.append((scene_data["index"], scene, scene_data["result"], scene_data["skipped"]))
+
+        if len(modes) > 1:
+            raise ValueError(f"cannot merge results of runs in different modes: {sorted(modes)}")
+        if len(nbr_shards) > 1:
+            raise ValueError(f"cannot merge results of runs split in different numbers of shards: {sorted(nbr_shards)}")
+        if nbr_shards:
+            shard_count = nbr_shards.pop()
+            missing = [f"{index + 1}/{shard_count}" for index in range(shard_count) if (index, shard_count) not in shards]
+            if missing:
+                raise ValueError(f"missing the results of shard {', '.join(missing)}")
+
+        for file_path, (scene_list, scenes) in sets.items():
+            indices = [scene[0] for scene in scenes]
+            duplicated = sorted({scene[1].file_scene_path for scene in scenes if indices.count(scene[0]) > 1})
+            nbr_missing = len(set(range(nbr_listed_scenes[file_path])) - set(indices))
+            if duplicated or nbr_missing:
+                problems = [f"{path} was run by several shards" for path in duplicated]
+                if nbr_missing:
+                    problems.append(f"{nbr_missing} scenes were run by no shard")
+                raise ValueError(f"{file_path}: {', '.join(problems)} (the shards did not compute the same split)")
+
+        mode = modes.pop() if modes else "compare"
+        for scene_list, scenes in sets.values():
+            # restore the order of the list file, as in a run without shards
+            scenes.sort(key=lambda scene: scene[0])
+            for index, scene, result, skipped in scenes:
+                scene_list.scene_indices.append(index)
+                scene_list.scenes_data_sets.append(scene)
+                id_scene = len(scene_list.scenes_data_sets) - 1
+                if skipped:
+                    scene.skipped = True
+                    self.nbr_skipped_scenes = self.nbr_skipped_scenes + 1
+                elif result is not None:
+                    scene_list.apply_result(id_scene, mode, result)
+            self.scene_sets.append(scene_list)
+
+        return mode
 
     def nbr_error_in_sets(self):
         nbr_errors = 0
@@ -63,7 +411,247 @@ class RegressionProgram:
         nbr_scenes = scene_list.write_all_references()
         return nbr_scenes
 
+    def get_all_scenes(self):
+        """Return the (scene_list, id_scene) pairs of every scene of every set, in set order."""
+        return [(scene_list, id_scene)
+                for scene_list in self.scene_sets
+                for id_scene in range(scene_list.get_nbr_scenes())]
+
+    def run_all_scenes_in_parallel(self, mode):
+        """Run every scene of every set through one global work queue of
+        `nbr_jobs` concurrent workers.
+
+        Each scene still runs in its own isolated process: the pool threads
+        only wait for their worker. Results are applied back to the scene lists
+        in the serial order once all workers are done, so that error counts and
+        log_errors() output are the same as in a serial run. The progress bar
+        also shows the number of steps simulated by all the workers, as they
+        report it.
+
+        Args:
+            mode (str): "write", "compare" or "benchmark".
+
+        Returns:
+            int: the number of scenes processed.
+        """
+        tasks = self.get_all_scenes()
+        for scene_list in self.scene_sets:
+            scene_list.legacy_mode = self.legacy_mode
+
+        # start the longest scenes first so that no slow scene ends up alone at the end of the run
+        submit_order = range(len(tasks))
+        if self.timing_history is not None:
+            submit_order = self.timing_history.order_longest_first(
+                [scene_list.scenes_data_sets[id_scene] for scene_list, id_scene in tasks])
+
+        # each unit of work is one scene, or a batch of scenes verified batchable run by one worker
+        if self.batch_size > 1 and self.batch_registry is not None and mode != "benchmark":
+            units = self.make_batches(tasks, submit_order)
+        else:
+            units = [[task_id] for task_id in submit_order]
+
+        pbar_scenes = pbh.ProgressBarHandler(total=len(tasks), disable=self.disable_progress_bar)
+        pbar_scenes.set_description(mode.capitalize() + f" all scenes ({self.nbr_jobs} jobs)")
+
+        # steps simulated by the workers: the ones of the finished units, plus
+        # the last "progress" message of each scene still running
+        total_steps = sum(scene_list.scenes_data_sets[id_scene].steps for scene_list, id_scene in tasks)
+        steps = {"finished": 0, "running": {}} # running: unit index -> {scene in the worker: steps}
+        steps_lock = threading.Lock()
+
+        def show_steps():
+            nbr_steps = steps["finished"] + sum(sum(unit_steps.values()) for unit_steps in steps["running"].values())
+            pbar_scenes.set_postfix(f"{nbr_steps}/{total_steps} steps")
+
+        def progress_handler(unit_index):
+            started = set() # scenes of the unit already logged: a benchmark starts one worker per repeat
+            def on_message(message):
+                if message["event"] == "started" and message["scene"] not in started:
+                    # the logs the serial run writes before running a scene
+                    started.add(message["scene"])
+                    scene_list, id_scene = tasks[units[unit_index][message["scene"]]]
+                    scene_list.log_scene_start(id_scene, mode)
+                elif message["event"] == "progress":
+                    with steps_lock:
+                        steps["running"].setdefault(unit_index, {})[message["scene"]] = message["step"]
+                        show_steps()
+            return on_message
+
+        # set once --max-failures is reached: the workers still running are stopped
+        cancel = threading.Event()
+
+        def run_unit(unit_index):
+            unit = units[unit_index]
+            scene_list = tasks[unit[0]][0]
+            if len(unit) == 1:
+                return [scene_list.run_scene(tasks[unit[0]][1], mode, True, progress_handler(unit_index), cancel)]
+            return scene_list.run_batch([tasks[task_id][1] for task_id in unit], mode, True,
+                                        progress_handler(unit_index), cancel)
+
+        results = [None] * len(tasks)
+        nbr_failures = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nbr_jobs) as executor:
+            # progress bars of concurrent workers would interleave: only the global one is kept
+            futures = {executor.submit(run_unit, unit_index): unit_index for unit_index in range(len(units))}
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
+                unit_index = futures[future]
+                unit = units[unit_index]
+                try:
+                    unit_results = future.result()
+                except Exception as e:
+                    unit_results = [{"ok": False, "error": f"Failed to run worker: {e}"}] * len(unit)
+                with steps_lock:
+                    steps["running"].pop(unit_index, None)
+                    steps["finished"] += sum(tasks[task_id][0].scenes_data_sets[tasks[task_id][1]].steps
+                                             for task_id in unit)
+                    show_steps()
+                for task_id, result in zip(unit, unit_results):
+                    pbar_scenes.update(1)
+                    if result.get("cancelled", False):
+                        continue # reported skipped
+                    results[task_id] = result
+
+                    if mode == "compare" and not (result.get("ok", False) and result.get("result", False)):
+                        nbr_failures = nbr_failures + 1
+                if self.max_failures is not None and nbr_failures >= self.max_failures:
+                    # pending workers are dropped, running ones are stopped
+                    cancel.set()
+                    for pending in futures:
+                        pending.cancel()
+
+        pbar_scenes.close()
+
+        nbr_scenes = 0
+        for task_id, (scene_list, id_scene) in enumerate(tasks):
+            if results[task_id] is None:
+                scene_list.scenes_data_sets[id_scene].skipped = True
+                self.nbr_skipped_scenes = self.nbr_skipped_scenes + 1
+                continue
+            scene_list.apply_result(id_scene, mode, results[task_id])
+            nbr_scenes = nbr_scenes + 1
+
+        return nbr_scenes
+
+    def make_batches(self, tasks, submit_order):
+        """Group the scenes verified batchable in batches of up to batch_size
+        scenes of the same list, the other scenes being run alone.
+
+        Args:
+            tasks (list): the (scene_list, id_scene) of every scene.
+            submit_order (list): the order in which the tasks are started.
+
+        Returns:
+            list: the units of work, each one a list of tasks, in start order.
+        """
+        units = []
+        open_batches = {} # scene list -> batch being filled
+        for task_id in submit_order:
+            scene_list, id_scene = tasks[task_id]
+            if not self.batch_registry.is_batchable(scene_list.scenes_data_sets[id_scene]):
+                units.append([task_id])
+                continue
+            batch = open_batches.get(id(scene_list))
+            if batch is None or len(batch) >= self.batch_size:
+                batch = []
+                open_batches[id(scene_list)] = batch
+                units.append(batch)
+            batch.append(task_id)
+        return units
+
+    def verify_batchable(self):
+        """Find the scenes which give the same results alone and after other
+        scenes in the same worker, and record them in the batch registry.
+
+        The references of every scene are written in a temporary folder three
+        times: alone in its own worker, and in a batch of all the scenes, in
+        both orders, so that every scene runs after other ones. A scene is
+        batchable if they are bit-identical (uncompressed BINARY references).
+
+        Returns:
+            int: the number of scenes found batchable.
+        """
+        tasks = self.get_all_scenes()
+        if len(tasks) < 2:
+            raise ValueError("at least 2 scenes are needed to verify that they can be batched")
+        options = dict(disable_progress_bar=True, verbose=self.verbose, format="BINARY", fork_server=self.fork_server,
+                       codec="none")
+        orders = {"forward": list(range(len(tasks))), "backward": list(reversed(range(len(tasks))))}
+
+        with tempfile.TemporaryDirectory(prefix="regression_batch_verification_") as verification_dir:
+            def isolated_scene(run_name, task_id):
+                """The scene of a task, writing its references in its own folder of the run."""
+                scene_list, id_scene = tasks[task_id]
+                scene = scene_list.scenes_data_sets[id_scene]
+                ref_dir = os.path.join(verification_dir, run_name, str(task_id))
+                os.makedirs(ref_dir)
+                return RegressionSceneData.RegressionSceneData(scene.file_scene_path, os.path.join(ref_dir, "scene"),
+                                                               scene.steps, scene.epsilon, scene.meca_in_mapping,
+                                                               scene.dump_number_step, True, self.verbose, fields=scene.fields)
+
+            limits = [scene_list.scene_limits(id_scene) for scene_list, id_scene in tasks]
+            results = {}
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.nbr_jobs) as executor:
+                # the batches are the longest: started first
+                batch_futures = {run_name: executor.submit(RegressionWorker.run_batch_in_subprocess,
+                                                           [isolated_scene(run_name, task_id) for task_id in order],
+                                                           "write", scene_limits=[limits[task_id] for task_id in order],
+                                                           **options)
+                                 for run_name, order in orders.items()}
+                alone_futures = [executor.submit(RegressionWorker.run_scene_in_subprocess, isolated_scene("alone", task_id),
+                                                 "write", timeout=limits[task_id][0], max_memory=limits[task_id][1],
+                                                 **options)
+                                 for task_id in range(len(tasks))]
+                results["alone"] = [future.result() for future in alone_futures]
+                for run_name, order in orders.items():
+                    results[run_name] = [None] * len(tasks)
+                    for task_id, result in zip(order, batch_futures[run_name].result()):
+                        results[run_name][task_id] = result
+
+            nbr_batchable = 0
+            for task_id, (scene_list, id_scene) in enumerate(tasks):
+                scene = scene_list.scenes_data_sets[id_scene]
+                reason = None
+                for run_name in results:
+                    result = results[run_name][task_id]
+                    if result is None:
+                        reason = f"the {run_name} batch stopped before its end"
+                    elif not result.get("ok", False):
+                        reason = f"writing its references {run_name if run_name == 'alone' else 'in a batch'} failed: " \
+                                 f"{result.get('error')}"
+                    if reason is not None:
+                        break
+                if reason is None and not self.same_references(verification_dir, task_id, results.keys()):
+                    reason = "its references differ when it runs after other scenes"
+
+                try:
+                    self.batch_registry.record(scene, reason is None, reason)
+                except OSError as e:
+                    reason = str(e)
+                if reason is None:
+                    nbr_batchable = nbr_batchable + 1
+                else:
+                    helper.writeWarning(f"{scene.file_scene_path} cannot be batched: {reason}.")
+        return nbr_batchable
+
+    @staticmethod
+    def same_references(verification_dir, task_id, run_names):
+        """Whether the reference files written for a task by every run are bit-identical."""
+        run_dirs = [os.path.join(verification_dir, run_name, str(task_id)) for run_name in run_names]
+        file_names = sorted(os.listdir(run_dirs[0]))
+        for run_dir in run_dirs[1:]:
+            if sorted(os.listdir(run_dir)) != file_names:
+                return False
+            for file_name in file_names:
+                if not filecmp.cmp(os.path.join(run_dirs[0], file_name), os.path.join(run_dir, file_name), shallow=False):
+                    return False
+        return True
+
     def write_all_sets_references(self):
+        if self.nbr_jobs > 1 or self.batch_size > 1:
+            return self.run_all_scenes_in_parallel("write")
+
         nbr_sets = len(self.scene_sets)
 
         pbar_sets = pbh.ProgressBarHandler(total=nbr_sets, disable=self.disable_progress_bar)
@@ -79,13 +667,33 @@ class RegressionProgram:
 
         return nbr_scenes
 
+    def benchmark_all_sets(self):
+        if self.nbr_jobs > 1:
+            helper.writeWarning("Benchmarking scenes concurrently makes step times noisy: prefer --jobs 1.")
+            return self.run_all_scenes_in_parallel("benchmark")
+
+        nbr_scenes = 0
+        for scene_list in self.scene_sets:
+            nbr_scenes = nbr_scenes + scene_list.benchmark_all_references()
+        return nbr_scenes
+
     def compare_sets_references(self, id_set=0):
         scene_list = self.scene_sets[id_set]
         scene_list.legacy_mode = self.legacy_mode
-        nbr_scenes = scene_list.compare_all_references()
+
+        max_errors = None
+        if self.max_failures is not None:
+            # errors of the other sets count too
+            max_errors = self.max_failures - (self.nbr_error_in_sets() - scene_list.get_nbr_errors())
+
+        nbr_scenes = scene_list.compare_all_references(max_errors)
+        self.nbr_skipped_scenes = self.nbr_skipped_scenes + scene_list.get_nbr_scenes() - nbr_scenes
         return nbr_scenes
 
     def compare_all_sets_references(self):
+        if self.nbr_jobs > 1 or self.batch_size > 1:
+            return self.run_all_scenes_in_parallel("compare")
+
         nbr_sets = len(self.scene_sets)
         pbar_sets = pbh.ProgressBarHandler(total=nbr_sets, disable=self.disable_progress_bar)
         pbar_sets.set_description("Compare All sets")
@@ -99,9 +707,20 @@ class RegressionProgram:
 
         return nbr_scenes
 
-    def replay_references(self, id_scene, id_set=0):
+    def list_scenes(self):
+        """Print the scenes which would be run (after filtering and sharding), one per line."""
+        for scene_list in self.scene_sets:
+            for scene in scene_list.scenes_data_sets:
+                criterion = f" criterion={scene.criterion}" if scene.criterion != ErrorMetrics.default_criterion else ""
+                fields = f" fields={FieldCapture.format_fields(scene.fields)}" if scene.fields else ""
+                print(f"{scene.file_scene_path} {scene.steps} {scene.epsilon} {int(scene.meca_in_mapping)} "
+                      f"{scene.dump_number_step}{criterion}{fields}")
+
+    def replay_references(self, id_scene, id_set=0, frame=None):
+        # the scene is replayed in this process
+        RegressionWorker.setup_environment()
         scene_list = self.scene_sets[id_set]
-        scene_list.replay_references(id_scene)
+        scene_list.replay_references(id_scene, frame)
 
 
 
@@ -132,13 +751,222 @@ def make_parser():
                         dest='replay', 
                         help=f"Will launch runSofa on the scene number X (input number) in the input the list of the {regression_file_extension} file given as input and display the scene references aside from the simulation",
                         type=int)
+    parser.add_argument('--replay-frame',
+                        dest='replay_frame',
+                        help="With --replay, start at this key frame (e.g. the one at which the scene failed, see "
+                             "\"Threshold exceeded at key frame\") instead of t=0: the scene is first simulated to "
+                             "this frame without rendering.",
+                        type=int)
     
+    parser.add_argument('--format',
+                        dest='format',
+                        help="Format of the reference files to write or compare: JSON and CSV are gzip text files, "
+                             "BINARY stores contiguous float64 frames which are memory mapped when compared. Defaults to JSON.",
+                        choices=["JSON", "CSV", "BINARY"],
+                        default="JSON")
+    parser.add_argument('--codec',
+                        dest='codec',
+                        help="Compression of the written references: gzip[:level], bz2[:level], lzma[:level], "
+                             "zstd[:level] (if available) or none. Overrides the codec=<codec> option of the options "
+                             f"file of the lists (<list file>{RegressionSceneList.options_file_suffix}). Defaults to gzip:9 for JSON and CSV, none for BINARY. "
+                             "The codec is detected when reading, whatever the extension.",
+                        type=str)
+    parser.add_argument('--binary-encoding',
+                        dest='binary_encoding',
+                        help="Encoding of the written BINARY references: raw frames (memory mapped when compared), or "
+                             "xor: each frame stored as the bitwise difference with the previous one, which compresses "
+                             "much better (the codec defaults to gzip:6). Lossless. Defaults to raw.",
+                        choices=["raw", "xor"],
+                        default="raw")
+    parser.add_argument('--binary-precision',
+                        dest='binary_precision',
+                        help="Precision of the written BINARY references. float32 halves their size; a reference is only "
+                             "stored in float32 if its rounding error stays below epsilon/1000 (measured with the error "
+                             "by dof and the criterion of the scene, accumulated as in the comparison), else in float64. "
+                             "Defaults to float64.",
+                        choices=["float64", "float32"],
+                        default="float64")
+
+    parser.add_argument('--metrics',
+                        dest='metrics',
+                        help="Comma separated error metrics computed and reported for each compared scene besides its "
+                             "criterion (see the criterion= option of the scenes): "
+                             + ", ".join(ErrorMetrics.metric_names) + ".",
+                        type=str)
+    parser.add_argument(
+        "--fail-fast-scene",
+        dest="fail_fast_scene",
+        help='If set, a compared scene stops simulating as soon as its error exceeds the threshold, '
+             'since the scene cannot pass anymore. The key frame where it happened is reported.',
+        action='store_true'
+    )
+    parser.add_argument('--max-failures',
+                        dest='max_failures',
+                        help="Stop the compare run once this number of scenes failed: pending scenes are not run, running "
+                             "ones are stopped, and they are reported as skipped.",
+                        type=int)
+
+    parser.add_argument('--timeout',
+                        dest='timeout',
+                        help="Time limit of each scene in seconds: a scene still running after it is killed and reported as such. "
+                             "A scene can override it with a timeout=<seconds> option in the options file of its list "
+                             f"(<list file>{RegressionSceneList.options_file_suffix}).",
+                        type=float)
+    parser.add_argument('--max-memory',
+                        dest='max_memory',
+                        help="Resident memory limit of each scene in MB: a scene using more is killed and reported as such. "
+                             "A scene can override it with a max_memory=<MB> option in the options file of its list. "
+                             "Only enforced where the memory of a process can be read from /proc (e.g. not on macOS).",
+                        type=float)
+
+    parser.add_argument('--cache-dir',
+                        dest='cache_dir',
+                        help="Directory of a persistent cache of passing compare results. A scene whose scene file, reference files, "
+                             "list parameters and SOFA build are unchanged since it last passed is reported as a cached pass without being run. "
+                             "Other files used by the scenes are not tracked: use --clear-cache after changing them.",
+                        type=str)
+    parser.add_argument(
+        "--clear-cache",
+        dest="clear_cache",
+        help='If set, invalidate all the results of the cache given by --cache-dir before running.',
+        action='store_true'
+    )
+    parser.add_argument('--cache-max-entries',
+                        dest='cache_max_entries',
+                        help="Maximum number of results kept in the cache, the least recently used are evicted first. Defaults to 5000.",
+                        type=int,
+                        default=5000)
+
+    parser.add_argument('--trace-file',
+                        dest='trace_file',
+                        help="Write the time spent by every scene in each phase (worker startup, SOFA import, load, init, "
+                             "reference decode, each animate() step, comparison, reference encode) to this file, "
+                             "as a Chrome trace JSON which can be opened in Perfetto or chrome://tracing.",
+                        type=str)
+
+    parser.add_argument('--timing-history',
+                        dest='timing_history',
+                        help="JSON file where the wall, animate and load times of each scene are kept between runs. "
+                             "Parallel runs start the longest scenes first. The timings depend on the machine: "
+                             "use one file per machine and input folder. Scenes stopped early (--fail-fast, "
+                             "--max-failures) and benchmarks are not recorded. Disabled by default.",
+                        type=str)
+
+    parser.add_argument('--batch-size',
+                        dest='batch_size',
+                        help="Run up to N scenes of a list in the same worker, one after another, to pay the startup once "
+                             "per batch. Only the scenes verified with --verify-batchable are batched, the others are "
+                             "still run alone. Not used by --benchmark. Defaults to 1 (every scene in its own worker).",
+                        type=int,
+                        default=1)
+    parser.add_argument(
+        "--verify-batchable",
+        dest="verify_batchable",
+        help='If set, write the references of every scene alone and after the other scenes in a temporary folder, '
+             'and record the scenes whose results are bit-identical as batchable in the batch registry. '
+             'No reference is written or compared.',
+        action='store_true'
+    )
+    parser.add_argument('--batch-registry',
+                        dest='batch_registry',
+                        help="JSON file where the scenes verified batchable are recorded. "
+                             f"Defaults to {BatchRegistry.default_registry_path()}.",
+                        type=str,
+                        default=BatchRegistry.default_registry_path())
+
+    parser.add_argument('--discovery-index',
+                        dest='discovery_index',
+                        help=f"JSON file indexing the {regression_file_extension} files of the input folder and their parsed "
+                             "scenes, by modification time: only the changed directories are listed again and only the "
+                             "changed list files parsed again. Defaults to a file per input folder in the user cache directory.",
+                        type=str)
+    parser.add_argument(
+        "--no-discovery-index",
+        dest="no_discovery_index",
+        help='If set, the input folder is fully walked and every list file parsed, without using an index.',
+        action='store_true'
+    )
+
+    parser.add_argument('--shard',
+                        dest='shard',
+                        help="Only run the i-th of N groups of scenes (1 <= i <= N), split to have roughly equal expected costs "
+                             "(number of steps x reference size). The split is deterministic as long as all the shards use "
+                             "the same input folder and references: the timing history is not used for it.",
+                        type=str)
+    parser.add_argument(
+        "--list-scenes",
+        dest="list_scenes",
+        help='If set, print the scenes which would be run (after --filter and --shard) with their steps, epsilon, '
+             'mechanical-objects-in-mapping flag and dump step, without running them. SOFA is not needed.',
+        action='store_true'
+    )
+    parser.add_argument('--results-file',
+                        dest='results_file',
+                        help="Write the outcome of every scene of the run to this JSON file (e.g. one per shard).",
+                        type=str)
+    parser.add_argument('--merge-results',
+                        dest='merge_results',
+                        help="Merge the given results files (e.g. of all the shards of a run) into one summary, "
+                             "with the same logs and exit code as a single run. No scene is run. Fails if a shard is "
+                             "missing or given twice, or if a scene was run by several shards or by none.",
+                        nargs='+',
+                        type=str)
+
+    parser.add_argument('--jobs', '-j',
+                        dest='jobs',
+                        help="Number of scenes simulated concurrently, each one in its own isolated worker process. "
+                             "All the scenes of all the sets share a single work queue. Defaults to 1.",
+                        type=int,
+                        default=1)
+
+    parser.add_argument(
+        "--fork-server",
+        dest="fork_server",
+        help='If set, SOFA is imported once in a warm worker which forks one fresh child per scene, '
+             'instead of spawning a new interpreter per scene. Ignored where fork is not available.',
+        action='store_true'
+    )
+    parser.add_argument('--preload-plugin',
+                        dest='preload_plugins',
+                        help="Plugin loaded once by the fork server before forking the scene workers. "
+                             "Can be repeated. Defaults to Sofa.Component.",
+                        action='append',
+                        type=str)
+
     parser.add_argument(
         "--write-references",
         dest="write_mode",
-        help='If set, will generate new reference files',
+        help='If set, will generate new reference files (or new baselines with --benchmark)',
         action='store_true'
     )
+    parser.add_argument(
+        "--benchmark",
+        dest="benchmark",
+        help='If set, time the steps of each scene instead of comparing its results, and fail the scenes whose '
+             'median step time regressed compared with the baseline stored next to their references. '
+             'Scenes without baseline get one. Use it with --jobs 1 on a quiet machine.',
+        action='store_true'
+    )
+    parser.add_argument('--benchmark-warmup',
+                        dest='benchmark_warmup',
+                        help="Number of untimed steps simulated before the timed ones. Defaults to 10.",
+                        type=int,
+                        default=10)
+    parser.add_argument('--benchmark-repeats',
+                        dest='benchmark_repeats',
+                        help="Number of times each scene is loaded and timed, each time in a fresh worker. Defaults to 5.",
+                        type=int,
+                        default=5)
+    parser.add_argument('--benchmark-threshold',
+                        dest='benchmark_threshold',
+                        help="Maximum slowdown of the median step time, in percent. Defaults to 10.",
+                        type=float,
+                        default=10.0)
+    parser.add_argument('--benchmark-min-effect',
+                        dest='benchmark_min_effect',
+                        help="Slowdowns of the median step time smaller than this, in microseconds, are considered as noise. Defaults to 10.",
+                        type=float,
+                        default=10.0)
     parser.add_argument(
         "--disable-progress-bar",
         dest="progress_bar_is_disabled",
@@ -169,19 +997,78 @@ Examples:
     python SofaRegressionProgram.py --input ./scenes
     python SofaRegressionProgram.py --input ./scenes --filter \"$demo.*.scn\"
     python SofaRegressionProgram.py --input ./scenes --replay 5
+    python SofaRegressionProgram.py --input ./scenes --jobs 8
+    python SofaRegressionProgram.py --input ./scenes --shard 2/4 --results-file shard2.json
+    python SofaRegressionProgram.py --merge-results shard1.json shard2.json shard3.json shard4.json
         '''
 
     return parser
 
 
+def check_sofa_root():
+    """Quit if there is no SOFA build to run the scenes with."""
+    if "SOFA_ROOT" not in os.environ:
+        print('SOFA_ROOT environment variable has not been detected, quitting.')
+        exit(1)
+
+
+def print_summary(reg_prog, nbr_scenes, write_mode):
+    """Print the outcome of a run and return the exit code of the program."""
+    np.set_printoptions(legacy='1.25') # revert printing floating-point type in numpy (concretely remove np.array when displaying a list of np.float)
+    
+    nbr_parsing_errors = reg_prog.nbr_parsing_error_in_sets()
+
+    print ("### Number of sets Done:  " + str(len(reg_prog.scene_sets)))
+    print ("### Number of scenes Done:  " + str(nbr_scenes))
+    if reg_prog.nbr_killed_in_sets() > 0:
+        print ("### Number of scenes killed (time or memory limit):  " + str(reg_prog.nbr_killed_in_sets()))
+    if nbr_parsing_errors > 0:
+        # Those scenes have not been processed at all: report them as an error
+        # so that an invalid list file cannot silently reduce the test coverage.
+        print ("### Number of invalid lines skipped:  " + str(nbr_parsing_errors))
+    if write_mode is False:
+        print ("### Number of scenes failed:  " + str(reg_prog.nbr_error_in_sets()))
+        if reg_prog.nbr_cached_in_sets() > 0:
+            print ("### Number of cached passes:  " + str(reg_prog.nbr_cached_in_sets()))
+        if reg_prog.nbr_skipped_scenes > 0:
+            print ("### Number of scenes skipped (--max-failures reached):  " + str(reg_prog.nbr_skipped_scenes))
+        reg_prog.log_errors_in_sets()
+        if reg_prog.nbr_error_in_sets() > 0:
+            return 1 # exit with error(s)
+
+    if nbr_parsing_errors > 0:
+        return 1 # exit with error(s)
+
+    return 0 # exit without error
+
+
 if __name__ == '__main__':
     # 1- Parse arguments to get folder path
     parser = make_parser()
     args = parser.parse_args()
 
+    # Merge the results of several runs (e.g. shards), without running anything
+    if args.merge_results is not None:
+        reg_prog = RegressionProgram(None, disable_progress_bar=args.progress_bar_is_disabled, verbose=args.verbose)
+        try:
+            mode = reg_prog.merge_results_files(args.merge_results)
+        except (OSError, ValueError, KeyError) as e:
+            exit(f"Error: cannot merge results files: {e}")
+        sys.exit(print_summary(reg_prog, reg_prog.nbr_scenes_done, mode == "write"))
+
+    # Running or replaying scenes needs SOFA, listing them does not
+    if not args.list_scenes:
+        check_sofa_root()
+
     # 2- Process file
     if args.input is not None:
-        reg_prog = RegressionProgram(args.input, args.filter, args.progress_bar_is_disabled, args.verbose)
+        discovery_index = None
+        if not args.no_discovery_index:
+            discovery_index = DiscoveryIndex.DiscoveryIndex(
+                args.discovery_index if args.discovery_index is not None else DiscoveryIndex.default_index_path(args.input),
+                args.input)
+        reg_prog = RegressionProgram(args.input, args.filter, args.progress_bar_is_disabled, args.verbose, args.jobs, args.format,
+                                     discovery_index)
     else:
         parser.print_help()
         exit("Error: Argument is required ! Quitting.")
@@ -191,11 +1078,73 @@ if __name__ == '__main__':
     if args.legacy_mode:
         print("Legacy regression mode activated.")
         reg_prog.legacy_mode = True
+
+    if args.cache_dir is not None:
+        reg_prog.open_result_cache(args.cache_dir, args.cache_max_entries, args.clear_cache)
+    elif args.clear_cache:
+        exit("Error: --clear-cache requires --cache-dir ! Quitting.")
+
+    if args.timing_history is not None:
+        reg_prog.open_timing_history(args.timing_history)
+
+    if args.shard is not None:
+        try:
+            nbr_shard_scenes = reg_prog.apply_shard(args.shard)
+        except ValueError as e:
+            exit(f"Error: {e} ! Quitting.")
+        print(f"Shard {args.shard}: {nbr_shard_scenes} scenes.")
+
+    if args.metrics is not None:
+        try:
+            reg_prog.set_metrics(ErrorMetrics.parse_metrics(args.metrics))
+        except ValueError as e:
+            exit(f"Error: {e} ! Quitting.")
+    if args.fail_fast_scene:
+        reg_prog.set_fail_fast_scene(True)
+    if args.max_failures is not None:
+        if args.max_failures <= 0:
+            exit("Error: --max-failures must be strictly positive ! Quitting.")
+        reg_prog.max_failures = args.max_failures
+    for limit in (args.timeout, args.max_memory):
+        if limit is not None and limit <= 0:
+            exit("Error: --timeout and --max-memory must be strictly positive ! Quitting.")
+    reg_prog.set_scene_limits(args.timeout, args.max_memory)
+    reg_prog.check_scene_limits()
+    if args.codec is not None:
+        try:
+            Codecs.parse_codec(args.codec)
+        except ValueError as e:
+            exit(f"Error: {e} ! Quitting.")
+        reg_prog.set_codec(args.codec)
+    if args.binary_encoding != "raw" or args.binary_precision != "float64":
+        if args.format != "BINARY":
+            exit("Error: --binary-encoding and --binary-precision require --format BINARY ! Quitting.")
+        reg_prog.set_binary_encoding(args.binary_encoding, args.binary_precision)
+    if args.trace_file is not None:
+        reg_prog.set_profile(True)
+    if args.batch_size <= 0:
+        exit("Error: --batch-size must be strictly positive ! Quitting.")
+    if args.verify_batchable or args.batch_size > 1:
+        reg_prog.open_batch_registry(args.batch_registry)
+        reg_prog.set_batch_size(args.batch_size)
+    if args.benchmark:
+        if args.benchmark_warmup < 0 or args.benchmark_repeats <= 0:
+            exit("Error: --benchmark-warmup must be positive and --benchmark-repeats strictly positive ! Quitting.")
+        reg_prog.set_benchmark_options(Benchmark.BenchmarkOptions(args.benchmark_warmup, args.benchmark_repeats,
+                                                                  args.benchmark_threshold, args.benchmark_min_effect,
+                                                                  update_baselines=args.write_mode))
     
+    if args.list_scenes:
+        reg_prog.list_scenes()
+        print("### Number of scenes:  " + str(len(reg_prog.get_all_scenes())))
+        sys.exit(1 if reg_prog.nbr_parsing_error_in_sets() > 0 else 0)
+
     if args.replay is not None:
         replayId = int(args.replay)
-        reg_prog.replay_references(replayId)
+        reg_prog.replay_references(replayId, frame=args.replay_frame)
         sys.exit()
+    elif args.replay_frame is not None:
+        exit("Error: --replay-frame requires --replay ! Quitting.")
 
     old_fd = os.dup(1)
     if args.quiet:
@@ -205,36 +1154,54 @@ if __name__ == '__main__':
         os.dup2(devnull, 1)
         os.close(devnull)
 
-    if args.write_mode:
+    if args.fork_server:
+        # started after the --quiet redirection so that the forked workers inherit it
+        reg_prog.start_fork_server(args.preload_plugins if args.preload_plugins is not None else ["Sofa.Component"])
+
+    if args.verify_batchable:
+        try:
+            nbr_batchable = reg_prog.verify_batchable()
+        except ValueError as e:
+            exit(f"Error: {e} ! Quitting.")
+        finally:
+            reg_prog.stop_fork_server()
+            reg_prog.close_batch_registry()
+        if args.quiet:
+            sys.stdout.flush()
+            os.dup2(old_fd, 1)
+            os.close(old_fd)
+        print(f"### Number of scenes verified batchable:  {nbr_batchable} / {len(reg_prog.get_all_scenes())}")
+        sys.exit(0)
+
+    if args.benchmark:
+        mode = "benchmark"
+        nbr_scenes = reg_prog.benchmark_all_sets()
+    elif args.write_mode:
+        mode = "write"
         nbr_scenes = reg_prog.write_all_sets_references()
     else:
+        mode = "compare"
         nbr_scenes = reg_prog.compare_all_sets_references()
 
+    reg_prog.stop_fork_server()
+    reg_prog.close_result_cache()
+    reg_prog.close_timing_history()
+    reg_prog.close_batch_registry()
+
+    if args.results_file is not None:
+        reg_prog.export_results(args.results_file, mode, nbr_scenes)
+    if args.trace_file is not None:
+        reg_prog.export_trace(args.trace_file)
+
     if args.quiet:
         # Restore
         sys.stdout.flush()
         os.dup2(old_fd, 1)
         os.close(old_fd)
 
-    np.set_printoptions(legacy='1.25') # revert printing floating-point type in numpy (concretely remove np.array when displaying a list of np.float)
-    
-    nbr_parsing_errors = reg_prog.nbr_parsing_error_in_sets()
+    if args.trace_file is not None:
+        print(f"### Trace written to {args.trace_file}, time by phase:")
+        for name, total in sorted(reg_prog.phase_summary().items(), key=lambda item: -item[1]["time"]):
+            print(f"###    {name}: {total['time']/1e9:.3f} seconds ({total['count']} times)")
 
-    print ("### Number of sets Done:  " + str(len(reg_prog.scene_sets)))
-    print ("### Number of scenes Done:  " + str(nbr_scenes))
-    if nbr_parsing_errors > 0:
-        # Those scenes have not been processed at all: report them as an error
-        # so that an invalid list file cannot silently reduce the test coverage.
-        print ("### Number of invalid lines skipped:  " + str(nbr_parsing_errors))
-    if args.write_mode is False:
-        print ("### Number of scenes failed:  " + str(reg_prog.nbr_error_in_sets()))
-        reg_prog.log_errors_in_sets()
-        if reg_prog.nbr_error_in_sets() > 0:
-            sys.exit(1) # exit with error(s)
-
-    if nbr_parsing_errors > 0:
-        sys.exit(1) # exit with error(s)
-
-    sys.exit(0) # exit without error
-
-    
+    sys.exit(print_summary(reg_prog, nbr_scenes, mode == "write"))
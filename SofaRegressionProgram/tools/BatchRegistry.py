@@ -0,0 +1,114 @@
+"""
+Persistent registry of the scenes which can be run in a batch.
+
+Every scene normally runs in its own process because SOFA does not fully reset
+its global state between two load/unload cycles: the result of some scenes
+depends on the scenes simulated before them in the same process. Many small
+scenes do not, and can share one worker (see RegressionWorker) so that the
+startup is paid once per batch.
+
+A scene is only batched once it has been verified (--verify-batchable): its
+references are written alone in a fresh process, and after other scenes in a
+batch (in both orders), and it is batchable if all of them are bit-identical.
+The verdict is kept for the SOFA build, the content of the scene file and the
+parameters it was verified with (its line and its options): changing any of
+them requires a new verification. A scene whose batch crashed while running
+it is recorded as not batchable, so that it runs alone until verified again.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+import tools.ResultCache as ResultCache
+
+registry_version = 1
+
+
+def default_registry_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "SofaRegressionProgram", "batchable_scenes.json")
+
+
+class BatchRegistry:
+    def __init__(self, registry_path, sofa_root = None):
+        """Open (or create) a registry of batchable scenes.
+
+        Args:
+            registry_path (str): JSON file of the registry.
+            sofa_root (str): SOFA build the verifications apply to. Defaults to $SOFA_ROOT.
+        """
+        self.registry_path = registry_path
+        self.sofa_root = sofa_root if sofa_root is not None else os.environ.get("SOFA_ROOT", "")
+        self.entries = {} # scene key -> {"scene", "batchable", "reason", "verified"}
+        self.lock = threading.Lock()
+        self.sofa_fingerprint = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.registry_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == registry_version:
+            self.entries = data.get("entries", {})
+
+    def save(self):
+        with self.lock:
+            data = {"version": registry_version, "entries": self.entries}
+
+        registry_dir = os.path.dirname(self.registry_path)
+        if registry_dir:
+            os.makedirs(registry_dir, exist_ok=True)
+        tmp_path = self.registry_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.registry_path)
+
+    def scene_key(self, scene_data):
+        """Key of a scene: hash of the SOFA build, of the scene file and of its parameters.
+
+        Raises:
+            OSError: if the scene file cannot be read.
+        """
+        with self.lock:
+            if self.sofa_fingerprint is None:
+                self.sofa_fingerprint = ResultCache.sofa_build_fingerprint(self.sofa_root)
+        hasher = hashlib.sha256()
+        hasher.update(self.sofa_fingerprint.encode("utf-8"))
+        hasher.update(f"{scene_data.steps}|{scene_data.meca_in_mapping}|{scene_data.dump_number_step}|"
+                      f"{scene_data.criterion}|{sorted(scene_data.fields.items())}\n".encode("utf-8"))
+        with open(scene_data.file_scene_path, "rb") as f:
+            hasher.update(f.read())
+        return hasher.hexdigest()
+
+    def record(self, scene_data, batchable, reason = None):
+        """Record the outcome of the verification of a scene.
+
+        Args:
+            batchable (bool): whether its results are the same alone and in a batch.
+            reason (str): why it is not batchable.
+
+        Raises:
+            OSError: if the scene file cannot be read.
+        """
+        key = self.scene_key(scene_data)
+        with self.lock:
+            # the verifications of the previous versions of the scene are obsolete
+            self.entries = {other_key: entry for other_key, entry in self.entries.items()
+                            if entry["scene"] != scene_data.file_scene_path}
+            self.entries[key] = {"scene": scene_data.file_scene_path, "batchable": bool(batchable), "reason": reason,
+                                 "verified": time.time()}
+
+    def is_batchable(self, scene_data):
+        """Whether the scene has been verified batchable, in its current state."""
+        try:
+            key = self.scene_key(scene_data)
+        except OSError:
+            return False
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry["batchable"]
@@ -0,0 +1,152 @@
+"""
+Step time benchmark of the scenes, compared with stored baselines.
+
+A benchmarked scene is run `repeats` times, each time in a fresh worker, so
+that the repeats do not share the state of a process (caches, allocator,
+SOFA globals) and are independent samples. Each time it is simulated for
+`warmup` untimed steps, then for its number of steps (from the list file) with
+every animate() timed. The statistics of the step times
+are stored as a baseline next to the reference files of the scene
+(<reference path>.benchmark.json).
+
+A later run fails the scene when its median step time is slower than the
+baseline by more than the threshold. To tell a slowdown from noise, the
+median is the median of the medians of each repeat, and a slowdown is only
+reported when it is also larger than a minimum effect size and when even the
+fastest repeat is slower than the slowest repeat of the baseline.
+
+Step times depend on the machine: baselines must be written and compared on
+the same one, with a single job (--jobs 1) to avoid scenes competing for CPU.
+A baseline written on another machine is reported when compared.
+"""
+
+import os
+import json
+import time
+import platform
+import numpy as np
+
+import tools.PhaseProfiler as PhaseProfiler
+
+baseline_version = 1
+baseline_extension = ".benchmark.json"
+
+
+class BenchmarkOptions:
+    def __init__(self, warmup = 10, repeats = 5, threshold = 10.0, min_effect = 10.0, update_baselines = False):
+        """
+        Args:
+            warmup (int): untimed steps before the timed ones, in each repeat.
+            repeats (int): number of workers the scene is loaded and timed in.
+            threshold (float): maximum slowdown of the median step time, in percent.
+            min_effect (float): slowdowns smaller than this, in microseconds per
+                step, are never reported.
+            update_baselines (bool): write the baselines instead of comparing with them.
+        """
+        self.warmup = warmup
+        self.repeats = repeats
+        self.threshold = threshold
+        self.min_effect = min_effect
+        self.update_baselines = update_baselines
+
+
+def baseline_path(scene_data):
+    return scene_data.file_ref_path + baseline_extension
+
+
+def step_time_statistics(repeat_step_times):
+    """Statistics of the step times of the repeats of a scene.
+
+    Args:
+        repeat_step_times (list): for each repeat, the duration of each timed step in ns.
+
+    Returns:
+        dict: the step time percentiles, mean, min and max over all the steps,
+        the "median" of the repeat medians and the "repeat_medians", all in seconds.
+    """
+    all_times = np.concatenate([np.asarray(times, dtype=np.float64) for times in repeat_step_times]) / 1e9
+    repeat_medians = [float(np.median(times)) / 1e9 for times in repeat_step_times]
+    p10, p50, p90, p99 = np.percentile(all_times, [10, 50, 90, 99])
+    return {
+        "nbr_steps": int(all_times.size),
+        "p10": float(p10), "p50": float(p50), "p90": float(p90), "p99": float(p99),
+        "mean": float(all_times.mean()), "min": float(all_times.min()), "max": float(all_times.max()),
+        "median": float(np.median(repeat_medians)),
+        "repeat_medians": repeat_medians,
+    }
+
+
+def merge_repeat_results(results):
+    """Merge the worker results of the repeats of a benchmark, each one run
+    with a single repeat, into the result of the benchmark.
+
+    Returns:
+        dict: the first result, with the "statistics" of all the step times,
+        the "wall_time" from the launch of the first worker to the end of the
+        last one, and the sum of the "total_run_time" and of the "phases".
+    """
+    result = dict(results[0])
+    repeat_step_times = [times for repeat_result in results for times in repeat_result["repeat_step_times"]]
+    del result["repeat_step_times"]
+    result["statistics"] = step_time_statistics(repeat_step_times)
+    result["total_run_time"] = sum(repeat_result["total_run_time"] for repeat_result in results)
+    if "launch_time" in results[0]:
+        result["wall_time"] = results[-1]["launch_time"] + results[-1]["wall_time"] - results[0]["launch_time"]
+    result["phases"] = PhaseProfiler.merge_summaries([repeat_result.get("phases", {}) for repeat_result in results])
+    if "phase_events" in result:
+        result["phase_events"] = [event for repeat_result in results for event in repeat_result["phase_events"]]
+    return result
+
+
+def other_machine(baseline):
+    """The machine a baseline was written on, if it is not this one, else None."""
+    machine = baseline.get("machine")
+    return machine if machine is not None and machine != platform.node() else None
+
+
+def read_baseline(scene_data):
+    """Return the stored baseline of a scene, or None if there is none."""
+    try:
+        with open(baseline_path(scene_data), "r") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        return None
+    if baseline.get("version") != baseline_version:
+        raise ValueError(f"unsupported benchmark baseline version {baseline.get('version')}")
+    return baseline
+
+
+def write_baseline(scene_data, options, statistics):
+    path = baseline_path(scene_data)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    baseline = {
+        "version": baseline_version,
+        "steps": scene_data.steps,
+        "warmup": options.warmup,
+        "repeats": options.repeats,
+        "machine": platform.node(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "statistics": statistics,
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(baseline, f, indent=1)
+    os.replace(tmp_path, path)
+    return baseline
+
+
+def compare_with_baseline(statistics, baseline_statistics, options):
+    """Tell whether the step time regressed compared with the baseline.
+
+    Returns:
+        (bool, float): whether the scene regressed, and the relative change of
+        the median step time in percent.
+    """
+    current = statistics["median"]
+    reference = baseline_statistics["median"]
+    change = 100.0 * (current - reference) / reference if reference > 0 else 0.0
+
+    regressed = (change > options.threshold
+                 and (current - reference) * 1e6 > options.min_effect
+                 and min(statistics["repeat_medians"]) > max(baseline_statistics["repeat_medians"]))
+    return regressed, change
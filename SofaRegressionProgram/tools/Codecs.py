@@ -0,0 +1,223 @@
+"""
+Compression codecs of the reference files.
+
+A codec is given as "<name>[:<level>]", e.g. "gzip:6", "lzma", "bz2:9",
+"zstd:19" or "none". zstd is only available when the interpreter provides it
+(the compression.zstd module of Python >= 3.14, or the zstandard package).
+
+The codec of a file is not part of its name: the extension of its format is
+kept (e.g. ".json.gz"), and readers detect the codec from the magic number at
+the beginning of the file. Files starting with no known magic number are read
+as uncompressed.
+"""
+
+import io
+import gzip
+import bz2
+import lzma
+
+
+class Codec:
+    name = None
+    magic = None # first bytes of the compressed files
+    min_level = None # valid compression levels, None if the codec has none
+    max_level = None
+    default_level = None
+
+    def available(self):
+        return True
+
+    def open(self, file_path, mode, level = None):
+        """Open a compressed file in binary mode ("rb" or "wb")."""
+        raise NotImplementedError
+
+    def compress(self, data, level = None):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+
+class NoCodec(Codec):
+    name = "none"
+
+    def open(self, file_path, mode, level = None):
+        return open(file_path, mode)
+
+    def compress(self, data, level = None):
+        return bytes(data)
+
+    def decompress(self, data):
+        return bytes(data)
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    magic = b"\x1f\x8b"
+    min_level, max_level, default_level = 0, 9, 9
+
+    def open(self, file_path, mode, level = None):
+        if "r" in mode:
+            return gzip.open(file_path, mode)
+        return gzip.open(file_path, mode, compresslevel=self.default_level if level is None else level)
+
+    def compress(self, data, level = None):
+        return gzip.compress(data, compresslevel=self.default_level if level is None else level)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class Bz2Codec(Codec):
+    name = "bz2"
+    magic = b"BZh"
+    min_level, max_level, default_level = 1, 9, 9
+
+    def open(self, file_path, mode, level = None):
+        if "r" in mode:
+            return bz2.open(file_path, mode)
+        return bz2.open(file_path, mode, compresslevel=self.default_level if level is None else level)
+
+    def compress(self, data, level = None):
+        return bz2.compress(data, compresslevel=self.default_level if level is None else level)
+
+    def decompress(self, data):
+        return bz2.decompress(data)
+
+
+class LzmaCodec(Codec):
+    name = "lzma"
+    magic = b"\xfd7zXZ\x00"
+    min_level, max_level, default_level = 0, 9, 6
+
+    def open(self, file_path, mode, level = None):
+        if "r" in mode:
+            return lzma.open(file_path, mode)
+        return lzma.open(file_path, mode, preset=self.default_level if level is None else level)
+
+    def compress(self, data, level = None):
+        return lzma.compress(data, preset=self.default_level if level is None else level)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+def _import_zstd():
+    """Return ("stdlib" or "zstandard", module), or (None, None) if zstd is not available."""
+    try:
+        from compression import zstd
+        return "stdlib", zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return "zstandard", zstandard
+    except ImportError:
+        return None, None
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    magic = b"\x28\xb5\x2f\xfd"
+    min_level, max_level, default_level = 1, 22, 3
+
+    def __init__(self):
+        self.implementation, self.module = _import_zstd()
+
+    def available(self):
+        return self.module is not None
+
+    def _check_available(self):
+        if self.module is None:
+            raise ValueError("zstd is not provided by this Python interpreter "
+                             "(requires Python >= 3.14 or the zstandard package)")
+
+    def open(self, file_path, mode, level = None):
+        self._check_available()
+        level = self.default_level if level is None else level
+        if self.implementation == "stdlib":
+            return self.module.open(file_path, mode) if "r" in mode else self.module.open(file_path, mode, level=level)
+        if "r" in mode:
+            return self.module.open(file_path, mode)
+        return self.module.open(file_path, mode, cctx=self.module.ZstdCompressor(level=level))
+
+    def compress(self, data, level = None):
+        self._check_available()
+        level = self.default_level if level is None else level
+        if self.implementation == "stdlib":
+            return self.module.compress(data, level=level)
+        return self.module.ZstdCompressor(level=level).compress(data)
+
+    def decompress(self, data):
+        self._check_available()
+        if self.implementation == "stdlib":
+            return self.module.decompress(data)
+        return self.module.ZstdDecompressor().decompress(data)
+
+
+codecs = {codec.name: codec for codec in (NoCodec(), GzipCodec(), Bz2Codec(), LzmaCodec(), ZstdCodec())}
+
+# longest magic number of the codecs, read to detect the codec of a file
+_magic_size = max(len(codec.magic) for codec in codecs.values() if codec.magic is not None)
+
+
+def parse_codec(spec):
+    """Parse a "<name>[:<level>]" codec specification.
+
+    Returns:
+        (Codec, int): the codec and the compression level (None for the default one).
+    """
+    name, sep, level = spec.partition(":")
+    codec = codecs.get(name)
+    if codec is None:
+        raise ValueError(f"unknown codec '{name}', expecting one of {', '.join(codecs)}")
+    if not codec.available():
+        raise ValueError(f"codec '{name}' is not available in this Python interpreter")
+    if not sep:
+        return codec, None
+    if codec.min_level is None:
+        raise ValueError(f"codec '{name}' has no compression level")
+    try:
+        level = int(level)
+    except ValueError:
+        raise ValueError(f"invalid compression level '{level}' for codec '{name}'")
+    if not codec.min_level <= level <= codec.max_level:
+        raise ValueError(f"compression level of codec '{name}' must be in [{codec.min_level}, {codec.max_level}], got {level}")
+    return codec, level
+
+
+def detect_codec(data):
+    """Codec of a file from its first bytes (uncompressed if no magic number is known)."""
+    for codec in codecs.values():
+        if codec.magic is not None and data.startswith(codec.magic):
+            return codec
+    return codecs["none"]
+
+
+def detect_file_codec(file_path):
+    with open(file_path, "rb") as f:
+        return detect_codec(f.read(_magic_size))
+
+
+def open_file(file_path, mode, codec_spec = None, newline = None):
+    """Open a reference file through its codec.
+
+    Args:
+        file_path (str): the file.
+        mode (str): "rb", "wb", "rt" or "wt".
+        codec_spec (str): codec used to write. When reading, the codec is
+            detected from the file.
+        newline (str): newline argument of the text modes.
+
+    Returns:
+        a binary or text file object.
+    """
+    if "r" in mode:
+        codec, level = detect_file_codec(file_path), None
+    else:
+        codec, level = parse_codec(codec_spec or "none")
+
+    binary_file = codec.open(file_path, mode.replace("t", "").replace("b", "") + "b", level)
+    if "t" in mode:
+        return io.TextIOWrapper(binary_file, encoding="utf-8", newline=newline)
+    return binary_file
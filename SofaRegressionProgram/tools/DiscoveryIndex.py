@@ -0,0 +1,187 @@
+"""
+Persistent index of the .regression-tests files of an input folder.
+
+Finding the list files walks the whole input folder (usually the SOFA source
+tree), which is slow on network filesystems. The index keeps, for every
+directory, its modification time and what it contains (sub-directories and
+list files): a directory whose mtime did not change is not listed again, only
+stat'ed. The mtime of a directory changes when an entry is added, removed or
+renamed in it, not when a deeper directory changes: every known directory is
+still stat'ed, but only the changed ones are read. Directories are checked
+concurrently, level by level, to hide the latency of the filesystem.
+
+The index also keeps the parsed definition of each list file (see
+RegressionSceneList.parse_file()). It is reused while the list file and its
+options file, the directories of its scenes and of its reference folder,
+$REGRESSION_DIR and the regression program are unchanged.
+
+The paths of the list files are returned as os.walk() would give them from the
+input folder as it was given (relative or absolute), so that a run gives the
+same paths with or without the index.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import concurrent.futures
+
+import tools.ResultCache as ResultCache
+
+index_version = 1
+
+
+def default_index_path(input_folder):
+    """One index per input folder, in the user cache directory."""
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    folder_hash = hashlib.sha256(os.path.abspath(input_folder).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_home, "SofaRegressionProgram", f"discovery_index_{folder_hash}.json")
+
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class DiscoveryIndex:
+    def __init__(self, index_path, input_folder):
+        """Open (or create) the discovery index of an input folder.
+
+        Args:
+            index_path (str): JSON file of the index.
+            input_folder (str): folder searched for list files.
+        """
+        self.index_path = index_path
+        self.input_path = input_folder # as given: the returned paths start with it
+        self.input_folder = os.path.abspath(input_folder)
+        self.program = ResultCache.program_fingerprint()
+        self.directories = {} # absolute directory -> {"mtime_ns", "subdirs", "list_files"}
+        self.definitions = {} # absolute list file -> {"path", "mtime_ns", "size", "definition"}
+        self.nbr_listed_directories = 0 # directories read during the last find_list_files()
+        self.nbr_parsed_files = 0 # list files parsed, i.e. whose definition was not reused
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != index_version or data.get("input_folder") != self.input_folder:
+            return
+        self.directories = data.get("directories", {})
+        # definitions depend on the parsing code
+        if data.get("program") == self.program:
+            self.definitions = data.get("definitions", {})
+
+    def save(self):
+        with self.lock:
+            data = {"version": index_version, "input_folder": self.input_folder, "program": self.program,
+                    "directories": self.directories, "definitions": self.definitions}
+
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _scan_directory(self, directory, extension):
+        """Return the entry of a directory, listing it again only if its mtime changed."""
+        mtime_ns = _mtime_ns(directory)
+        entry = self.directories.get(directory)
+        if mtime_ns is None:
+            return None
+        if entry is not None and entry["mtime_ns"] == mtime_ns:
+            return entry
+
+        subdirs = []
+        list_files = []
+        try:
+            with os.scandir(directory) as entries:
+                for dir_entry in entries:
+                    if dir_entry.is_dir():
+                        # like os.walk: symbolic links to directories are not followed
+                        if not dir_entry.is_symlink():
+                            subdirs.append(dir_entry.name)
+                    elif dir_entry.name.endswith(extension):
+                        list_files.append(dir_entry.name)
+        except OSError:
+            return None
+        with self.lock:
+            self.nbr_listed_directories += 1
+        return {"mtime_ns": mtime_ns, "subdirs": sorted(subdirs), "list_files": sorted(list_files)}
+
+    def find_list_files(self, extension, nbr_threads = None):
+        """Return the paths of the list files of the input folder, sorted, as
+        os.walk() gives them from the input folder as given.
+
+        Args:
+            extension (str): extension of the list files.
+            nbr_threads (int): number of directories checked concurrently.
+        """
+        self.nbr_listed_directories = 0
+        directories = {}
+        list_files = []
+        level = [(self.input_folder, self.input_path)] # (absolute directory, directory as returned)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nbr_threads) as executor:
+            while level:
+                next_level = []
+                entries = executor.map(lambda d: self._scan_directory(d[0], extension), level)
+                for (directory, path), entry in zip(level, entries):
+                    if entry is None:
+                        continue
+                    directories[directory] = entry
+                    list_files.extend(os.path.join(path, file) for file in entry["list_files"])
+                    next_level.extend((os.path.join(directory, subdir), os.path.join(path, subdir))
+                                      for subdir in entry["subdirs"])
+                level = next_level
+
+        # directories which disappeared are forgotten
+        with self.lock:
+            self.directories = directories
+        return sorted(list_files)
+
+    def get_definition(self, list_file):
+        """Return the stored definition of a list file if it is still valid, else None."""
+        with self.lock:
+            entry = self.definitions.get(os.path.abspath(list_file))
+        # the paths of the definition start with the path of the list file it was parsed from
+        if entry is None or entry.get("path") != list_file:
+            return None
+        try:
+            stat = os.stat(list_file)
+        except OSError:
+            return None
+        if stat.st_mtime_ns != entry["mtime_ns"] or stat.st_size != entry["size"]:
+            return None
+
+        dependencies = entry["definition"]["dependencies"]
+        if dependencies["regression_dir"] != os.environ.get("REGRESSION_DIR"):
+            return None
+        for directory, mtime_ns in zip(dependencies["directories"], entry["directory_mtimes"]):
+            if _mtime_ns(directory) != mtime_ns:
+                return None
+        for file, mtime_ns in zip(dependencies["files"], entry["file_mtimes"]):
+            if _mtime_ns(file) != mtime_ns:
+                return None
+        return entry["definition"]
+
+    def set_definition(self, list_file, stat, definition):
+        """Store the definition of a list file, parsed when the file had the given os.stat()."""
+        entry = {"path": list_file, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "definition": definition,
+                 "directory_mtimes": [_mtime_ns(directory) for directory in definition["dependencies"]["directories"]],
+                 "file_mtimes": [_mtime_ns(file) for file in definition["dependencies"]["files"]]}
+        with self.lock:
+            self.definitions[os.path.abspath(list_file)] = entry
+            self.nbr_parsed_files += 1
+
+    def forget_missing_definitions(self, list_files):
+        """Drop the definitions of the list files which are not in the input folder anymore."""
+        kept = set(os.path.abspath(list_file) for list_file in list_files)
+        with self.lock:
+            self.definitions = {path: entry for path, entry in self.definitions.items() if path in kept}
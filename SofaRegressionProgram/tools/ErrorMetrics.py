@@ -0,0 +1,175 @@
+"""
+Error metrics of the comparison of a simulation with its references.
+
+All the MechanicalObjects of a scene are compared at once: the positions of a
+key frame are stacked in one contiguous buffer (and so are the references), and
+every metric is computed for all the MechanicalObjects in one vectorized pass
+over the buffers, reducing the segments of each object and of each point.
+
+Metrics, for each MechanicalObject:
+  * "error_by_dof": norm of the difference divided by the number of dofs (the
+    historical metric),
+  * "rms": root mean square of the difference,
+  * "max_abs": largest absolute difference of a dof,
+  * "max_point": largest distance between a point and its reference,
+  * "translation": largest translation error of a point: the distance between
+    the first 3 coordinates of the rigid frames (7 dofs per point), the
+    distance between the points of the other objects,
+  * "rotation": largest rotation error of a rigid frame in radians (angle
+    between its quaternion and the reference one), 0 for the other objects.
+
+The criterion of a scene (criterion=<metric> option of its line, "error_by_dof"
+by default) is the metric compared to its epsilon. Over the key frames,
+"error_by_dof" is summed, as it always was, and the other metrics keep their
+maximum.
+"""
+
+import numpy as np
+
+metric_names = ("error_by_dof", "rms", "max_abs", "max_point", "translation", "rotation")
+default_criterion = "error_by_dof"
+
+rigid_dof_per_point = 7 # 3 coordinates and a quaternion
+
+
+def parse_metrics(text):
+    """Parse a comma separated list of metric names.
+
+    Raises:
+        ValueError: if a metric is unknown.
+    """
+    metrics = [metric for metric in text.split(",") if metric]
+    for metric in metrics:
+        if metric not in metric_names:
+            raise ValueError(f"unknown metric '{metric}', expecting one of: {', '.join(metric_names)}")
+    return metrics
+
+
+def accumulate(metric, accumulated, frame_values):
+    """Accumulate the values of a metric at a key frame with the ones of the previous key frames."""
+    if metric == "error_by_dof":
+        return accumulated + frame_values
+    return np.maximum(accumulated, frame_values)
+
+
+class FrameComparator:
+    def __init__(self, shapes, metrics):
+        """Prepare the comparison of the key frames of a scene.
+
+        Args:
+            shapes (list): shape (num_points, dof_per_point) of the reference
+                positions of each MechanicalObject.
+            metrics (list): names of the metrics to compute. The norm of the
+                difference ("full_dist") is always computed.
+        """
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.metrics = list(dict.fromkeys(metrics))
+        nbr_points = [shape[0] if len(shape) > 1 else int(np.prod(shape)) for shape in self.shapes]
+        dof_per_point = [shape[1] if len(shape) > 1 else 1 for shape in self.shapes]
+        sizes = np.array([n * dof for n, dof in zip(nbr_points, dof_per_point)], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+
+        self.nbr_objects = len(self.shapes)
+        self.sizes = sizes.astype(np.float64)
+        # reduceat cannot reduce empty segments: objects without dofs keep a 0 error
+        self.nonempty = np.flatnonzero(sizes > 0)
+        self.object_starts = offsets[:-1][self.nonempty]
+
+        size = int(offsets[-1])
+        self.reference = np.empty(size)
+        self.current = np.empty(size)
+        self.difference = np.empty(size)
+        self.work = np.empty(size)
+
+        # start of each point in the buffers, and of the points of each object among them
+        self.point_starts = np.concatenate([offsets[i] + dof_per_point[i] * np.arange(nbr_points[i])
+                                            for i in self.nonempty]).astype(np.int64) if len(self.nonempty) else np.empty(0, np.int64)
+        self.object_point_starts = np.concatenate(([0], np.cumsum([nbr_points[i] for i in self.nonempty])[:-1])).astype(np.int64)
+
+        # rigid frames: coordinates which are translations, and the quaternion of each frame
+        rigid = [i for i in self.nonempty if dof_per_point[i] == rigid_dof_per_point]
+        self.translation_mask = None
+        self.quaternion_indices = None
+        if rigid:
+            self.translation_mask = np.ones(size)
+            quaternion_indices = []
+            for i in rigid:
+                starts = offsets[i] + rigid_dof_per_point * np.arange(nbr_points[i])
+                indices = starts[:, None] + np.arange(3, rigid_dof_per_point)
+                self.translation_mask[indices.ravel()] = 0.0
+                quaternion_indices.append(indices)
+            self.quaternion_indices = np.concatenate(quaternion_indices)
+            self.rigid_objects = np.array(rigid, dtype=np.int64)
+            self.rigid_starts = np.concatenate(([0], np.cumsum([nbr_points[i] for i in rigid])[:-1])).astype(np.int64)
+
+    def first_mismatch(self, positions):
+        """Return (index, reference shape, current shape) of the first MechanicalObject
+        whose positions do not have the shape of its references, or None."""
+        for meca_id, (position, shape) in enumerate(zip(positions, self.shapes)):
+            if np.shape(position) != shape:
+                return meca_id, shape, np.shape(position)
+        return None
+
+    def _by_object(self, reduced):
+        values = np.zeros(self.nbr_objects)
+        values[self.nonempty] = reduced
+        return values
+
+    def compare(self, references, positions):
+        """Compare the positions of a key frame with their references.
+
+        Args:
+            references (list): reference positions of each MechanicalObject,
+                or all of them already stacked in one flat array.
+            positions (list): current positions of each MechanicalObject, with
+                the shapes of their references (see first_mismatch()).
+
+        Returns:
+            dict: the value of "full_dist" and of each metric for each MechanicalObject.
+        """
+        values = {"full_dist": np.zeros(self.nbr_objects)}
+        values.update((metric, np.zeros(self.nbr_objects)) for metric in self.metrics)
+        if len(self.nonempty) == 0:
+            return values
+
+        if isinstance(references, np.ndarray) and references.ndim == 1:
+            reference = references
+        else:
+            reference = np.concatenate([np.ravel(array) for array in references], out=self.reference)
+        np.concatenate([np.ravel(array) for array in positions], out=self.current)
+        np.subtract(reference, self.current, out=self.difference)
+
+        np.square(self.difference, out=self.work)
+        squares = self._by_object(np.add.reduceat(self.work, self.object_starts))
+        values["full_dist"] = np.sqrt(squares)
+        sizes = np.maximum(self.sizes, 1.0)
+        if "error_by_dof" in values:
+            values["error_by_dof"] = values["full_dist"] / sizes
+        if "rms" in values:
+            values["rms"] = np.sqrt(squares / sizes)
+
+        if "max_point" in values or ("translation" in values and self.translation_mask is None):
+            point_squares = np.add.reduceat(self.work, self.point_starts)
+            max_point = self._by_object(np.sqrt(np.maximum.reduceat(point_squares, self.object_point_starts)))
+            values["max_point"] = max_point
+            values["translation"] = max_point
+        if "translation" in values and self.translation_mask is not None:
+            np.multiply(self.work, self.translation_mask, out=self.work)
+            point_squares = np.add.reduceat(self.work, self.point_starts)
+            values["translation"] = self._by_object(np.sqrt(np.maximum.reduceat(point_squares, self.object_point_starts)))
+
+        if "max_abs" in values:
+            np.abs(self.difference, out=self.work)
+            values["max_abs"] = self._by_object(np.maximum.reduceat(self.work, self.object_starts))
+
+        if "rotation" in values and self.quaternion_indices is not None:
+            reference_quaternions = reference[self.quaternion_indices]
+            current_quaternions = self.current[self.quaternion_indices]
+            dot = np.einsum("ij,ij->i", reference_quaternions, current_quaternions)
+            norms = np.linalg.norm(reference_quaternions, axis=1) * np.linalg.norm(current_quaternions, axis=1)
+            # q and -q are the same rotation
+            cosine = np.clip(np.abs(dot) / np.where(norms > 0.0, norms, 1.0), 0.0, 1.0)
+            angles = 2.0 * np.arccos(cosine)
+            values["rotation"][self.rigid_objects] = np.maximum.reduceat(angles, self.rigid_starts)
+
+        return {metric: values[metric] for metric in ["full_dist"] + self.metrics}
@@ -0,0 +1,122 @@
+"""
+Fields of a scene captured and compared besides the positions.
+
+A scene asks for other fields with a fields=<field>[:<tolerance>],... option
+in the options file of its list (e.g. fields=velocity:1e-3,topology, see
+RegressionSceneList.options_file_suffix). They are captured in the same
+simulation run as the positions, at the same key frames, written next to the
+position references as <ref>.reference_<field>_<i>_<name><extension>, and
+each one is compared with its own tolerance:
+  * "velocity", "force": the Data of each MechanicalObject, compared like the
+    positions (error by dof, summed over the key frames). The tolerance
+    defaults to the epsilon of the scene. They are stored in float32 with
+    --binary-precision float32, under the same rounding error guard as the positions.
+  * "topology": the number of points, edges, triangles, quads, tetrahedra and
+    hexahedra of each topology container, stored as int32 in BINARY
+    references. The tolerance is the largest difference of a count: 0 by
+    default, i.e. the counts must be the same (as TopologyRegression_test).
+"""
+
+import numpy as np
+
+import tools.ReferenceFileIO as reference_io
+
+
+class CapturedField:
+    name = None
+    metric = "error_by_dof" # compared with the tolerance, see ErrorMetrics
+    precision = None # storage precision of BINARY references, None for the one of the positions
+    default_tolerance = None # None: the epsilon of the scene
+
+    def sources(self, scene):
+        """The objects of a loaded scene whose field is captured."""
+        raise NotImplementedError
+
+    def source_name(self, source):
+        return source.name.value
+
+    def capture(self, source):
+        """The current value of the field of a source, as a (num_points, dof_per_point) array."""
+        raise NotImplementedError
+
+
+class MechanicalObjectField(CapturedField):
+    """A Data of the compared MechanicalObjects, with one value per dof."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def sources(self, scene):
+        return scene.meca_objs
+
+    def capture(self, source):
+        return np.asarray(getattr(source, self.name).value)
+
+
+class TopologyField(CapturedField):
+    name = "topology"
+    metric = "max_abs"
+    precision = "int32"
+    default_tolerance = 0.0
+    element_counts = ("getNbPoints", "getNbEdges", "getNbTriangles", "getNbQuads", "getNbTetrahedra", "getNbHexahedra")
+
+    def sources(self, scene):
+        # a node without topology container of its own sees the one of its parent
+        topologies = {}
+
+        def visit(node):
+            topology = node.getMeshTopology()
+            if topology is not None:
+                topologies.setdefault(topology.getPathName(), topology)
+            for child in node.children:
+                visit(child)
+
+        visit(scene.root_node)
+        return list(topologies.values())
+
+    def capture(self, source):
+        return np.array([[getattr(source, count)() for count in self.element_counts]], dtype=np.int32)
+
+
+fields = {field.name: field for field in (MechanicalObjectField("velocity"), MechanicalObjectField("force"),
+                                          TopologyField())}
+
+# the positions are always captured, they are not one of the fields
+positions = MechanicalObjectField("position")
+
+
+def parse_fields(spec):
+    """Parse a "<field>[:<tolerance>],..." specification.
+
+    Returns:
+        dict: the tolerance of each field, None for its default one.
+
+    Raises:
+        ValueError: if a field is unknown or a tolerance invalid.
+    """
+    parsed = {}
+    for item in spec.split(","):
+        if not item:
+            continue
+        name, sep, tolerance = item.partition(":")
+        if name not in fields:
+            raise ValueError(f"unknown field '{name}', expecting one of: {', '.join(fields)}")
+        parsed[name] = None
+        if sep:
+            try:
+                parsed[name] = float(tolerance)
+            except ValueError:
+                parsed[name] = -1.0
+            if parsed[name] < 0:
+                raise ValueError(f"the tolerance of field '{name}' must be a positive number, got '{tolerance}'")
+    return parsed
+
+
+def format_fields(captured_fields):
+    """The specification of parsed fields, see parse_fields()."""
+    return ",".join(name if tolerance is None else f"{name}:{tolerance!r}"
+                    for name, tolerance in captured_fields.items())
+
+
+def reference_path(file_ref_path, field_name, index, source_name, format):
+    return f"{file_ref_path}.reference_{field_name}_{index}_{source_name}{reference_io.reference_formats[format]}"
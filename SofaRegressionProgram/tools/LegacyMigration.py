@@ -0,0 +1,163 @@
+"""
+Conversion of legacy references to the current reference formats.
+
+Legacy references are the `<scene>.reference_<i>_<name>_mstate.txt.gz` files
+written by the WriteState component. They are rewritten as
+`<scene>.reference_mstate_<i>_<name><extension>` files, which compare mode
+reads without the slow compare_legacy_references() path.
+
+No SOFA is needed: the layout of the MechanicalObject (number of points and
+dof per point), which the current formats store, is inferred from the data:
+  * when the V= (velocity) lines are shorter than the X= (position) lines, the
+    positions are rigid frames with one more coordinate per point than the
+    velocities (Rigid3: 7 vs 6): num_points = len(X) - len(V),
+  * otherwise the dofs are assumed to be Vec3 if len(X) is a multiple of 3,
+    else Rigid3 (7), else Vec2, else Vec1.
+Vec3 and Rigid2 (or Vec1) layouts cannot be told apart from the data: the
+inferred layout can be overridden for some files. A wrong layout is detected
+by compare mode as a shape mismatch.
+
+Every converted file is read back and each frame (time and positions) is
+checked to be bit-exact with the legacy data. It is written next to its target
+first, and only replaces it once verified: a file which fails the verification
+is deleted, so that compare mode never reads it.
+"""
+
+import os
+import re
+import numpy as np
+
+import tools.ReferenceFileIO as reference_io
+import tools.Codecs as Codecs
+
+legacy_reference_pattern = re.compile(r"^(?P<scene>.*)\.reference_(?P<index>\d+)_(?P<name>.*)_mstate\.txt\.gz$")
+
+_first_velocity_line = re.compile(rb"^[ \t]*V=([^\n]*)", re.MULTILINE)
+
+
+def find_legacy_references(root_dir):
+    """Return the paths of all the legacy state references under a directory, sorted."""
+    paths = []
+    for root, dirs, files in os.walk(root_dir):
+        for file in files:
+            if legacy_reference_pattern.match(file):
+                paths.append(os.path.join(root, file))
+    return sorted(paths)
+
+
+def converted_path(legacy_path, format, input_dir = None, output_dir = None):
+    """Path of the converted reference of a legacy reference file.
+
+    Args:
+        legacy_path (str): the legacy reference.
+        format (str): target format, see ReferenceFileIO.reference_formats.
+        input_dir (str), output_dir (str): if given, the converted file is put
+            at the same relative path in output_dir as legacy_path in input_dir.
+    """
+    directory, file = os.path.split(legacy_path)
+    if output_dir is not None:
+        directory = os.path.join(output_dir, os.path.relpath(directory, input_dir))
+    match = legacy_reference_pattern.match(file)
+    return os.path.join(directory, f"{match['scene']}.reference_mstate_{match['index']}_{match['name']}"
+                                   + reference_io.reference_formats[format])
+
+
+def infer_layout(values_per_frame, velocity_size):
+    """Infer (num_points, dof_per_point) from the size of the X and V blocks.
+
+    Args:
+        values_per_frame (int): number of values of an X= block.
+        velocity_size (int): number of values of a V= block, None if there is none.
+
+    Returns:
+        (int, int, str): the number of points, the dof per point, and how the
+        layout was inferred.
+    """
+    if velocity_size is not None and 0 < velocity_size < values_per_frame:
+        num_points = values_per_frame - velocity_size
+        if values_per_frame % num_points == 0:
+            return num_points, values_per_frame // num_points, "rigid (positions longer than velocities)"
+
+    for dof_per_point in (3, 7, 2, 1):
+        if values_per_frame % dof_per_point == 0:
+            return values_per_frame // dof_per_point, dof_per_point, f"assumed {dof_per_point} dof per point"
+
+
+def convert_legacy_reference(legacy_path, target_path, format, dof_per_point = None, overwrite = False, codec = None,
+                             encoding = "raw"):
+    """Convert one legacy reference and verify the round trip.
+
+    Args:
+        legacy_path (str): the legacy reference to convert.
+        target_path (str): the reference to write.
+        format (str): target format, see ReferenceFileIO.reference_formats.
+        dof_per_point (int): layout to use instead of the inferred one.
+        overwrite (bool): convert even if target_path already exists.
+        codec (str): compression of the converted file, see Codecs. Defaults
+            to the default codec of the format.
+        encoding (str): encoding of BINARY references, see
+            ReferenceFileIO.binary_encodings (lossless).
+
+    Returns:
+        dict: the report of the conversion, whose "status" is "converted",
+        "skipped" (target exists), "mismatch" (the round trip is not exact) or
+        "error". target_path is only written when the status is "converted".
+    """
+    report = {"source": legacy_path, "target": target_path, "format": format}
+    if not overwrite and os.path.exists(target_path):
+        report["status"] = "skipped"
+        return report
+
+    unverified_path = target_path + ".unverified"
+    try:
+        with Codecs.open_file(legacy_path, "rb") as f:
+            data = f.read()
+        times, values = reference_io.parse_legacy_reference(data, legacy_path)
+        values_per_frame = values.shape[1]
+
+        if dof_per_point is not None:
+            if values_per_frame % dof_per_point != 0:
+                raise ValueError(f"{values_per_frame} values per frame is not a multiple of {dof_per_point} dof per point")
+            num_points, layout = values_per_frame // dof_per_point, "given"
+        else:
+            velocity = _first_velocity_line.search(data)
+            velocity_size = len(velocity.group(1).split()) if velocity is not None else None
+            num_points, dof_per_point, layout = infer_layout(values_per_frame, velocity_size)
+        report.update(num_points=num_points, dof_per_point=dof_per_point, layout=layout, nbr_frames=len(times))
+
+        frames = values.reshape((len(times), num_points, dof_per_point))
+        os.makedirs(os.path.dirname(target_path) or ".", exist_ok=True)
+        with reference_io.open_reference_writer(unverified_path, format, dof_per_point, num_points, codec, encoding,
+                                                expected_frames=len(times)) as writer:
+            for t, frame in zip(times, frames):
+                writer.write_frame(float(t), frame)
+
+        # read everything back: every frame must be bit-exact
+        nbr_checked = 0
+        mismatch = None
+        for frame_id, (t, frame) in enumerate(reference_io.iter_reference_frames(unverified_path, format)):
+            if (frame_id >= len(times) or float(t) != float(times[frame_id])
+                    or frame.shape != frames[frame_id].shape or not np.array_equal(frame, frames[frame_id])):
+                mismatch = frame_id
+                break
+            nbr_checked = nbr_checked + 1
+        if mismatch is None and nbr_checked != len(times):
+            mismatch = nbr_checked
+
+        report["nbr_verified_frames"] = nbr_checked
+        if mismatch is None:
+            os.replace(unverified_path, target_path)
+            report["status"] = "converted"
+        else:
+            report["status"] = "mismatch"
+            report["error"] = f"frame {mismatch} does not round-trip exactly"
+    except Exception as e:
+        report["status"] = "error"
+        report["error"] = str(e)
+    finally:
+        # an interrupted writer keeps its partial file
+        for path in (unverified_path, unverified_path + ".partial"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return report
@@ -0,0 +1,100 @@
+"""
+Phase-level timing of the scene runs.
+
+The worker times each phase of a scene: interpreter startup, SOFA import,
+scene load, initRoot, parse_node, reference decode, each animate() step, the
+comparison math and reference encode. The totals of each phase always come
+back in the worker result ("phases"); the individual events are only kept
+when a trace is requested, since there is one per step.
+
+The events of a whole run can be exported as a Chrome trace JSON, which can
+be opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing: one track
+per worker slot of the orchestrator, and one process per scene worker showing
+its phases.
+"""
+
+import json
+import time
+import contextlib
+
+
+class PhaseProfiler:
+    def __init__(self, record_events = False):
+        """
+        Args:
+            record_events (bool): keep every event, to build a trace. Otherwise
+                only the total time and count of each phase are kept.
+        """
+        self.record_events = record_events
+        self.totals = {} # phase name -> [total duration in ns, number of events]
+        self.events = [] # [phase name, start in ns since the epoch, duration in ns]
+
+    def add(self, name, start, duration):
+        """Record a phase which started at `start` (time.time_ns()) and lasted `duration` ns."""
+        total = self.totals.setdefault(name, [0, 0])
+        total[0] += duration
+        total[1] += 1
+        if self.record_events:
+            self.events.append([name, start, duration])
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time_ns()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time_ns() - start)
+
+    def summary(self):
+        """Total time and count of each phase: {name: {"time": ns, "count": n}}."""
+        return {name: {"time": total[0], "count": total[1]} for name, total in self.totals.items()}
+
+
+def merge_summaries(summaries):
+    """Sum the phase summaries of several scenes."""
+    merged = {}
+    for summary in summaries:
+        for name, total in summary.items():
+            entry = merged.setdefault(name, {"time": 0, "count": 0})
+            entry["time"] += total["time"]
+            entry["count"] += total["count"]
+    return merged
+
+
+def write_chrome_trace(trace_path, scene_results):
+    """Export the timings of a run as a Chrome trace.
+
+    Args:
+        trace_path (str): JSON file to write.
+        scene_results (list): (scene path, worker result) of each scene run.
+            Results without timings (cached, killed...) are skipped.
+    """
+    trace_events = []
+    slots = {} # orchestrator thread -> track index
+
+    for scene_path, result in scene_results:
+        if result is None or result.get("cached", False) or "launch_time" not in result:
+            continue
+
+        slot = slots.setdefault(result.get("launch_thread"), len(slots))
+        trace_events.append({"name": scene_path, "cat": "scene", "ph": "X", "pid": 0, "tid": slot,
+                             "ts": result["launch_time"] / 1e3, "dur": result["wall_time"] / 1e3,
+                             "args": {"ok": result.get("ok", False), "result": result.get("result"),
+                                      "killed": result.get("killed")}})
+
+        worker_pid = result.get("worker_pid")
+        if worker_pid is None:
+            continue
+        trace_events.append({"name": "process_name", "ph": "M", "pid": worker_pid,
+                             "args": {"name": f"{scene_path} (worker {worker_pid})"}})
+        for name, start, duration in result.get("phase_events", []):
+            trace_events.append({"name": name, "cat": "phase", "ph": "X", "pid": worker_pid, "tid": 0,
+                                 "ts": start / 1e3, "dur": duration / 1e3})
+
+    trace_events.append({"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "regression program"}})
+    for thread, slot in slots.items():
+        trace_events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": slot,
+                             "args": {"name": f"worker slot {slot}"}})
+
+    with open(trace_path, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
@@ -17,6 +17,10 @@ class ProgressBarHandler:
         if self.enable_progress_bar:
             self.tqdm_object.set_description(description)
 
+    def set_postfix(self, postfix):
+        if self.enable_progress_bar:
+            self.tqdm_object.set_postfix_str(postfix)
+
     def update(self, nb_step):
         if self.enable_progress_bar:
             self.tqdm_object.update(nb_step)
@@ -1,11 +1,63 @@
-import gzip
+import os
 import csv
 import json
+import itertools
+import re
+import shutil
+import struct
 from json import JSONEncoder
 import numpy as np
 
+import tools.Codecs as Codecs
+import tools.ErrorMetrics as ErrorMetrics
+
 regression_version = "1.0"
 
+# Supported values of the "format" argument, with their file extension
+reference_formats = {
+    "JSON": ".json.gz",
+    "CSV": ".csv.gz",
+    "BINARY": ".bin",
+}
+
+# Codec of each format when none is given, see Codecs. The extension does not
+# change with the codec: readers detect it from the file.
+default_codecs = {
+    "JSON": "gzip",
+    "CSV": "gzip",
+    "BINARY": "none",
+}
+
+# Binary format: magic, uint32 header size, JSON header padded so that the
+# float64 frame blocks start on an aligned offset (required by np.memmap views)
+binary_magic = b"SOFAREGB"
+binary_alignment = 64
+binary_dtype = "<f8"
+
+# Encodings of the binary frame blocks:
+#   raw: each frame as is (can be memory mapped),
+#   xor: the first frame as is, then the bits of each frame XORed with the bits
+#        of the previous one, and the bytes of each frame stored by planes
+#        (all the first bytes of the values, then all the second bytes...).
+#        Lossless; the residuals of correlated frames have long runs of zero
+#        bytes in their sign/exponent planes, which the codec compresses much
+#        better (and faster).
+binary_encodings = ("raw", "xor")
+
+# Storage precisions of the binary frames. float32 halves the size but rounds
+# the values: see BINARYReferenceWriter for the quantization guard. int32 is
+# for integer fields (e.g. the element counts of a topology, see FieldCapture).
+binary_precisions = {
+    "float64": "<f8",
+    "float32": "<f4",
+    "int32": "<i4",
+}
+_binary_bits_dtypes = {"<f8": "<u8", "<f4": "<u4", "<i4": "<u4"}
+
+# A float32 reference is only kept when its quantization error (accumulated
+# like the comparison error) stays below this fraction of the scene epsilon
+quantization_error_ratio = 1e-3
+
 class NumpyArrayEncoder(JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.ndarray):
@@ -16,67 +68,103 @@ class NumpyArrayEncoder(JSONEncoder):
 # --------------------------------------------------
 # Helper: read CSV + metadata
 # --------------------------------------------------
-def read_CSV_reference_file(file_path):
+def _read_CSV_metadata(f):
+    # Read the "# key=value" lines, leaving f on the first data row
     meta = {}
-    data_rows = []
+    while True:
+        pos = f.tell()
+        line = f.readline()
+        if not line:
+            break
 
-    with gzip.open(file_path, "rt") as f:
-        # Read metadata
-        while True:
-            pos = f.tell()
-            line = f.readline()
-            if not line:
-                break
+        if line.startswith("#"):
+            if "=" in line:
+                k, v = line[1:].strip().split("=", 1)
+                meta[k.strip()] = v.strip()
+        else:
+            f.seek(pos)
+            break
+    return meta
 
-            if line.startswith("#"):
-                if "=" in line:
-                    k, v = line[1:].strip().split("=", 1)
-                    meta[k.strip()] = v.strip()
-            else:
-                f.seek(pos)
-                break
+def _CSV_layout(meta):
+    dof_per_point = int(meta["dof_per_point"])
+    num_points = int(meta["num_points"])
+    return dof_per_point, num_points
 
-        reader = csv.reader(f)
-        for row in reader:
-            if row:
-                data_rows.append(row)
+def _parse_CSV_rows(lines, file_path, expected_size):
+    """Convert CSV data rows in bulk, with numpy's C parser.
 
-    return meta, data_rows
+    Returns:
+        (np.ndarray, np.ndarray): the time column, and the values as one
+        (rows, expected_size) array. Empty rows are skipped.
+    """
+    if not any(line.strip() for line in lines):
+        return np.zeros(0), np.zeros((0, expected_size))
+    try:
+        table = np.loadtxt(lines, delimiter=",", dtype=np.float64, ndmin=2, comments=None)
+    except ValueError as e:
+        # rows of different sizes, or a value which is not a number
+        for line in lines:
+            size = len(line.split(",")) - 1 if line.strip() else expected_size
+            if size != expected_size:
+                raise ValueError(f"Reference size mismatch in {file_path}: "
+                                 f"expected {expected_size}, got {size}")
+        raise ValueError(f"Invalid CSV reference {file_path}: {e}")
+    if table.shape[1] - 1 != expected_size:
+        raise ValueError(f"Reference size mismatch in {file_path}: "
+                         f"expected {expected_size}, got {table.shape[1] - 1}")
+    return table[:, 0], table[:, 1:]
+
+def read_CSV_reference_file(file_path):
+    """Read a whole CSV reference, parsing all its rows at once.
+
+    Returns:
+        (dict, np.ndarray, np.ndarray): the "# key=value" metadata, the time of
+        each frame and the positions as one (frames, num_points, dof_per_point) array.
+    """
+    with Codecs.open_file(file_path, "rt") as f:
+        meta = _read_CSV_metadata(f)
+        dof_per_point, num_points = _CSV_layout(meta)
+        times, values = _parse_CSV_rows(f.readlines(), file_path, num_points * dof_per_point)
+
+    return meta, times, values.reshape((len(times), num_points, dof_per_point))
 
 # --------------------------------------------------
 # Helper: write CSV + metadata
 # --------------------------------------------------
-def write_CSV_reference_file(file_path, dof_per_point, num_points, csv_rows):
-    with gzip.open(file_path, "wt", newline="") as f:
-        writer = csv.writer(f)
-        f.write(f"# format_version={regression_version}\n")
-        f.write(f"# dof_per_point={dof_per_point}\n")
-        f.write(f"# num_points={num_points}\n")
-
-        if dof_per_point == 2:
-            f.write("# layout=time,X0,Y1,...,Xn,Yn\n")
-        elif dof_per_point == 3:
-            f.write("# layout=time,X0,Y1,Z1,...,Xn,Yn,Zn\n")
-        elif dof_per_point == 7:
-            f.write("# layout=time,X0,Y1,Z1,Qx1,Qy1,Qz1,Qw1,...,Xn,Yn,Zn,QxN,QyN,QzN1,QwN\n")
-        else:
-            f.write("# layout=unknown\n")
+def _write_CSV_metadata(f, dof_per_point, num_points):
+    f.write(f"# format_version={regression_version}\n")
+    f.write(f"# dof_per_point={dof_per_point}\n")
+    f.write(f"# num_points={num_points}\n")
 
+    if dof_per_point == 2:
+        f.write("# layout=time,X0,Y1,...,Xn,Yn\n")
+    elif dof_per_point == 3:
+        f.write("# layout=time,X0,Y1,Z1,...,Xn,Yn,Zn\n")
+    elif dof_per_point == 7:
+        f.write("# layout=time,X0,Y1,Z1,Qx1,Qy1,Qz1,Qw1,...,Xn,Yn,Zn,QxN,QyN,QzN1,QwN\n")
+    else:
+        f.write("# layout=unknown\n")
+
+def write_CSV_reference_file(file_path, dof_per_point, num_points, csv_rows, codec = default_codecs["CSV"]):
+    with Codecs.open_file(file_path, "wt", codec, newline="") as f:
+        writer = csv.writer(f)
+        _write_CSV_metadata(f, dof_per_point, num_points)
         writer.writerows(csv_rows)
 
 
 # --------------------------------------------------
 # Helper: write numpy array to JSON
 # --------------------------------------------------
-def write_JSON_reference_file(file_path, numpy_data):
-    with gzip.open(file_path, 'wb') as write_file:
+def write_JSON_reference_file(file_path, numpy_data, codec = default_codecs["JSON"]):
+    with Codecs.open_file(file_path, 'wb', codec) as write_file:
         write_file.write(json.dumps(numpy_data, cls=NumpyArrayEncoder).encode('utf-8'))
 
 # --------------------------------------------------
 # Helper: read JSON and convert to numpy array
 # --------------------------------------------------
 def read_JSON_reference_file(file_path):
-    with gzip.open(file_path, 'r') as zipfile:
+    with Codecs.open_file(file_path, 'rb') as zipfile:
         decoded_array = json.loads(zipfile.read().decode('utf-8'))
 
         keyframes = []
@@ -86,54 +174,796 @@ def read_JSON_reference_file(file_path):
         return decoded_array, keyframes
 
 # --------------------------------------------------
-# Helper: read the legacy state reference format
+# Helper: write binary header + contiguous float64 frames
 # --------------------------------------------------
-def read_legacy_reference(filename, mechanical_object):
-    ref_data = []
-    times = []
-    values = []
+def write_BINARY_reference_file(file_path, dof_per_point, num_points, times, frames, codec = default_codecs["BINARY"],
+                                encoding = "raw", precision = "float64", max_quantization_error = None):
+    """Write frames as one header followed by contiguous frame blocks.
+
+    Args:
+        file_path (str): output file.
+        dof_per_point (int): number of values per point (3 for Vec3, 7 for Rigid3...).
+        num_points (int): number of points of the MechanicalObject.
+        times (list): time of each frame.
+        frames (list): one (num_points, dof_per_point) array per frame.
+        codec (str): compression of the file, see Codecs. Only uncompressed
+            raw files can be memory mapped when read.
+        encoding (str), precision (str), max_quantization_error (float): see
+            BINARYReferenceWriter.
+    """
+    with BINARYReferenceWriter(file_path, dof_per_point, num_points, codec, encoding, precision,
+                               max_quantization_error, expected_frames=len(times)) as writer:
+        for t, frame in zip(times, frames):
+            writer.write_frame(t, frame)
+
+
+def _BINARY_header_bytes(dof_per_point, num_points, times, dtype = binary_dtype, encoding = "raw", extra = None,
+                         min_size = 0):
+    """Magic, header size and header of a binary reference, padded to the
+    alignment of the frames, and to min_size bytes if it is shorter (and aligned)."""
+    header = {
+        "format_version": regression_version,
+        "dof_per_point": int(dof_per_point),
+        "num_points": int(num_points),
+        "nbr_frames": len(times),
+        "dtype": dtype,
+        "times": [float(t) for t in times],
+    }
+    if encoding != "raw":
+        header["encoding"] = encoding
+    if extra is not None:
+        header.update(extra)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_offset = len(binary_magic) + 4 + len(header_bytes)
+    header_bytes += b" " * max(min_size - data_offset, -data_offset % binary_alignment)
+    return binary_magic + struct.pack("<I", len(header_bytes)) + header_bytes
+
+
+def _reserved_BINARY_header_size(dof_per_point, num_points, nbr_frames):
+    """Size of the largest raw float64 header of nbr_frames frames: the one of
+    times whose representation is the longest a float can have."""
+    return len(_BINARY_header_bytes(dof_per_point, num_points, [-2.2250738585072014e-308] * nbr_frames))
+
+
+def parse_BINARY_header(buffer):
+    """Decode the header of a binary reference.
+
+    Args:
+        buffer (bytes): the beginning of the file (at least the whole header).
+
+    Returns:
+        (dict, int): the header and the offset of the first frame block.
+    """
+    prefix_size = len(binary_magic) + 4
+    if bytes(buffer[:len(binary_magic)]) != binary_magic:
+        raise ValueError("Not a binary regression reference (bad magic)")
+    (header_size,) = struct.unpack("<I", bytes(buffer[len(binary_magic):prefix_size]))
+    header = json.loads(bytes(buffer[prefix_size:prefix_size + header_size]).decode("utf-8"))
+    for key in ("dof_per_point", "num_points", "nbr_frames", "times"):
+        if key not in header:
+            raise KeyError(key)
+    # files written before the encodings only have raw float64 frames
+    header.setdefault("dtype", binary_dtype)
+    header.setdefault("encoding", "raw")
+    if header["dtype"] not in _binary_bits_dtypes:
+        raise ValueError(f"Unsupported binary reference dtype: {header['dtype']}")
+    if header["encoding"] not in binary_encodings:
+        raise ValueError(f"Unsupported binary reference encoding: {header['encoding']}")
+    return header, prefix_size + header_size
+
+
+def _binary_values_shape(header, data_size, file_path):
+    shape = (int(header["nbr_frames"]), int(header["num_points"]), int(header["dof_per_point"]))
+    expected_size = shape[0] * shape[1] * shape[2] * np.dtype(header["dtype"]).itemsize
+    if data_size < expected_size:
+        raise ValueError(f"Binary reference truncated in {file_path}: "
+                         f"expected {expected_size} bytes of frames, got {data_size}")
+    return shape
+
+
+def _read_exactly(f, size):
+    """Read size bytes from a (decompressing) stream, which may return less per read(), or less at its end."""
+    chunks = []
+    while size > 0:
+        chunk = f.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _read_BINARY_header(f, file_path):
+    """Read the header of a binary reference from the start of a stream.
+
+    Returns:
+        (dict, int): the header and the offset of the first frame block.
+    """
+    prefix = _read_exactly(f, len(binary_magic) + 4)
+    if len(prefix) < len(binary_magic) + 4:
+        raise ValueError(f"Binary reference truncated in {file_path}")
+    header_size = struct.unpack("<I", prefix[len(binary_magic):])[0]
+    return parse_BINARY_header(prefix + _read_exactly(f, header_size))
+
+# --------------------------------------------------
+# Helper: read binary reference as a memory map
+# --------------------------------------------------
+def read_BINARY_reference_file(file_path, use_mmap=True):
+    """Read a binary reference without decoding the frames.
+
+    Args:
+        file_path (str): reference file.
+        use_mmap (bool): map the file with np.memmap (frames are paged in on
+            access). Otherwise, or if the file is compressed, the file is read
+            (and decompressed) once and viewed with a zero-copy np.frombuffer.
+            XOR encoded frames are always decoded in memory.
+
+    Returns:
+        (dict, np.ndarray, np.ndarray): the header, the times of the frames and
+        a read-only (nbr_frames, num_points, dof_per_point) array, of the
+        header "dtype" (float64, float32 for reduced precision references, or
+        int32 for integer fields).
+    """
+    if not use_mmap or Codecs.detect_file_codec(file_path).name != "none":
+        with Codecs.open_file(file_path, "rb") as f:
+            return read_BINARY_reference_buffer(f.read(), file_path)
+
+    with open(file_path, "rb") as f:
+        header, data_offset = _read_BINARY_header(f, file_path)
+        data_size = f.seek(0, 2) - data_offset
+
+    shape = _binary_values_shape(header, data_size, file_path)
+    times = np.asarray(header["times"], dtype=np.float64)
+    if shape[0] * shape[1] * shape[2] == 0:
+        return header, times, np.empty(shape, dtype=header["dtype"])
+    values = np.memmap(file_path, dtype=header["dtype"], mode="r", offset=data_offset, shape=shape)
+    if header["encoding"] == "xor":
+        values = _decode_xor_frames(values, header["dtype"])
+    return header, times, values
+
+
+def read_BINARY_reference_buffer(buffer, file_path="<buffer>"):
+    """Same as read_BINARY_reference_file() on an in-memory file content.
+    Raw frames are a zero-copy np.frombuffer view of the buffer."""
+    header, data_offset = parse_BINARY_header(buffer)
+    shape = _binary_values_shape(header, len(buffer) - data_offset, file_path)
+    times = np.asarray(header["times"], dtype=np.float64)
+    values = np.frombuffer(buffer, dtype=header["dtype"], count=shape[0] * shape[1] * shape[2],
+                           offset=data_offset).reshape(shape)
+    if header["encoding"] == "xor":
+        values = _decode_xor_frames(values, header["dtype"])
+    return header, times, values
+
+
+def _decode_xor_frames(values, dtype):
+    # gather the byte planes of each frame, then frame k is the XOR of the
+    # residuals 0..k: one vectorized prefix scan
+    shape = values.shape
+    itemsize = np.dtype(dtype).itemsize
+    planes = np.asarray(values).view(np.uint8).reshape(shape[0], itemsize, -1)
+    residuals = np.ascontiguousarray(planes.transpose(0, 2, 1)).view(_binary_bits_dtypes[dtype])
+    bits = np.bitwise_xor.accumulate(residuals.reshape(shape[0], -1), axis=0)
+    decoded = bits.view(dtype).reshape(shape)
+    decoded.flags.writeable = False
+    return decoded
+
+# --------------------------------------------------
+# Time index: sorted frame times, matched to the simulation steps
+# --------------------------------------------------
+def match_frame_steps(frame_times, step_times, previous_step = -1):
+    """Find the simulation step at which each reference frame is compared.
+
+    Frames are consumed in order: frame k is compared at the first step after
+    the step of frame k-1 whose time is np.isclose() to the frame time. A
+    frame with no such step stops the matching, as the frames after it are
+    never reached. All frames are matched at once with a binary search.
+
+    Args:
+        frame_times (array): times of the frames, in file order.
+        step_times (np.ndarray): sorted time of each step (dt * step).
+        previous_step (int): step of the frame preceding frame_times[0], if any.
+
+    Returns:
+        np.ndarray: the step of each frame, -1 for the frames that are never compared.
+    """
+    frame_times = np.asarray(frame_times, dtype=np.float64).reshape(-1)
+    tolerance = 1e-8 + 1e-5 * np.abs(frame_times) # default tolerance of np.isclose(simu_time, frame_time)
+    first = np.searchsorted(step_times, frame_times - tolerance, side="left")
+    order = np.arange(len(frame_times))
+    # step_k = max(first_k, step_(k-1) + 1), as a running maximum
+    steps = np.maximum.accumulate(np.maximum(first - order, previous_step + 1)) + order
+    valid = steps < len(step_times)
+    valid[valid] = step_times[steps[valid]] <= frame_times[valid] + tolerance[valid]
+    valid = np.logical_and.accumulate(valid)
+    return np.where(valid, steps, -1)
+
+
+class ReferenceTimeIndex:
+    """Sorted float64 times of the frames of a reference.
+
+    Frames are identified by their integer index (their offset in the frame
+    arrays of the readers): matching is done once, on the time values, and
+    never through str(time) keys.
+
+    Some legacy references hold several frames at the same time. Only the
+    last one of them is matched, as it is the state the simulation reached.
+    """
+
+    def __init__(self, times):
+        self.times = np.asarray(times, dtype=np.float64).reshape(-1)
+        if np.any(np.diff(self.times) < 0):
+            raise ValueError("Reference frame times are not increasing")
+
+    def __len__(self):
+        return len(self.times)
+
+    def find(self, t):
+        """Index of the (last) frame at time t (within the np.isclose tolerance), or -1."""
+        index = int(np.searchsorted(self.times, t, side="right"))
+        for candidate in (index - 1, index):
+            if 0 <= candidate < len(self.times) and np.isclose(t, self.times[candidate]):
+                return candidate
+        return -1
+
+    def step_frames(self, dt, steps):
+        """For each step 0..steps, the index of the frame compared at this step, or -1."""
+        step_times = dt * np.arange(steps + 1, dtype=np.float64)
+        # the last frame of each time
+        frames = np.flatnonzero(np.diff(self.times, append=np.inf) > 0)
+        frame_steps = match_frame_steps(self.times[frames], step_times)
+        step_frames = np.full(steps + 1, -1, dtype=np.int64)
+        matched = frame_steps >= 0
+        step_frames[frame_steps[matched]] = frames[matched]
+        return step_frames
+
+
+def read_indexed_reference(file_path, format):
+    """Read a whole reference for random access to its frames.
+
+    Returns:
+        (ReferenceTimeIndex, np.ndarray): the time index and the
+        (nbr_frames, num_points, dof_per_point) values, frame i being values[i].
+        BINARY references are memory mapped, not read.
+    """
+    if format == "CSV":
+        meta, times, values = read_CSV_reference_file(file_path)
+    elif format == "JSON":
+        data, times = read_JSON_reference_file(file_path)
+        values = np.asarray(list(data.values()), dtype=np.float64)
+        if len(times) > 0 and values.ndim != 3:
+            raise ValueError(f"Reference frames of {file_path} do not all have the same shape")
+        times = np.asarray(times, dtype=np.float64)
+        # keys are written in time order, but a JSON object is unordered
+        order = np.argsort(times, kind="stable")
+        if np.any(order != np.arange(len(order))):
+            times, values = times[order], values[order]
+    elif format == "BINARY":
+        header, times, values = read_BINARY_reference_file(file_path)
+    else:
+        raise ValueError(f"Unsupported format: {format}")
+    return ReferenceTimeIndex(times), values
+
+# --------------------------------------------------
+# Streaming readers: one frame at a time, in time order
+# --------------------------------------------------
+def iter_reference_frames(file_path, format):
+    """Lazily read a reference file frame by frame.
+
+    Only the frame being yielded (plus a read buffer of a few MB) is kept in memory,
+    whatever the number of frames of the file.
+
+    Args:
+        file_path (str): reference file.
+        format (str): one of reference_formats.
+
+    Yields:
+        (float, np.ndarray): the time of the frame and its
+        (num_points, dof_per_point) values, in time order.
+    """
+    if format == "CSV":
+        return iter_CSV_reference_frames(file_path)
+    elif format == "JSON":
+        return iter_JSON_reference_frames(file_path)
+    elif format == "BINARY":
+        return iter_BINARY_reference_frames(file_path)
+    raise ValueError(f"Unsupported format: {format}")
+
 
-    # Infer layout from MechanicalObject
-    n_points, dof_per_point = mechanical_object.position.value.shape
-    expected_size = n_points * dof_per_point
+def iter_CSV_reference_frames(file_path, batch_size=1 << 23):
+    # Rows are parsed in bulk by batches of about batch_size characters, so
+    # that memory stays bounded without converting each row separately
+    with Codecs.open_file(file_path, "rt") as f:
+        meta = _read_CSV_metadata(f)
+        dof_per_point, n_points = _CSV_layout(meta)
+        expected_size = n_points * dof_per_point
+        rows_per_batch = max(1, batch_size // (20 * (expected_size + 1)))
 
+        while True:
+            lines = list(itertools.islice(f, rows_per_batch))
+            if not lines:
+                break
+            times, values = _parse_CSV_rows(lines, file_path, expected_size)
+            for t, flat in zip(times, values):
+                yield float(t), flat.reshape((n_points, dof_per_point))
+
+
+class _JSONStreamReader:
+    """Decode the values of a JSON text one by one from a file object,
+    without reading the whole text."""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, min_size=0):
+        chunk = self.f.read(max(self.chunk_size, min_size))
+        if not chunk:
+            self.eof = True
+            return
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def _skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return
+            self._fill()
+
+    def next_char(self):
+        self._skip_whitespace()
+        if self.pos >= len(self.buffer):
+            raise ValueError("Unexpected end of JSON reference")
+        c = self.buffer[self.pos]
+        self.pos += 1
+        return c
+
+    def peek_char(self):
+        self._skip_whitespace()
+        return self.buffer[self.pos] if self.pos < len(self.buffer) else ""
+
+    def decode(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a value ending with the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise ValueError(f"Invalid JSON reference: {e}")
+            # grow geometrically so a large frame is not parsed again and again
+            self._fill(len(self.buffer) - self.pos)
+
+
+def iter_JSON_reference_frames(file_path, chunk_size=1 << 20):
+    with Codecs.open_file(file_path, "rt") as f:
+        reader = _JSONStreamReader(f, chunk_size)
+        if reader.next_char() != "{":
+            raise ValueError(f"Invalid JSON reference {file_path}: expecting an object")
+        if reader.peek_char() == "}":
+            return
+
+        while True:
+            key = reader.decode()
+            if reader.next_char() != ":":
+                raise ValueError(f"Invalid JSON reference {file_path}: expecting ':'")
+            value = reader.decode()
+            yield float(key), np.asarray(value, dtype=float)
+
+            separator = reader.next_char()
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"Invalid JSON reference {file_path}: expecting ',' or '}}'")
+
+
+def iter_BINARY_reference_frames(file_path):
+    # uncompressed raw frames are views on the memory map: they are only paged in when used
+    if Codecs.detect_file_codec(file_path).name == "none":
+        with open(file_path, "rb") as f:
+            header, data_offset = _read_BINARY_header(f, file_path)
+        if header["encoding"] == "raw":
+            meta, times, values = read_BINARY_reference_file(file_path)
+            for frame_id in range(len(times)):
+                yield float(times[frame_id]), values[frame_id]
+            return
+
+    # compressed or XOR encoded frames are decompressed and decoded by batches
+    # of about 8 MB, as BINARYReferenceWriter encodes them: the XOR decoding
+    # carries the bits of the last frame of the previous batch
+    with Codecs.open_file(file_path, "rb") as f:
+        header, data_offset = _read_BINARY_header(f, file_path)
+        times = np.asarray(header["times"], dtype=np.float64)
+        nbr_frames, num_points, dof_per_point = (int(header["nbr_frames"]), int(header["num_points"]),
+                                                 int(header["dof_per_point"]))
+        dtype = np.dtype(header["dtype"])
+        bits_dtype = _binary_bits_dtypes[header["dtype"]]
+        frame_size = num_points * dof_per_point
+        batch_frames = max(1, (1 << 20) // max(1, frame_size))
+        previous = None
+        for first_frame in range(0, nbr_frames, batch_frames):
+            count = min(batch_frames, nbr_frames - first_frame)
+            data = _read_exactly(f, count * frame_size * dtype.itemsize)
+            if len(data) < count * frame_size * dtype.itemsize:
+                raise ValueError(f"Binary reference truncated in {file_path}: expected {nbr_frames} frames")
+            if header["encoding"] == "xor":
+                planes = np.frombuffer(data, dtype=np.uint8).reshape(count, dtype.itemsize, frame_size)
+                residuals = np.ascontiguousarray(planes.transpose(0, 2, 1)).view(bits_dtype).reshape(count, frame_size)
+                if previous is not None:
+                    residuals[0] ^= previous
+                bits = np.bitwise_xor.accumulate(residuals, axis=0)
+                previous = bits[-1].copy()
+                values = bits.view(dtype).reshape(count, num_points, dof_per_point)
+                values.flags.writeable = False
+            else:
+                values = np.frombuffer(data, dtype=dtype).reshape(count, num_points, dof_per_point)
+            for frame_id in range(count):
+                yield float(times[first_frame + frame_id]), values[frame_id]
+
+# --------------------------------------------------
+# Streaming writers: one frame at a time, as captured
+# --------------------------------------------------
+class ReferenceWriter:
+    """Incremental reference writer.
+
+    Each frame is appended to the (compressed) output as soon as it is given,
+    so memory does not grow with the number of steps. Frames are written to
+    `<file_path>.partial`, which is renamed to `file_path` by close() once the
+    header or index has been finalized: an interrupted write never leaves a
+    truncated file that could be taken for a valid reference, while the frames
+    written so far are kept in the partial file.
+
+    The resulting files have the same content as the ones produced by the
+    write_*_reference_file() helpers.
+    """
+
+    def __init__(self, file_path, dof_per_point, num_points, codec):
+        self.file_path = str(file_path)
+        self.codec = codec
+        self.partial_path = self.file_path + ".partial"
+        self.dof_per_point = int(dof_per_point)
+        self.num_points = int(num_points)
+        self.nbr_frames = 0
+        self.closed = False
+
+    # whether every frame must have num_points * dof_per_point values
+    fixed_frame_size = True
+
+    def write_frame(self, t, positions):
+        frame = np.asarray(positions)
+        if self.fixed_frame_size and frame.size != self.num_points * self.dof_per_point:
+            raise ValueError(f"Frame size mismatch while writing {self.file_path}: "
+                             f"expected {self.num_points * self.dof_per_point}, got {frame.size}")
+        self._write_frame(t, frame)
+        self.nbr_frames += 1
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._finalize()
+        os.replace(self.partial_path, self.file_path)
+
+    def abort(self):
+        """Stop writing without producing the reference file (the partial file is kept)."""
+        if self.closed:
+            return
+        self.closed = True
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CSVReferenceWriter(ReferenceWriter):
+    def __init__(self, file_path, dof_per_point, num_points, codec = default_codecs["CSV"]):
+        super().__init__(file_path, dof_per_point, num_points, codec)
+        self._stream = Codecs.open_file(self.partial_path, "wt", codec, newline="")
+        self._writer = csv.writer(self._stream)
+        _write_CSV_metadata(self._stream, self.dof_per_point, self.num_points)
+
+    def _write_frame(self, t, frame):
+        row = [t]
+        row.extend(frame.reshape(-1).tolist())  # flatten vec3d
+        self._writer.writerow(row)
 
-    with gzip.open(filename, "rt") as f:
-        for line in f:
-            line = line.strip()
+    def _finalize(self):
+        self._stream.close()
 
-            if not line:
-                continue
 
-            # Time marker
-            if line.startswith("T="):
-                current_time = float(line.split("=", 1)[1])
-                times.append(current_time)
-         
-            # Positions
-            elif line.startswith("X="):
-                if current_time is None:
-                    raise RuntimeError(f"X found before T in {filename}")
+class JSONReferenceWriter(ReferenceWriter):
+    # each JSON frame carries its own shape
+    fixed_frame_size = False
 
-                raw = line.split("=", 1)[1].strip().split()
-                flat = np.asarray(raw, dtype=float)
+    def __init__(self, file_path, dof_per_point, num_points, codec = default_codecs["JSON"]):
+        super().__init__(file_path, dof_per_point, num_points, codec)
+        self._stream = Codecs.open_file(self.partial_path, "wb", codec)
+        self._stream.write(b"{")
 
-                if flat.size != expected_size:
-                    raise ValueError(
-                        f"Legacy reference size mismatch in {filename}: "
-                        f"expected {expected_size}, got {flat.size}\n"
-                    )
+    def _write_frame(self, t, frame):
+        # encode the entry as json.dumps() encodes it inside the whole dict
+        entry = json.dumps({t: frame}, cls=NumpyArrayEncoder)[1:-1]
+        if self.nbr_frames > 0:
+            entry = ", " + entry
+        self._stream.write(entry.encode("utf-8"))
 
-                values.append(flat.reshape((n_points, dof_per_point)))
+    def _finalize(self):
+        self._stream.write(b"}")
+        self._stream.close()
 
-            # Velocity (ignored)
-            elif line.startswith("V="):
-                continue
 
-    if len(times) != len(values):
+class BINARYReferenceWriter(ReferenceWriter):
+    """Incremental writer of binary references.
+
+    Args:
+        encoding (str): encoding of the frame blocks, see binary_encodings.
+        precision (str): storage precision, see binary_precisions. The frames
+            of the int32 precision must hold integers.
+        max_quantization_error (float): with the float32 precision, the
+            reference is only stored in float32 if the rounding error stays
+            below this bound for each of the quantization_metrics, measured
+            and accumulated over the frames as the comparison does (see
+            ErrorMetrics). Otherwise it is stored in float64. None: no bound.
+        quantization_metrics (list): metrics of the rounding error bounded by
+            max_quantization_error, error_by_dof by default. The criterion of
+            the scene must be one of them: e.g. the error by dof of a large
+            mesh shrinks with its size while its max_abs error does not.
+        expected_frames (int): number of frames which will be written, if
+            known. Uncompressed raw float64 references then reserve the room
+            of their header in front of the frames, and are finalized in
+            place instead of being written a second time after the header.
+    """
+
+    def __init__(self, file_path, dof_per_point, num_points, codec = default_codecs["BINARY"],
+                 encoding = "raw", precision = "float64", max_quantization_error = None, expected_frames = None,
+                 quantization_metrics = None):
+        super().__init__(file_path, dof_per_point, num_points, codec)
+        if encoding not in binary_encodings:
+            raise ValueError(f"Unsupported binary encoding: {encoding}")
+        if precision not in binary_precisions:
+            raise ValueError(f"Unsupported binary precision: {precision}")
+        self.encoding = encoding
+        self.precision = precision
+        self.max_quantization_error = max_quantization_error
+        metrics = quantization_metrics or [ErrorMetrics.default_criterion]
+        self.quantization_errors = {metric: 0.0 for metric in metrics} # accumulated rounding error of each metric
+        self._quantization_comparator = None
+        if precision == "float32":
+            self._quantization_comparator = ErrorMetrics.FrameComparator([(self.num_points, self.dof_per_point)], metrics)
+        self.dtype = binary_dtype # dtype of the stored frames, decided by close()
+        self.times = []
+        self._stream = open(self.partial_path, "wb")
+        # room left for the header in front of the frames, 0 if they are written again by close()
+        self._reserved_size = 0
+        if (expected_frames is not None and precision == "float64" and encoding == "raw"
+                and Codecs.parse_codec(codec or "none")[0].name == "none"):
+            self._reserved_size = _reserved_BINARY_header_size(self.dof_per_point, self.num_points, expected_frames)
+            self._stream.write(b" " * self._reserved_size)
+
+    def _write_frame(self, t, frame):
+        self.times.append(float(t))
+        block = np.ascontiguousarray(frame, dtype=binary_dtype)
+        if self._quantization_comparator is not None and block.size > 0:
+            rounded = block.astype(binary_precisions["float32"]).astype(binary_dtype)
+            frame_values = self._quantization_comparator.compare([block], [rounded])
+            for metric, value in self.quantization_errors.items():
+                self.quantization_errors[metric] = float(ErrorMetrics.accumulate(metric, value, frame_values[metric][0]))
+        self._stream.write(block.tobytes())
+
+    @property
+    def quantization_error(self):
+        """The largest accumulated rounding error of the quantization metrics."""
+        return max(self.quantization_errors.values())
+
+    def _finalize(self):
+        # The header holds the frame times: it can only be written once all
+        # frames are known, in front of the frame blocks. The frames are kept
+        # uncompressed and in float64 until then: the precision is chosen, the
+        # frames encoded and the whole file compressed here. Raw float64 files
+        # whose header fits in its reserved room are only completed in place.
+        self._stream.close()
+        extra = None
+        if self.precision == "float32":
+            if self.max_quantization_error is None or self.quantization_error <= self.max_quantization_error:
+                self.dtype = binary_precisions["float32"]
+            extra = {"quantization_error": self.quantization_error, "quantization_errors": self.quantization_errors}
+        elif self.precision == "int32":
+            self.dtype = binary_precisions["int32"]
+
+        if self._reserved_size:
+            header = _BINARY_header_bytes(self.dof_per_point, self.num_points, self.times,
+                                          min_size=self._reserved_size)
+            if len(header) == self._reserved_size:
+                with open(self.partial_path, "r+b") as f:
+                    f.write(header)
+                return
+
+        frames_path = self.partial_path + ".frames"
+        os.replace(self.partial_path, frames_path)
+        try:
+            with Codecs.open_file(self.partial_path, "wb", self.codec) as f, open(frames_path, "rb") as frames:
+                frames.seek(self._reserved_size)
+                f.write(_BINARY_header_bytes(self.dof_per_point, self.num_points, self.times,
+                                             self.dtype, self.encoding, extra))
+                if self.dtype == binary_dtype and self.encoding == "raw":
+                    shutil.copyfileobj(frames, f)
+                else:
+                    self._write_encoded_frames(frames, f)
+        finally:
+            os.remove(frames_path)
+
+    def _write_encoded_frames(self, frames, f):
+        frame_size = self.num_points * self.dof_per_point
+        bits_dtype = _binary_bits_dtypes[self.dtype]
+        # frames are converted by batches of about 8 MB
+        batch_frames = max(1, (1 << 20) // max(1, frame_size))
+        previous = None
+        while True:
+            batch = np.fromfile(frames, dtype=binary_dtype, count=batch_frames * frame_size)
+            if batch.size == 0:
+                break
+            bits = batch.reshape(-1, frame_size).astype(self.dtype).view(bits_dtype)
+            if self.encoding == "xor":
+                residuals = np.empty_like(bits)
+                residuals[0] = bits[0] if previous is None else bits[0] ^ previous
+                np.bitwise_xor(bits[1:], bits[:-1], out=residuals[1:])
+                previous = bits[-1].copy()
+                bits = residuals.view(np.uint8).reshape(len(bits), frame_size, -1).transpose(0, 2, 1)
+            f.write(np.ascontiguousarray(bits).tobytes())
+
+    @property
+    def precision_fallback(self):
+        """Whether float32 was requested but the frames were kept in float64."""
+        return self.precision == "float32" and self.dtype == binary_dtype
+
+
+def open_reference_writer(file_path, format, dof_per_point, num_points, codec = None,
+                          encoding = "raw", precision = "float64", max_quantization_error = None,
+                          expected_frames = None, quantization_metrics = None):
+    """Create the incremental ReferenceWriter of the given format.
+
+    Args:
+        codec (str): compression of the file, see Codecs. Defaults to the
+            default_codecs of the format, or to gzip:6 for XOR encoded binary
+            references (the residuals are only smaller once compressed).
+        encoding (str), precision (str), max_quantization_error (float): see
+            BINARYReferenceWriter. Only the BINARY format supports other
+            values than "raw" and "float64".
+        expected_frames (int): number of frames which will be written, if
+            known, see BINARYReferenceWriter.
+        quantization_metrics (list): see BINARYReferenceWriter.
+    """
+    if format not in reference_formats:
+        raise ValueError(f"Unsupported format: {format}")
+    if format != "BINARY" and (encoding != "raw" or precision != "float64"):
+        raise ValueError(f"The {format} format only supports the raw encoding in float64")
+    if codec is None:
+        codec = "gzip:6" if encoding != "raw" else default_codecs[format]
+    if format == "CSV":
+        return CSVReferenceWriter(file_path, dof_per_point, num_points, codec)
+    elif format == "JSON":
+        return JSONReferenceWriter(file_path, dof_per_point, num_points, codec)
+    return BINARYReferenceWriter(file_path, dof_per_point, num_points, codec, encoding, precision, max_quantization_error,
+                                 expected_frames, quantization_metrics)
+
+# --------------------------------------------------
+# Helper: read the legacy state reference format
+# --------------------------------------------------
+_legacy_line = re.compile(rb"^[ \t]*([TXV])=([^\n]*)", re.MULTILINE)
+# fields of the MechanicalObjects written by WriteState, and their tag
+legacy_fields = {"position": b"X", "velocity": b"V"}
+
+
+def _legacy_size_error(filename, blocks, expected_size, reason):
+    """Build the error describing the first block of an unexpected size, or
+    the given reason if all the blocks have the expected size."""
+    sizes = [len(block.split()) for block in blocks]
+    expected_size = sizes[0] if expected_size is None else expected_size
+    for size in sizes:
+        if size != expected_size:
+            return ValueError(
+                f"Legacy reference size mismatch in {filename}: "
+                f"expected {expected_size}, got {size}\n"
+            )
+    return ValueError(f"Invalid legacy reference {filename}: {reason}")
+
+
+def parse_legacy_reference(data, filename, expected_size = None, state = b"X"):
+    """Parse the content of a legacy reference file in bulk.
+
+    The T= lines and the lines of the parsed state are located with a single
+    regular expression and all the blocks are converted at once by numpy's C
+    parser into one array, instead of splitting and converting every line in
+    Python. The lines of the other state are ignored.
+
+    Args:
+        data (bytes): the decompressed content of the file.
+        filename (str): name of the file, for error messages.
+        expected_size (int): number of values expected in each block, if known.
+        state (bytes): b"X" for the positions, b"V" for the velocities.
+
+    Returns:
+        (np.ndarray, np.ndarray): the time of each frame, and the values of the
+        state as one (frames, values per frame) array.
+    """
+    times = []
+    blocks = []
+    name = state.decode("ascii")
+    for tag, payload in _legacy_line.findall(data):
+        if tag == b"T":
+            times.append(payload)
+        elif tag == state:
+            if not times:
+                raise RuntimeError(f"{name} found before T in {filename}")
+            blocks.append(payload)
+
+    if len(times) != len(blocks):
         raise RuntimeError(
             f"Legacy reference corrupted in {filename}: "
-            f"{len(times)} times vs {len(values)} X blocks"
+            f"{len(times)} times vs {len(blocks)} {name} blocks"
         )
 
-    return times, values
+    try:
+        frame_times = np.array(times, dtype=np.float64)
+    except ValueError as e:
+        raise ValueError(f"Invalid time in legacy reference {filename}: {e}")
+    if not blocks:
+        return frame_times, np.zeros((0, 0 if expected_size is None else expected_size))
+    if not any(block.strip() for block in blocks):
+        # e.g. a MechanicalObject without points: loadtxt would skip all the blocks
+        if expected_size:
+            raise _legacy_size_error(filename, blocks, expected_size, f"empty {name} blocks")
+        return frame_times, np.zeros((len(blocks), 0))
+
+    try:
+        values = np.loadtxt(blocks, dtype=np.float64, ndmin=2, comments=None)
+    except ValueError as e:
+        # blocks of different sizes, or a token which is not a number
+        raise _legacy_size_error(filename, blocks, expected_size, e)
+
+    if values.shape[0] != len(blocks) or (expected_size is not None and values.shape[1] != expected_size):
+        # empty blocks are skipped by loadtxt
+        raise _legacy_size_error(filename, blocks, expected_size,
+                                 f"{len(blocks)} {name} blocks but {values.shape[0]} frames of values")
+
+    return frame_times, values
+
+
+def read_legacy_reference(filename, mechanical_object, fields = ("position",)):
+    """Read a legacy .txt.gz reference file written by the WriteState component.
+
+    The file is read and decompressed once, whatever the number of fields.
+
+    Args:
+        fields (list): the states read, among legacy_fields.
+
+    Returns:
+        (np.ndarray, list): the time of each frame, and the values of each
+        field as one (frames, n_points, dof_per_point) array.
+    """
+    with Codecs.open_file(filename, "rb") as f:
+        data = f.read()
+
+    times = None
+    field_values = []
+    for field in fields:
+        # Infer layout from MechanicalObject
+        n_points, dof_per_point = np.asarray(getattr(mechanical_object, field).value).shape
+        times, values = parse_legacy_reference(data, filename, n_points * dof_per_point, legacy_fields[field])
+        field_values.append(values.reshape((len(times), n_points, dof_per_point)))
+
+    return times, field_values
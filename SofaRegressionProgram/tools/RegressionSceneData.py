@@ -1,13 +1,24 @@
 import time
+import functools
 import numpy as np
 import pathlib
 
 import tools.ReferenceFileIO as reference_io
+import tools.ErrorMetrics as ErrorMetrics
+import tools.FieldCapture as FieldCapture
 import tools.RegressionHelper as helper
-import Sofa
+import tools.PhaseProfiler as PhaseProfiler
 
 from tools import ProgressBarHandler as pbh
 
+# Sofa is imported by the methods which simulate: the scene descriptors are used
+# without SOFA by the orchestrator (listing, filtering, sharding, merging).
+
+
+class _ReferenceReadError(Exception):
+    """The reference files of a scene cannot be read. Other errors of a compare
+    come from the simulation and are errors of the scene."""
+
 
 def is_simulated(node):
     if node.hasODESolver():
@@ -22,32 +33,6 @@ def is_simulated(node):
     return False
 
 
-class ReplayState(Sofa.Core.Controller):
-    def __init__(self, node, slave_mo, state_filename, **kwargs):
-        super().__init__(**kwargs)
-        self.node = node
-        self.slave_mo = slave_mo
-        self.keyframes = []
-        self.frame_step = 0
-        self.t_sim = 0.0
-
-        self.ref_data, self.keyframes = reference_io.read_JSON_reference_file(state_filename)
-        
-        if (self.keyframes[0] == 0.0): # frame 0.0
-            tmp_position = np.asarray(self.ref_data[str(self.keyframes[0])])
-            self.slave_mo.position = tmp_position.tolist()
-            self.frame_step = 1
-           
-    def onAnimateEndEvent(self, event):
-       dt = float(self.node.getRootContext().dt.value)
-       self.t_sim += dt
-
-       if abs(self.t_sim - self.keyframes[self.frame_step]) < 0.000001:
-           tmp_position = np.asarray(self.ref_data[str(self.keyframes[self.frame_step])])
-           self.slave_mo.position = tmp_position.tolist()
-           self.frame_step += 1
-
-    
 def is_mapped(node):
     mapping = node.getMechanicalMapping()
 
@@ -58,7 +43,8 @@ def is_mapped(node):
 
 class RegressionSceneData:
     def __init__(self, file_scene_path: str = None, file_ref_path: str = None, steps = 1000,
-                 epsilon = 0.0001, meca_in_mapping = True, dump_number_step = 1, disable_progress_bar = False, verbose = False):
+                 epsilon = 0.0001, meca_in_mapping = True, dump_number_step = 1, disable_progress_bar = False, verbose = False,
+                 timeout = None, max_memory = None, criterion = ErrorMetrics.default_criterion, fields = None):
         """
         /// Path to the file scene to test
         std::string m_fileScenePath;
@@ -72,6 +58,14 @@ class RegressionSceneData:
         bool m_mecaInMapping;
         /// Option to compare mechanicalObject dof position at each timestep
         bool m_dumpNumberStep;    
+        /// Time limit of the scene in seconds (None: no limit)
+        float timeout;
+        /// Resident memory limit of the scene in MB (None: no limit)
+        float max_memory;
+        /// Error metric compared to epsilon, see ErrorMetrics
+        str criterion;
+        /// Fields captured besides the positions, with their tolerance (None: default), see FieldCapture
+        dict fields;
         """
         self.file_scene_path = file_scene_path
         self.file_ref_path = file_ref_path
@@ -81,30 +75,100 @@ class RegressionSceneData:
         self.dump_number_step = int(dump_number_step)
         self.meca_objs = []
         self.filenames = []
+        self.replay_states = [] # ReplayState of each MechanicalObject, when replayed
         self.mins = []
         self.maxs = []
         self.total_error = []
         self.error_by_dof = []
+        self.criterion = criterion
+        self.metrics = [] # other metrics computed for the report, see ErrorMetrics
+        self.metric_values = {} # metric -> value for each MechanicalObject, accumulated over the key frames
+        self.fields = dict(fields) if fields else {}
+        self.field_sources = {} # field -> objects whose field is captured, see FieldCapture
+        self.field_filenames = {} # field -> reference file of each source
+        self.field_errors = {} # field -> error of each source, accumulated over the key frames
+        self.failed_fields = [] # fields whose error exceeds their tolerance
         self.nbr_tested_frame = 0
         self.regression_failed = False
         self.root_node = None
         self.disable_progress_bar = disable_progress_bar
         self.verbose = verbose
-        self.total_run_time = 0
+        self.total_run_time = 0 # time spent in animate(), in ns
+        self.load_time = 0 # time spent loading and initializing the scene, in ns
+        self.fail_fast = False # stop simulating as soon as the scene is known to fail
+        self.failed_frame = None # index of the key frame where the threshold was first exceeded
+        self.failed_time = None
+        self.stopped_early = False
+        self.skipped = False # not run at all, the run was stopped before (--max-failures)
+        self.cached = False # result reused from a previous run with the same inputs
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.killed = None # "timeout" or "memory" if the run was killed because of its limits
+        self.killed_message = None
+        self.profiler = PhaseProfiler.PhaseProfiler() # time spent in each phase of the run
+        self.benchmark_status = None # "baseline written", "passed" or "regressed" once benchmarked
+        self.benchmark_statistics = None # step time statistics of the benchmark, see Benchmark
+        self.benchmark_baseline = None # and of its baseline
+        self.benchmark_change = None # relative change of the median step time, in percent
+        self.event_handler = None # called with (event, fields) as the run progresses, see ResultChannel
+        self.nbr_simulated_steps = 0
+        self.meca_obj_names = [] # names of the MechanicalObjects, as reported by the worker
+        self.frame_errors = [] # [frame, time, criterion of each MechanicalObject] of each compared key frame
 
     def print_info(self):
         helper.writeLog("Test scene: " + self.file_scene_path + " vs " + self.file_ref_path + " using: " + str(self.steps)
               + " " + str(self.epsilon))
         
     def log_errors(self):
-        if self.regression_failed:
+        if self.skipped:
+            helper.writeWarning(f"{self.file_scene_path} | Skipped: maximum number of failures reached.")
+        elif self.killed is not None:
+            helper.writeError(f"{self.file_scene_path} | Killed ({self.killed} limit): {self.killed_message}")
+        elif self.benchmark_status is not None:
+            median = self.benchmark_statistics["median"] * 1e3
+            if self.benchmark_status == "baseline written":
+                helper.writeSuccess(f"{self.file_scene_path} | Benchmark baseline written: median step time {median:.4f} ms "
+                                    f"(p90 {self.benchmark_statistics['p90'] * 1e3:.4f} ms).")
+                return
+            message = (f"{self.file_scene_path} | Median step time {median:.4f} ms vs baseline "
+                       f"{self.benchmark_baseline['median'] * 1e3:.4f} ms ({self.benchmark_change:+.1f}%)")
+            if self.benchmark_status == "regressed":
+                helper.writeError(message + ": performance regression.")
+            else:
+                helper.writeSuccess(message + ".")
+        elif self.regression_failed:
+            # the scene may only fail because of its captured fields
+            threshold = f" > Threshold: {self.epsilon}"
+            if self.failed_fields and not any(value > self.epsilon for value in self.metric_values.get(self.criterion, [])):
+                threshold = f" (threshold: {self.epsilon})"
+            if self.criterion == "error_by_dof":
+                criterion = f"\n    ### Error by dof: {self.error_by_dof}{threshold}"
+            else:
+                criterion = (f"\n    ### Error by dof: {self.error_by_dof}"
+                             f"\n    ### {self.criterion}: {self.metric_values.get(self.criterion)}{threshold}")
             helper.writeError(
                                 f"{self.file_scene_path} | Number of key frames compared: {self.nbr_tested_frame}  | run time: {self.total_run_time/1e9} seconds. "
-                                f"\n    ### Error by dof: {self.error_by_dof} > Threshold: {self.epsilon}"
+                                + criterion +
                                 f"\n    ### Total Error: {self.total_error}"
+                                + "".join(f"\n    ### {metric}: {values}" for metric, values in self.metric_values.items()
+                                          if metric not in ("error_by_dof", self.criterion))
+                                + "".join(f"\n    ### {field} error: {errors}"
+                                          + (f" > Tolerance: {self.field_tolerance(field)}" if field in self.failed_fields
+                                             else f" (tolerance: {self.field_tolerance(field)})")
+                                          for field, errors in self.field_errors.items())
                             )
+            if self.failed_frame is not None:
+                helper.writeError(f"{self.file_scene_path} | Threshold exceeded at key frame {self.failed_frame} (time {self.failed_time})"
+                                  + (", simulation stopped there (fail-fast)." if self.stopped_early else "."))
+                for frame, frame_time, frame_errors in self.frame_errors:
+                    if frame == self.failed_frame:
+                        helper.writeError(f"    ### {self.criterion} at key frame {frame}: "
+                                          + ", ".join(f"{name}: {error}" for name, error in zip(self.meca_obj_names, frame_errors)))
         elif self.nbr_tested_frame == 0:
             helper.writeError(f"No frames were tested for {self.file_scene_path}")
+        elif self.cached:
+            helper.writeSuccess(f"{self.file_scene_path} | Cached pass: inputs unchanged since a previous passing run "
+                                f"({self.nbr_tested_frame} key frames compared). ")
         else:
             helper.writeSuccess(f"{self.file_scene_path} | Number of key frames compared: {self.nbr_tested_frame} | run time: {self.total_run_time/1e9} seconds. ")
 
@@ -117,6 +181,33 @@ class RegressionSceneData:
         self.total_run_time = result.get("total_run_time", 0)
         self.error_by_dof = result.get("error_by_dof", [])
         self.total_error = result.get("total_error", [])
+        self.failed_frame = result.get("failed_frame", None)
+        self.failed_time = result.get("failed_time", None)
+        self.stopped_early = bool(result.get("stopped_early", False))
+        self.cached = bool(result.get("cached", False))
+        self.metric_values = result.get("metrics", {})
+        self.field_errors = result.get("field_errors", {})
+        self.failed_fields = result.get("failed_fields", [])
+        self.meca_obj_names = result.get("meca_objs", [])
+        self.frame_errors = result.get("frame_errors", [])
+
+    def apply_benchmark_result(self, result):
+        """Copy the verdict of a benchmark (see RegressionSceneList.apply_benchmark_result) back onto this object."""
+        self.total_run_time = result.get("total_run_time", 0)
+        self.benchmark_status = result["benchmark_status"]
+        self.benchmark_statistics = result["statistics"]
+        self.benchmark_baseline = result.get("baseline")
+        self.benchmark_change = result.get("change")
+
+    def apply_killed_result(self, result):
+        """Record that the worker process was killed because it exceeded its limits."""
+        self.killed = result["killed"]
+        self.killed_message = result.get("error")
+
+    def emit(self, event, **fields):
+        """Report an event of the run to the event handler, if any (see ResultChannel)."""
+        if self.event_handler is not None:
+            self.event_handler(event, fields)
 
     def print_meca_objs(self):
         helper.writeLog("# Nbr Meca: " + str(len(self.meca_objs)))
@@ -141,16 +232,23 @@ class RegressionSceneData:
             self.parse_node(child, level + 1)
 
 
-    def add_compare_state(self):
+    def add_compare_state(self, format = "JSON"):
+        """Add a ReplayState displaying the references of each MechanicalObject.
+        load_scene() must have been called with the same format."""
+        import tools.ReplayState as ReplayState
+
+        self.replay_states = []
         counter = 0
         for meca_obj in self.meca_objs:
             # Use this filename format to be compatible with previous version
             #_filename = self.file_ref_path + ".reference_" + str(counter) + "_" + meca_obj.name.value + "_mstate" + ".txt.gz"
-            _filename = self.file_ref_path + ".reference_mstate_" + str(counter) + "_" + meca_obj.name.value + ".json.gz"
+            _filename = self.filenames[counter]
             
             compareNode = meca_obj.getContext().addChild("CompareStateNode_"+str(counter))
             cloudPoint = compareNode.addObject('VisualPointCloud', pointSize=10, drawMode="Point", color="green")
-            compareNode.addObject(ReplayState(node=compareNode, slave_mo=cloudPoint, state_filename=_filename))
+            replay_state = ReplayState.ReplayState(node=compareNode, slave_mo=cloudPoint, state_filename=_filename, format=format)
+            compareNode.addObject(replay_state)
+            self.replay_states.append(replay_state)
             counter = counter+1
 
 
@@ -164,85 +262,332 @@ class RegressionSceneData:
     
 
     def load_scene(self, format = "JSON"):
+        import Sofa.Simulation
+
         if self.verbose:
             helper.writeLog(f"Loading scene: {self.file_scene_path}")
-        self.root_node = Sofa.Simulation.load(self.file_scene_path)
+        start_time = time.time_ns()
+        with self.profiler.phase("load"):
+            self.root_node = Sofa.Simulation.load(self.file_scene_path)
         if not self.root_node: # error while loading
             helper.writeError("While trying to load {self.file_scene_path}")
             raise RuntimeError
         else:
             if self.verbose:
                 helper.writeLog("Initializing root node")
-            Sofa.Simulation.initRoot(self.root_node)
+            with self.profiler.phase("init"):
+                Sofa.Simulation.initRoot(self.root_node)
+            self.load_time = time.time_ns() - start_time
 
             # prepare ref files per mecaObjs:
-            self.parse_node(self.root_node, 0)
+            with self.profiler.phase("parse_node"):
+                self.parse_node(self.root_node, 0)
             counter = 0
             for mecaObj in self.meca_objs:
-                if format == "CSV":
-                    _filename = self.file_ref_path + ".reference_mstate_" + str(counter) + "_" + mecaObj.name.value + ".csv.gz"
-                elif format == "JSON":
-                    _filename = self.file_ref_path + ".reference_mstate_" + str(counter) + "_" + mecaObj.name.value + ".json.gz"
+                if format not in reference_io.reference_formats:
+                    helper.writeError(f"Unsupported format: {format}")
+                    raise ValueError(f"Unsupported format: {format}")
+                _filename = self.file_ref_path + ".reference_mstate_" + str(counter) + "_" + mecaObj.name.value + reference_io.reference_formats[format]
                 self.filenames.append(_filename)
                 counter = counter+1
+            self.prepare_fields(format)
+            self.emit("loaded", load_time=self.load_time, meca_objs=[meca_obj.name.value for meca_obj in self.meca_objs])
         
 
-    def write_references(self, format = "JSON"):
+    def prepare_fields(self, format):
+        """Find the sources of the captured fields in the loaded scene, and name their reference files."""
+        self.field_sources = {}
+        self.field_filenames = {}
+        for name in self.fields:
+            field = FieldCapture.fields[name]
+            sources = field.sources(self)
+            self.field_sources[name] = sources
+            self.field_filenames[name] = [FieldCapture.reference_path(self.file_ref_path, name, index, field.source_name(source), format)
+                                          for index, source in enumerate(sources)]
+            if self.verbose:
+                helper.writeLog(f"Capturing {name} of: {', '.join(field.source_name(source) for source in sources)}")
+
+    def field_tolerance(self, name):
+        """Tolerance of a captured field: the one of the scene line, or the default one of the field."""
+        tolerance = self.fields.get(name)
+        if tolerance is None:
+            tolerance = FieldCapture.fields[name].default_tolerance
+        return self.epsilon if tolerance is None else tolerance
+
+
+    def animate(self, dt):
+        """Advance the simulation by one step, timing it."""
+        import Sofa.Simulation
+
+        start_time = time.time_ns()
+        Sofa.Simulation.animate(self.root_node, dt)
+        duration = time.time_ns() - start_time
+        self.total_run_time += duration
+        self.profiler.add("animate", start_time, duration)
+        self.nbr_simulated_steps += 1
+        self.emit("progress", step=self.nbr_simulated_steps, animate_time=self.total_run_time)
+
+
+    def benchmark_steps(self, warmup, repeats):
+        """Time the animate() steps of the scene, loading it again for each repeat.
+
+        Args:
+            warmup (int): untimed steps simulated first in each repeat.
+            repeats (int): number of times the scene is loaded and timed.
+
+        Returns:
+            list: for each repeat, the duration of each of the `steps` timed steps in ns.
+        """
+        import Sofa.Simulation
+
+        pbar_simu = pbh.ProgressBarHandler(total=repeats * (warmup + self.steps), disable=self.disable_progress_bar)
+        pbar_simu.set_description("Benchmark: " + self.file_scene_path)
+
+        repeat_step_times = []
+        try:
+            for repeat in range(repeats):
+                with self.profiler.phase("load"):
+                    root_node = Sofa.Simulation.load(self.file_scene_path)
+                if not root_node: # error while loading
+                    raise RuntimeError(f"While trying to load {self.file_scene_path}")
+                with self.profiler.phase("init"):
+                    Sofa.Simulation.initRoot(root_node)
+                dt = root_node.dt.value
+
+                for step in range(warmup):
+                    Sofa.Simulation.animate(root_node, dt)
+                    pbar_simu.update(1)
+
+                step_times = []
+                for step in range(self.steps):
+                    start_time = time.perf_counter_ns()
+                    Sofa.Simulation.animate(root_node, dt)
+                    step_times.append(time.perf_counter_ns() - start_time)
+                    pbar_simu.update(1)
+                repeat_step_times.append(step_times)
+
+                Sofa.Simulation.unload(root_node)
+        finally:
+            pbar_simu.close()
+
+        return repeat_step_times
+
+
+    def write_references(self, format = "JSON", codec = None, encoding = "raw", precision = "float64"):
         pbar_simu = pbh.ProgressBarHandler(total=self.steps, disable=self.disable_progress_bar)
         pbar_simu.set_description("Simulate: " + self.file_scene_path)
 
-        # compute stepping parameters for the simulation
+        # compute stepping parameters for the simulation: the key frames are
+        # known before simulating, so that the writers know how many to expect
+        key_steps = []
         counter_step = 0
         modulo_step = self.steps / self.dump_number_step
+        for step in range(0, self.steps + 1):
+            if step == 0 or counter_step >= modulo_step or step == self.steps:
+                key_steps.append(step)
+                counter_step = 0
+            counter_step += 1
+        is_key_step = set(key_steps)
         dt = self.root_node.dt.value
         
-        # prepae per-mechanical-object data
-        nbr_meca = len(self.meca_objs)
-        if format == "CSV":
-            csv_rows = [[] for _ in range(nbr_meca)]
-        elif format == "JSON":
-            numpy_data = [] # List<map>
-            for meca_id in range(0, nbr_meca):
-                meca_dofs = {}
-                numpy_data.append(meca_dofs)
-        else:
+        if format not in reference_io.reference_formats:
             helper.writeError(f"Unsupported format: {format}")
             raise ValueError(f"Unsupported format: {format}")
 
-        for step in range(0, self.steps + 1):
-            if step == 0 or counter_step >= modulo_step or step == self.steps:
-                t = dt * step
-                for meca_id in range(nbr_meca):
-                    positions = np.asarray(self.meca_objs[meca_id].position.value)
-
-                    if format == "CSV":
-                        row = [t]
-                        row.extend(positions.reshape(-1).tolist())  # flatten vec3d
-                        csv_rows[meca_id].append(row)
-                    elif format == "JSON":
-                        numpy_data[meca_id][t] = np.copy(positions)
-                
-                counter_step = 0
-            
-            Sofa.Simulation.animate(self.root_node, dt)
-            counter_step += 1
-            pbar_simu.update(1)
+        # open one incremental writer per mechanical object, and per source of
+        # each captured field: each frame is written as soon as it is captured
+        # instead of being kept until the end
+        # the float32 rounding error is bounded for the metrics each file is compared with
+        captures = [(FieldCapture.positions, self.meca_objs, self.filenames, precision, self.epsilon, "epsilon",
+                     list(dict.fromkeys(["error_by_dof", self.criterion])))]
+        for name, sources in self.field_sources.items():
+            field = FieldCapture.fields[name]
+            field_precision = precision if field.precision is None or format != "BINARY" else field.precision
+            captures.append((field, sources, self.field_filenames[name], field_precision, self.field_tolerance(name),
+                             f"the {name} tolerance", [field.metric]))
+
+        writers = []
+        capture_functions = [] # value captured in the file of each writer
+        bounds = [] # description of the tolerance bounding the rounding error of each writer
+        try:
+            for field, sources, filenames, field_precision, tolerance, tolerance_name, metrics in captures:
+                for source, filename in zip(sources, filenames):
+                    output_file = pathlib.Path(filename)
+                    output_file.parent.mkdir(exist_ok=True, parents=True)
+
+                    n_points, dof_per_point = field.capture(source).shape
+                    writers.append(reference_io.open_reference_writer(
+                        filename, format, dof_per_point, n_points, codec, encoding, field_precision,
+                        max_quantization_error=tolerance * reference_io.quantization_error_ratio,
+                        expected_frames=len(key_steps), quantization_metrics=metrics))
+                    capture_functions.append(functools.partial(field.capture, source))
+                    bounds.append(f"{tolerance_name} {tolerance}")
+
+            for step in range(0, self.steps + 1):
+                if step in is_key_step:
+                    t = dt * step
+                    with self.profiler.phase("encode"):
+                        for writer, capture in zip(writers, capture_functions):
+                            writer.write_frame(t, capture())
+
+                self.animate(dt)
+                pbar_simu.update(1)
+
+            with self.profiler.phase("encode"):
+                for writer in writers:
+                    writer.close()
+            for writer, bound in zip(writers, bounds):
+                if getattr(writer, "precision_fallback", False):
+                    helper.writeWarning(f"{writer.file_path}: the float32 rounding error ({writer.quantization_error}) "
+                                        f"is too large for {bound}, the reference is stored in float64.")
+        except Exception:
+            for writer in writers:
+                writer.abort()
+            raise
+        finally:
+            pbar_simu.close()
+
+        self.unload_scene()
+
+
+    def unload_scene(self):
+        """Unload the scene loaded by load_scene(), e.g. before the next scene of a batch."""
+        import Sofa.Simulation
+
+        if self.root_node is not None:
+            Sofa.Simulation.unload(self.root_node)
+            self.root_node = None
+
+
+    def compared_metrics(self):
+        """The metrics computed when comparing: error_by_dof (always reported), the criterion and the requested ones."""
+        return list(dict.fromkeys(["error_by_dof", self.criterion] + self.metrics))
+
+    def reset_errors(self, nbr_meca, fields = None):
+        """Reset the accumulated errors.
+
+        Args:
+            nbr_meca (int): number of compared MechanicalObjects.
+            fields (list): compared fields, all the captured ones by default.
+        """
+        self.total_error = [0.0] * nbr_meca
+        self.error_by_dof = [0.0] * nbr_meca
+        self.metric_values = {metric: [0.0] * nbr_meca for metric in self.compared_metrics()}
+        fields = self.field_sources if fields is None else fields
+        self.field_errors = {name: [0.0] * len(self.field_sources[name]) for name in fields}
+        self.failed_fields = []
+
+    def add_frame_values(self, frame_values, step, simu_time):
+        """Accumulate the metrics of a compared key frame (see ErrorMetrics.FrameComparator.compare())."""
+        self.total_error = (np.asarray(self.total_error) + frame_values["full_dist"]).tolist()
+        for metric, values in self.metric_values.items():
+            self.metric_values[metric] = ErrorMetrics.accumulate(metric, np.asarray(values), frame_values[metric]).tolist()
+        self.error_by_dof = self.metric_values["error_by_dof"]
 
-        pbar_simu.close()
+        if self.verbose:
+            for meca_id, meca_obj in enumerate(self.meca_objs):
+                helper.writeLog(
+                    f"{step} | {meca_obj.name.value} | "
+                    f"full_dist: {frame_values['full_dist'][meca_id]} | "
+                    f"error_by_dof: {frame_values['error_by_dof'][meca_id]} | "
+                    f"{self.criterion}: {frame_values[self.criterion][meca_id]}"
+                )
 
-        # write reference files
-        for meca_id in range(nbr_meca):
-            output_file = pathlib.Path(self.filenames[meca_id])
-            output_file.parent.mkdir(exist_ok=True, parents=True)
+        self.nbr_tested_frame += 1
+        self.emit("frame", frame=self.nbr_tested_frame - 1, time=float(simu_time),
+                  errors=frame_values[self.criterion].tolist())
+
+    def criterion_exceeded(self, legacy = False):
+        """Whether the accumulated criterion exceeds epsilon for a MechanicalObject. The legacy
+        comparison uses the mean of error_by_dof over the MechanicalObjects instead."""
+        values = self.metric_values[self.criterion]
+        if legacy and self.criterion == "error_by_dof":
+            return len(values) > 0 and sum(values) / float(len(values)) > self.epsilon
+        return any(value > self.epsilon for value in values)
+
+    def field_comparators(self, shapes):
+        """Prepare the comparison of the captured fields.
 
-            if format == "CSV":
-                dof_per_point = self.meca_objs[meca_id].position.value.shape[1]
-                n_points = self.meca_objs[meca_id].position.value.shape[0]
-                reference_io.write_CSV_reference_file(self.filenames[meca_id], dof_per_point, n_points, csv_rows[meca_id])               
-            elif format == "JSON":
-                reference_io.write_JSON_reference_file(self.filenames[meca_id], numpy_data[meca_id])
+        Args:
+            shapes (dict): shape of the reference of each source of each compared field.
 
-        Sofa.Simulation.unload(self.root_node)
+        Returns:
+            dict: the ErrorMetrics.FrameComparator of each compared field.
+        """
+        return {name: ErrorMetrics.FrameComparator(field_shapes, [FieldCapture.fields[name].metric])
+                for name, field_shapes in shapes.items()}
+
+    def split_field_references(self, references):
+        """Split the references of the sources of all the captured fields, in order, by field."""
+        split = {}
+        start = 0
+        for name, sources in self.field_sources.items():
+            split[name] = references[start:start + len(sources)]
+            start += len(sources)
+        return split
+
+    def compare_fields(self, comparators, references):
+        """Compare the captured fields at a key frame and accumulate their errors.
+
+        Args:
+            comparators (dict): see field_comparators().
+            references (dict): references of the sources of each compared field
+                at this key frame, as a list or stacked in one flat array.
+
+        Returns:
+            str: the first source whose field does not have the shape of its
+            references, None if all the fields were compared.
+        """
+        for name, comparator in comparators.items():
+            field = FieldCapture.fields[name]
+            sources = self.field_sources[name]
+            values = [field.capture(source) for source in sources]
+            mismatch = comparator.first_mismatch(values)
+            if mismatch is not None:
+                return (f"{name} of {field.source_name(sources[mismatch[0]])}: "
+                        f"reference {mismatch[1]} vs current {mismatch[2]}")
+            frame_values = comparator.compare(references[name], values)[field.metric]
+            self.field_errors[name] = ErrorMetrics.accumulate(field.metric, np.asarray(self.field_errors[name]),
+                                                              frame_values).tolist()
+        return None
+
+    def fields_exceeding_tolerance(self):
+        """The compared fields whose accumulated error exceeds their tolerance for a source."""
+        return [name for name, errors in self.field_errors.items()
+                if any(error > self.field_tolerance(name) for error in errors)]
+
+    def record_failed_frame(self, simu_time):
+        """Remember the key frame at which the threshold was first exceeded."""
+        self.failed_frame = self.nbr_tested_frame - 1
+        self.failed_time = float(simu_time)
+        self.stopped_early = self.fail_fast
+
+
+    def read_next_reference_frames(self, readers):
+        """Advance every reference reader by one frame.
+
+        Returns:
+            list: the (time, frame) of each MechanicalObject, or None once all
+            the readers are exhausted.
+
+        Raises:
+            _ReferenceReadError: if the references cannot be read.
+        """
+        try:
+            frames = [next(reader, None) for reader in readers]
+        except FileNotFoundError as e:
+            raise _ReferenceReadError(f"While reading references: {str(e)}") from e
+        except KeyError as e:
+            raise _ReferenceReadError(f"Missing metadata in reference file: {str(e)}") from e
+        except ValueError as e:
+            raise _ReferenceReadError(f"Invalid reference file: {str(e)}") from e
+        nbr_ended = sum(1 for frame in frames if frame is None)
+        if nbr_ended == len(frames):
+            return None
+        if nbr_ended > 0:
+            raise _ReferenceReadError(f"Invalid reference file: Reference timeline mismatch for file {self.file_scene_path}: "
+                                      f"not all MechanicalObjects have the same number of frames")
+        return frames
 
 
     def compare_references(self, format = "JSON"):
@@ -250,147 +595,105 @@ class RegressionSceneData:
         pbar_simu.set_description("compare_references: " + self.file_scene_path)
 
         nbr_meca = len(self.meca_objs)
-        
-        # Reference data
-        keyframes = []  # shared timeline
-        if format == "CSV":
-            ref_values = []         # List[List[np.ndarray]]
-        elif format == "JSON":
-            numpy_data = [] # List<map>
-        else:
+
+        if format not in reference_io.reference_formats:
             helper.writeError(f"Unsupported format: {format}")
             raise ValueError(f"Unsupported format: {format}")
 
         # Outputs init
-        self.total_error = []
-        self.error_by_dof = []
+        self.reset_errors(nbr_meca)
         self.nbr_tested_frame = 0
         self.regression_failed = False
-
-        # --------------------------------------------------
-        # Load reference files
-        # --------------------------------------------------
-        for meca_id in range(nbr_meca):
-            try:
-                if format == "CSV":
-                    meta, rows = reference_io.read_CSV_reference_file(self.filenames[meca_id])
-
-                    dof_per_point = int(meta["dof_per_point"])
-                    n_points = int(meta["num_points"])
-
-                    times = []
-                    values = []
-
-                    for row in rows:
-                        t = float(row[0])
-                        flat = np.asarray(row[1:], dtype=float)
-
-                        expected_size = n_points * dof_per_point
-                        if flat.size != expected_size:
-                            helper.writeError(
-                                f"Reference size mismatch for file {self.file_scene_path}, "
-                                f"MechanicalObject {meca_id}: "
-                                f"expected {expected_size}, got {flat.size}"
-                            )
-                            return False
-
-                        values.append(flat.reshape((n_points, dof_per_point)))
-                        times.append(t)
-                    
-                    ref_values.append(values)
-
-                    # Keep timeline from first MechanicalObject
-                    if meca_id == 0:
-                        keyframes = times
-                    else:
-                        if len(times) != len(keyframes):
-                            helper.writeError(
-                                f"Reference timeline mismatch for file {self.file_scene_path}, "
-                                f"MechanicalObject {meca_id}"
-                            )
-                            return False
-
-                elif format == "JSON":
-                    decoded_array, decoded_keyframes = reference_io.read_JSON_reference_file(self.filenames[meca_id])
-                    numpy_data.append(decoded_array)
-
-                    # Keep timeline from first MechanicalObject
-                    if meca_id == 0:
-                        keyframes = decoded_keyframes
-
-                self.total_error.append(0.0)
-                self.error_by_dof.append(0.0)
-
-            except FileNotFoundError as e:
-                helper.writeError(f"While reading references: {str(e)}")
-                return False
-            except KeyError as e:
-                helper.writeError(f"Missing metadata in reference file: {str(e)}")
-                return False
-
-        # --------------------------------------------------
-        # Simulation + comparison
-        # --------------------------------------------------
-        frame_step = 0
-        nbr_frames = len(keyframes)
-        dt = self.root_node.dt.value
-        for step in range(0, self.steps + 1):
-            simu_time = dt * step
-
-            # Use tolerance for float comparison
-            if frame_step < nbr_frames and np.isclose(simu_time, keyframes[frame_step]):
-                for meca_id in range(nbr_meca):
-                    meca_dofs = np.copy(self.meca_objs[meca_id].position.value)
-
-                    if format == "CSV":
-                        data_ref = ref_values[meca_id][frame_step]
-                    elif format == "JSON":
-                        data_ref = np.asarray(numpy_data[meca_id][str(keyframes[frame_step])])
-
-                    if meca_dofs.shape != data_ref.shape:
+        self.failed_frame = None
+        self.failed_time = None
+        self.stopped_early = False
+
+        try:
+            # --------------------------------------------------
+            # Open reference files: frames are read one at a time, when the
+            # simulation reaches them, so that memory does not grow with the
+            # number of steps
+            # --------------------------------------------------
+            # the captured fields are read with the positions, in the same timeline
+            readers = []
+            for meca_id in range(nbr_meca):
+                readers.append(reference_io.iter_reference_frames(self.filenames[meca_id], format))
+            for filenames in self.field_filenames.values():
+                readers.extend(reference_io.iter_reference_frames(filename, format) for filename in filenames)
+
+            with self.profiler.phase("decode"):
+                ref_frames = self.read_next_reference_frames(readers)
+            # the layout of the references is the one of their first frame
+            if ref_frames is not None:
+                comparator = ErrorMetrics.FrameComparator([reference.shape for _, reference in ref_frames[:nbr_meca]],
+                                                          self.compared_metrics())
+                field_comparators = self.field_comparators(
+                    self.split_field_references([reference.shape for _, reference in ref_frames[nbr_meca:]]))
+
+            # --------------------------------------------------
+            # Simulation + comparison
+            # --------------------------------------------------
+            dt = self.root_node.dt.value
+            # each frame is matched to its step once, when it is read,
+            # instead of testing every step against the next frame
+            step_times = dt * np.arange(self.steps + 1, dtype=np.float64)
+            ref_step = -1
+            if ref_frames is not None:
+                ref_step = reference_io.match_frame_steps([ref_frames[0][0]], step_times)[0]
+            for step in range(0, self.steps + 1):
+                simu_time = dt * step
+
+                if step == ref_step:
+                    compare_start = time.time_ns()
+                    positions = [meca_obj.position.value for meca_obj in self.meca_objs]
+                    mismatch = comparator.first_mismatch(positions)
+                    if mismatch is not None:
                         helper.writeError(
                             f"Shape mismatch for file {self.file_scene_path}, "
-                            f"MechanicalObject {meca_id}: "
-                            f"reference {data_ref.shape} vs current {meca_dofs.shape}"
+                            f"MechanicalObject {mismatch[0]}: "
+                            f"reference {mismatch[1]} vs current {mismatch[2]}"
                         )
                         return False
 
-                    data_diff = data_ref - meca_dofs
-
-                    # Compute total distance between the 2 sets
-                    full_dist = np.linalg.norm(data_diff)
-                    error_by_dof = full_dist / float(data_diff.size)
+                    frame_values = comparator.compare([reference for _, reference in ref_frames[:nbr_meca]], positions)
+                    mismatch = self.compare_fields(field_comparators, self.split_field_references(
+                        [reference for _, reference in ref_frames[nbr_meca:]]))
+                    if mismatch is not None:
+                        helper.writeError(f"Shape mismatch for file {self.file_scene_path}, {mismatch}")
+                        return False
+                    self.profiler.add("compare", compare_start, time.time_ns() - compare_start)
+                    self.add_frame_values(frame_values, step, simu_time)
 
-                    if self.verbose:
-                        helper.writeLog(
-                            f"{step} | {self.meca_objs[meca_id].name.value} | "
-                            f"full_dist: {full_dist} | "
-                            f"error_by_dof: {error_by_dof} | "
-                            f"nbrDofs: {data_ref.size}"
-                        )
+                    # errors only accumulate: once over a tolerance, the verdict is settled
+                    if self.failed_frame is None and (self.criterion_exceeded() or self.fields_exceeding_tolerance()):
+                        self.record_failed_frame(simu_time)
+                        if self.fail_fast:
+                            break
 
-                    self.total_error[meca_id] += full_dist
-                    self.error_by_dof[meca_id] += error_by_dof
+                    with self.profiler.phase("decode"):
+                        ref_frames = self.read_next_reference_frames(readers)
 
-                frame_step += 1
-                self.nbr_tested_frame += 1
+                    # security exit if simulation steps exceed nbr_frames
+                    if ref_frames is None:
+                        break
+                    ref_step = reference_io.match_frame_steps([ref_frames[0][0]], step_times, step)[0]
 
-                # security exit if simulation steps exceed nbr_frames
-                if frame_step == nbr_frames:
-                    break
+                self.animate(dt)
 
-            start_time = time.time_ns()
-            Sofa.Simulation.animate(self.root_node, dt)
-            self.total_run_time += time.time_ns() - start_time
+                pbar_simu.update(1)
 
-            pbar_simu.update(1)
-        pbar_simu.close()
+        except _ReferenceReadError as e:
+            # errors of the simulation itself are not caught: they fail the scene
+            helper.writeError(str(e))
+            return False
+        finally:
+            pbar_simu.close()
 
         # Final regression returns value
-        for meca_id in range(nbr_meca):
-            if self.error_by_dof[meca_id] > self.epsilon:
-                self.regression_failed = True
-                return False
+        self.failed_fields = self.fields_exceeding_tolerance()
+        if self.criterion_exceeded() or self.failed_fields:
+            self.regression_failed = True
+            return False
 
         return True
     
@@ -406,17 +709,31 @@ class RegressionSceneData:
         ref_times = []          # shared timeline
         ref_values = []         # List[List[np.ndarray]]
 
-        self.total_error = []
-        self.error_by_dof = []
+        # WriteState only writes the positions and the velocities of the MechanicalObjects
+        legacy_fields = [name for name in self.field_sources if name in reference_io.legacy_fields]
+        for name in self.field_sources:
+            if name not in legacy_fields:
+                helper.writeWarning(f"{self.file_scene_path} | No {name} in legacy references, the field is not compared.")
+        ref_field_values = {name: [] for name in legacy_fields}
+
+        self.reset_errors(nbr_meca, legacy_fields)
         self.nbr_tested_frame = 0
         self.regression_failed = False
+        self.failed_frame = None
+        self.failed_time = None
+        self.stopped_early = False
 
         # --------------------------------------------------
         # Load legacy reference files
         # --------------------------------------------------
         for meca_id in range(nbr_meca):
             try:
-                times, values = reference_io.read_legacy_reference(self.file_ref_path + ".reference_" + str(meca_id) + "_" + self.meca_objs[meca_id].name.value + "_mstate" + ".txt.gz", self.meca_objs[meca_id])
+                with self.profiler.phase("decode"):
+                    legacy_filename = self.file_ref_path + ".reference_" + str(meca_id) + "_" + self.meca_objs[meca_id].name.value + "_mstate" + ".txt.gz"
+                    times, (values, *field_values) = reference_io.read_legacy_reference(
+                        legacy_filename, self.meca_objs[meca_id], ["position"] + legacy_fields)
+                    for name, values_of_field in zip(legacy_fields, field_values):
+                        ref_field_values[name].append(values_of_field)
             except Exception as e:
                 helper.writeError(
                     f"Error while reading legacy references for MechanicalObject '"
@@ -436,68 +753,75 @@ class RegressionSceneData:
                     return False
 
             ref_values.append(values)
-            self.total_error.append(0.0)
-            self.error_by_dof.append(0.0)
 
         if self.verbose:
             helper.writeLog(f"compare_legacy_references: ref_values[0][0] shape: {ref_values[0][0].shape}")
 
+        # the frames of all the MechanicalObjects are stacked once: each key frame is a row
+        comparator = ErrorMetrics.FrameComparator([values.shape[1:] for values in ref_values], self.compared_metrics())
+        field_comparators = self.field_comparators({name: [values.shape[1:] for values in field_values]
+                                                    for name, field_values in ref_field_values.items()})
+        if nbr_meca > 0:
+            ref_values = np.concatenate([values.reshape((len(values), -1)) for values in ref_values], axis=1)
+            ref_field_values = {name: np.concatenate([values.reshape((len(values), -1)) for values in field_values], axis=1)
+                                for name, field_values in ref_field_values.items()}
+
         # --------------------------------------------------
         # Simulation + comparison
         # --------------------------------------------------
 
-        frame_step = 0
         nbr_frames = len(ref_times)
         dt = self.root_node.dt.value
 
         if nbr_frames != self.steps:
             helper.writeWarning(f"Number of steps saved in reference file ({nbr_frames}) does not match the number of required steps ({self.steps})")
 
+        # match every step to its reference frame at once
+        try:
+            step_frames = reference_io.ReferenceTimeIndex(ref_times).step_frames(dt, self.steps)
+        except ValueError as e:
+            helper.writeError(f"Invalid legacy reference for file {self.file_scene_path}: {str(e)}")
+            return False
+
         if self.verbose:
             helper.writeLog(f"Running {self.steps} simulation steps...")
 
         for step in range(0, self.steps + 1):
             simu_time = dt * step
+            frame_step = step_frames[step]
 
-            # Use tolerance for float comparison
-            if frame_step < nbr_frames and np.isclose(simu_time, ref_times[frame_step]):
-                for meca_id in range(nbr_meca):
-                    meca_dofs = np.copy(self.meca_objs[meca_id].position.value)
-                    data_ref = ref_values[meca_id][frame_step]
-
-                    if meca_dofs.shape != data_ref.shape:
-                        helper.writeError(
-                            f"Shape mismatch for file {self.file_scene_path}, "
-                            f"MechanicalObject {meca_id}: "
-                            f"reference {data_ref.shape} vs current {meca_dofs.shape}"
-                        )
-                        return False
-
-                    data_diff = data_ref - meca_dofs
-
-                    # Compute total distance between the 2 sets
-                    full_dist = np.linalg.norm(data_diff)
-                    error_by_dof = full_dist / float(data_diff.size)
-
-                    if self.verbose:
-                        helper.writeLog(
-                            f"    {step} | {self.meca_objs[meca_id].name.value} | "
-                            f"full_dist: {full_dist} | "
-                            f"error_by_dof: {error_by_dof} | "
-                            f"nbrDofs: {data_ref.size}"
-                        )
+            if frame_step >= 0:
+                compare_start = time.time_ns()
+                positions = [meca_obj.position.value for meca_obj in self.meca_objs]
+                mismatch = comparator.first_mismatch(positions)
+                if mismatch is not None:
+                    helper.writeError(
+                        f"Shape mismatch for file {self.file_scene_path}, "
+                        f"MechanicalObject {mismatch[0]}: "
+                        f"reference {mismatch[1]} vs current {mismatch[2]}"
+                    )
+                    return False
 
-                    self.total_error[meca_id] += full_dist
-                    self.error_by_dof[meca_id] += error_by_dof
+                frame_values = comparator.compare(ref_values[frame_step], positions)
+                mismatch = self.compare_fields(field_comparators, {name: field_values[frame_step]
+                                                                   for name, field_values in ref_field_values.items()})
+                if mismatch is not None:
+                    helper.writeError(f"Shape mismatch for file {self.file_scene_path}, {mismatch}")
+                    return False
+                self.profiler.add("compare", compare_start, time.time_ns() - compare_start)
+                self.add_frame_values(frame_values, step, simu_time)
 
-                frame_step += 1
-                self.nbr_tested_frame += 1
+                # errors only accumulate: once the mean is over epsilon, the verdict is settled
+                if self.failed_frame is None and (self.criterion_exceeded(legacy=True) or self.fields_exceeding_tolerance()):
+                    self.record_failed_frame(simu_time)
+                    if self.fail_fast:
+                        break
 
                 # security exit if simulation steps exceed nbr_frames
-                if frame_step == nbr_frames:
+                if frame_step == nbr_frames - 1:
                     break
 
-            Sofa.Simulation.animate(self.root_node, dt)
+            self.animate(dt)
             
             pbar_simu.update(1)
         pbar_simu.close()
@@ -508,22 +832,40 @@ class RegressionSceneData:
             return False
 
         # use the same way of computing errors as legacy mode
-        mean_total_error = 0.0
-        mean_error_by_dof = 0.0
-        for meca_id in range(nbr_meca):
-            mean_total_error += self.total_error[meca_id]
-            mean_error_by_dof += self.error_by_dof[meca_id]
-
-        mean_total_error = mean_total_error / float(nbr_meca)
-        mean_error_by_dof = mean_error_by_dof / float(nbr_meca)
-
-        if mean_error_by_dof > self.epsilon:
+        self.failed_fields = self.fields_exceeding_tolerance()
+        if self.criterion_exceeded(legacy=True) or self.failed_fields:
             self.regression_failed = True
             return False
 
         return True
 
 
+    def seek_replay(self, frame_index):
+        """Bring the replay to a key frame before opening the GUI.
+
+        The simulation cannot jump in time: it is advanced without rendering
+        up to the time of the key frame (e.g. the frame at which a compare
+        failed), then the references are set to this frame.
+        """
+        if len(self.replay_states) == 0:
+            return
+        keyframes = self.replay_states[0].keyframes
+        if not 0 <= frame_index < len(keyframes):
+            raise IndexError(f"key frame {frame_index} out of range [0, {len(keyframes) - 1}]")
+
+        dt = self.root_node.dt.value
+        target_step = int(round(float(keyframes.times[frame_index]) / dt))
+        pbar_simu = pbh.ProgressBarHandler(total=target_step, disable=self.disable_progress_bar)
+        pbar_simu.set_description(f"Simulate to key frame {frame_index}: " + self.file_scene_path)
+        for step in range(target_step):
+            self.animate(dt)
+            pbar_simu.update(1)
+        pbar_simu.close()
+
+        for replay_state in self.replay_states:
+            replay_state.seek(frame_index)
+
+
     def replay_references(self):
         
         # Import the GUI package
@@ -1,11 +1,22 @@
 import os
 import tools.RegressionSceneData as RegressionSceneData
+import tools.ErrorMetrics as ErrorMetrics
+import tools.FieldCapture as FieldCapture
 import tools.RegressionHelper as helper
 import tools.RegressionWorker as RegressionWorker
+import tools.Benchmark as Benchmark
+import tools.Codecs as Codecs
 from tools import ProgressBarHandler as pbh
 
 import re
 
+# The options of the list (e.g. codec=<codec>) and of its scenes (e.g.
+# timeout=<s>) are read from a file next to the list file, named after it with
+# this suffix. They cannot be written in the list file: Regression_test reads
+# the whole first line as the reference directory, and a sixth field of a scene
+# line as an integer, aborting on anything else.
+options_file_suffix = ".options"
+
 ## This class is responsible for loading a file.regression-tests to gather the list of scene to test with all arguments
 ## It will provide the API to launch the tests or write refs on all scenes contained in this file
 class RegressionSceneList:
@@ -18,12 +29,31 @@ class RegressionSceneList:
         self.filter = filter
         self.file_dir = os.path.dirname(file_path)
         self.scenes_data_sets = [] # List<RegressionSceneData>
+        self.scene_indices = [] # index of each scene among the scenes of the file, kept when the list is sharded
+        self.nbr_listed_scenes = 0 # number of scenes of the file passing the filter, before sharding
+        self.scene_results = {} # id_scene -> result of the worker, once applied
         self.nbr_errors = 0
         self.nbr_parsing_errors = 0 # number of lines of the list file that could not be used
+        self.parsing_error_messages = [] # and why
         self.ref_dir_path = None
+        self._messages = None # where parse_file() records the messages of the line being parsed
         self.disable_progress_bar = disable_progress_bar
         self.verbose = verbose
         self.legacy_mode = False
+        self.fork_server = None # RegressionWorker.ForkServer used to start the workers, if any
+        self.format = "JSON" # reference file format, see ReferenceFileIO.reference_formats
+        self.codec = None # compression of the written references, see Codecs. None for the default of the format
+        self.encoding = "raw" # encoding of the written BINARY references, see ReferenceFileIO.binary_encodings
+        self.precision = "float64" # storage precision of the written BINARY references
+        self.fail_fast = False # stop simulating a compared scene as soon as it fails
+        self.result_cache = None # ResultCache.ResultCache of passing compare results, if any
+        self.timing_history = None # TimingHistory.TimingHistory recording the time of each run, if any
+        self.batch_registry = None # BatchRegistry.BatchRegistry recording the scenes whose batch crashed, if any
+        self.timeout = None # default time limit of a scene in seconds, overridden by its "timeout" option
+        self.max_memory = None # default memory limit of a scene in MB, overridden by its "max_memory" option
+        self.profile = False # keep every timed event of the workers, to export a trace
+        self.benchmark_options = None # Benchmark.BenchmarkOptions of the benchmark mode
+        self.metrics = [] # metrics reported besides the criterion of each compared scene, see ErrorMetrics
 
 
     def get_nbr_scenes(self):
@@ -35,6 +65,9 @@ class RegressionSceneList:
     def get_nbr_parsing_errors(self):
         return self.nbr_parsing_errors
 
+    def get_nbr_killed(self):
+        return sum(1 for scene in self.scenes_data_sets if scene.killed is not None)
+
     def log_scenes_errors(self):
         for scene in self.scenes_data_sets:
             scene.log_errors()
@@ -43,31 +76,157 @@ class RegressionSceneList:
         self.legacy_mode = legacy_mode
 
 
-    def parsing_error(self, line_number, message):
-        """Report a line of the list file that cannot be used, and count it.
+    def parsing_error(self, line_number, message, file_path = None):
+        """Record a line of the list file (or of its options file, see
+        options_file_path()) that cannot be used. It is reported, and counted,
+        when the definition is applied (see apply_definition()).
 
         A malformed line only invalidates the scene it describes: it must never
         interrupt the parsing of the file, nor the whole regression run.
         """
-        self.nbr_parsing_errors = self.nbr_parsing_errors + 1
-        helper.writeError(f"{self.file_path}:{line_number}: {message}")
+        self._messages.append(["error", f"{file_path or self.file_path}:{line_number}: {message}"])
+
+    def parsing_warning(self, line_number, message, file_path = None):
+        self._messages.append(["warning", f"{file_path or self.file_path}:{line_number}: {message}"])
+
+    def options_file_path(self):
+        return self.file_path + options_file_suffix
+
+
+    def parse_scene_options(self, options, line_number):
+        """Parse the key=value options of a scene, given in the options file of the list.
+
+        Supported options:
+            timeout: time limit of the scene in seconds.
+            max_memory: resident memory limit of the scene in MB.
+            criterion: error metric compared to epsilon (see ErrorMetrics),
+                error_by_dof by default.
+            fields: fields captured and compared besides the positions, with
+                their tolerance, as <field>[:<tolerance>],... (see FieldCapture).
+
+        Returns:
+            dict: the options as keyword arguments of RegressionSceneData, or
+            None if an option is invalid. In that case the error has already
+            been recorded.
+        """
+        options_path = self.options_file_path()
+        parsed = {}
+        for option in options:
+            key, sep, value = option.partition("=")
+            if not sep or key not in ("timeout", "max_memory", "criterion", "fields"):
+                self.parsing_warning(line_number, f"unknown option '{option}', expecting "
+                                                  f"timeout=<seconds>, max_memory=<MB>, criterion=<metric> or "
+                                                  f"fields=<field>[:<tolerance>],... It is ignored.", options_path)
+                continue
+            if key == "fields":
+                try:
+                    parsed[key] = FieldCapture.parse_fields(value)
+                except ValueError as e:
+                    self.parsing_error(line_number, f"invalid fields: {e}. Skipping this scene.", options_path)
+                    return None
+                continue
+            if key == "criterion":
+                if value not in ErrorMetrics.metric_names:
+                    self.parsing_error(line_number, f"unknown criterion '{value}', expecting one of: "
+                                                    f"{', '.join(ErrorMetrics.metric_names)}. Skipping this scene.",
+                                       options_path)
+                    return None
+                parsed[key] = value
+                continue
+            try:
+                parsed[key] = float(value)
+            except ValueError:
+                parsed[key] = -1.0
+            if parsed[key] <= 0:
+                self.parsing_error(line_number, f"{key} must be a strictly positive number, got '{value}'. "
+                                                f"Skipping this scene.", options_path)
+                return None
+        return parsed
+
+    def parse_options_file(self):
+        """Read the options file of the list, if any (see options_file_path()).
+
+        A line starting with a key=value option holds options of the list
+        (see parse_list_options()). The other lines hold the path of a scene,
+        as written in the list file, followed by its key=value options (see
+        parse_scene_options()). Regression_test does not read this file.
+
+        Returns:
+            dict: the normalized path of each scene -> (line number, options).
+        """
+        scene_options = {}
+        options_path = self.options_file_path()
+        try:
+            with open(options_path, 'r') as the_file:
+                data = the_file.readlines()
+        except FileNotFoundError:
+            return scene_options
+
+        for idx, line in enumerate(data):
+            line_number = idx + 1
+            if line.startswith("#"):
+                continue
+            values = line.split()
+            if len(values) == 0:
+                continue
+            if "=" in values[0]:
+                self.parse_list_options(values, line_number)
+                continue
+
+            scene_path = os.path.normpath(os.path.join(self.file_dir, values[0]))
+            if scene_path in scene_options:
+                self.parsing_warning(line_number, f"the options of {values[0]} are already given at line "
+                                                  f"{scene_options[scene_path][0]}. They are ignored.", options_path)
+                continue
+            scene_options[scene_path] = (line_number, values[1:])
+        return scene_options
 
+    def parse_list_options(self, options, line_number):
+        """Parse the key=value options of the list, given in its options file.
 
-    def parse_scene_line(self, values, line_number):
+        Supported options:
+            codec: compression of the references written for this tree, as
+                <name>[:<level>] (see Codecs). Overridden by --codec.
+        """
+        for option in options:
+            key, sep, value = option.partition("=")
+            if not sep or key != "codec":
+                self.parsing_warning(line_number, f"unknown option '{option}', expecting "
+                                                  f"codec=<name>[:<level>]. It is ignored.", self.options_file_path())
+                continue
+            try:
+                Codecs.parse_codec(value)
+            except ValueError as e:
+                self.parsing_warning(line_number, f"{e}. It is ignored.", self.options_file_path())
+                continue
+            self.codec = value
+
+    def parse_scene_line(self, values, line_number, scene_options = None):
         """Parse one scene line of the list file.
 
         Args:
             values (list): the whitespace separated fields of the line.
             line_number (int): line number in the list file, for error reporting.
+            scene_options (tuple): line number and options of the scene in the
+                options file of the list, None if it has none there.
 
         Returns:
-            RegressionSceneData: the described scene, or None if the line is
-            invalid. In that case the error has already been reported.
+            dict: the keyword arguments of the RegressionSceneData of the
+            scene, or None if the line is invalid. In that case the error has
+            already been recorded.
         """
         expected_fields = "<scene path> <steps> <epsilon> <meca_in_mapping> <dump_number_step>"
         if len(values) > 5:
-            helper.writeWarning(f"{self.file_path}:{line_number}: expecting at most 5 fields "
-                                f"({expected_fields}), got {len(values)}. Extra fields are ignored.")
+            message = f"expecting at most 5 fields ({expected_fields}), got {len(values)}. Extra fields are ignored."
+            if any("=" in value for value in values[5:]):
+                message += (f" The options of a scene (e.g. criterion=<metric>) must be given in {self.options_file_path()}: "
+                            f"Regression_test aborts on them.")
+            self.parsing_warning(line_number, message)
+        options = {}
+        if scene_options is not None:
+            options = self.parse_scene_options(scene_options[1], scene_options[0])
+            if options is None:
+                return None
 
         steps = 1000
         epsilon = 0.0001
@@ -75,8 +234,8 @@ class RegressionSceneList:
         dump_number_step = 1
 
         if len(values) < 2:
-            helper.writeWarning(f"{self.file_path}:{line_number}: cannot evaluate steps. "
-                                f"Default value {steps} will be used instead.")
+            self.parsing_warning(line_number, f"cannot evaluate steps. "
+                                              f"Default value {steps} will be used instead.")
         else:
             try:
                 steps = int(values[1])
@@ -90,8 +249,8 @@ class RegressionSceneList:
                 return None
 
         if len(values) < 3:
-            helper.writeWarning(f"{self.file_path}:{line_number}: cannot evaluate epsilon. "
-                                f"Default value {epsilon} will be used instead.")
+            self.parsing_warning(line_number, f"cannot evaluate epsilon. "
+                                              f"Default value {epsilon} will be used instead.")
         else:
             try:
                 epsilon = float(values[2])
@@ -105,8 +264,8 @@ class RegressionSceneList:
                 return None
 
         if len(values) < 4:
-            helper.writeWarning(f"{self.file_path}:{line_number}: cannot evaluate meca_in_mapping. "
-                                f"Default value {meca_in_mapping} will be used instead.")
+            self.parsing_warning(line_number, f"cannot evaluate meca_in_mapping. "
+                                              f"Default value {meca_in_mapping} will be used instead.")
         elif values[3] not in ('0', '1'):
             self.parsing_error(line_number, f"meca_in_mapping must be 0 or 1, got '{values[3]}'. "
                                             f"Expecting: {expected_fields}. Skipping this scene.")
@@ -115,8 +274,8 @@ class RegressionSceneList:
             meca_in_mapping = (values[3] == '1')  # converting string to Bool always gives True
 
         if len(values) < 5:
-            helper.writeWarning(f"{self.file_path}:{line_number}: cannot evaluate dump_number_step. "
-                                f"Default value {dump_number_step} will be used instead.")
+            self.parsing_warning(line_number, f"cannot evaluate dump_number_step. "
+                                              f"Default value {dump_number_step} will be used instead.")
         else:
             try:
                 dump_number_step = int(values[4])
@@ -138,15 +297,35 @@ class RegressionSceneList:
 
         full_ref_file_path = os.path.normpath(os.path.join(self.ref_dir_path, values[0]))
 
-        return RegressionSceneData.RegressionSceneData(full_file_path, full_ref_file_path,
-                                                       steps, epsilon, meca_in_mapping, dump_number_step,
-                                                       self.disable_progress_bar, self.verbose)
+        return dict(file_scene_path=full_file_path, file_ref_path=full_ref_file_path, steps=steps, epsilon=epsilon,
+                    meca_in_mapping=meca_in_mapping, dump_number_step=dump_number_step, **options)
 
 
-    def process_file(self):
+    def parse_file(self):
+        """Parse the list file into a plain data definition.
+
+        Nothing is reported nor created here: every message is recorded in the
+        definition, so that list files can be parsed concurrently and their
+        definitions reused while the file and the directories it refers to are
+        unchanged (see DiscoveryIndex). The filter is not applied either.
+
+        Returns:
+            dict: "ref_dir_path", "codec", the "messages" of the reference
+            directory line and of the options file, and the "lines" of the
+            scenes: their "line_number", "scene" path, "messages" and
+            RegressionSceneData "arguments" (None if the line is invalid).
+            "dependencies" lists what the definition depends on.
+        """
+        definition = {"ref_dir_path": None, "codec": None, "messages": [], "lines": [],
+                      "dependencies": {"regression_dir": os.environ.get("REGRESSION_DIR"), "directories": [],
+                                       "files": [self.options_file_path()]}}
+        self._messages = definition["messages"]
+        directories = {self.file_dir}
+        scene_options = self.parse_options_file()
+        used_options = set()
+
         with open(self.file_path, 'r') as the_file:
             data = the_file.readlines()
-        the_file.close()
         
         count = 0
         for idx, line in enumerate(data):
@@ -167,50 +346,340 @@ class RegressionSceneList:
                         self.parsing_error(line_number, f"the environment variable $REGRESSION_DIR is required but not set. "
                                                         f"Please set this variable to the root directory of your regression tests to proceed. "
                                                         f"No scene of this file will be processed.")
-                        return
+                        break
                 else: # direct absolute or relative path
                     self.ref_dir_path = os.path.join(self.file_dir, values[0])
                     self.ref_dir_path = os.path.abspath(self.ref_dir_path)
 
+                directories.add(os.path.dirname(self.ref_dir_path))
                 if not os.path.isdir(self.ref_dir_path):
                     self.parsing_error(line_number, f"reference directory does not exist: {self.ref_dir_path}. "
                                                     f"No scene of this file will be processed.")
-                    return
-
-                if self.verbose:
-                    helper.writeLog(f'Reference directory mentioned by file \'{self.file_path}\': {self.ref_dir_path}')
+                    break
+
+                definition["ref_dir_path"] = self.ref_dir_path
+                if len(values) > 1:
+                    self.parsing_warning(line_number, f"unexpected '{' '.join(values[1:])}' after the reference directory, "
+                                                      f"Regression_test reads the whole line as the reference directory. "
+                                                      f"The options of the list must be given in {self.options_file_path()}. "
+                                                      f"It is ignored.")
+                self._messages.append(["log", f'Reference directory mentioned by file \'{self.file_path}\': {self.ref_dir_path}'])
                 count = count + 1
                 continue
 
-            if self.filter is not None and re.search(self.filter, values[0]) is None:
+            # An invalid line is reported and skipped: the other scenes of the
+            # file must still be processed.
+            scene_path = os.path.normpath(os.path.join(self.file_dir, values[0]))
+            scene_line = {"line_number": line_number, "scene": values[0], "messages": []}
+            self._messages = scene_line["messages"]
+            scene_line["arguments"] = self.parse_scene_line(values, line_number, scene_options.get(scene_path))
+            used_options.add(scene_path)
+            # a scene file appearing or disappearing changes the mtime of its directory
+            directories.add(os.path.dirname(scene_path))
+            definition["lines"].append(scene_line)
+
+        definition["codec"] = self.codec
+        self._messages = definition["messages"]
+        for scene_path, (line_number, options) in scene_options.items():
+            # no scene is read when the reference directory is invalid
+            if definition["ref_dir_path"] is not None and scene_path not in used_options:
+                self.parsing_warning(line_number, f"{scene_path} is not a scene of {self.file_path}. "
+                                                  f"Its options are ignored.", self.options_file_path())
+        self._messages = None
+        definition["dependencies"]["directories"] = sorted(directories)
+        return definition
+
+    def apply_definition(self, definition):
+        """Report the messages of a definition from parse_file() and create the
+        RegressionSceneData of its scenes which pass the filter."""
+        self.ref_dir_path = definition["ref_dir_path"]
+        self.codec = definition["codec"]
+        self.report_messages(definition["messages"])
+
+        for scene_line in definition["lines"]:
+            if self.filter is not None and re.search(self.filter, scene_line["scene"]) is None:
                 if self.verbose:
-                    helper.writeLog(f'Filtered out {self.filter}: {values[0]}')
+                    helper.writeLog(f'Filtered out {self.filter}: {scene_line["scene"]}')
                 continue
 
-            # An invalid line is reported and skipped: the other scenes of the
-            # file must still be processed.
-            scene_data = self.parse_scene_line(values, line_number)
-            if scene_data is None:
+            self.report_messages(scene_line["messages"])
+            if scene_line["arguments"] is None:
                 continue
 
+            scene_data = RegressionSceneData.RegressionSceneData(**scene_line["arguments"],
+                                                                 disable_progress_bar=self.disable_progress_bar,
+                                                                 verbose=self.verbose)
             #scene_data.printInfo()
+            self.scene_indices.append(len(self.scenes_data_sets))
             self.scenes_data_sets.append(scene_data)
+        self.nbr_listed_scenes = len(self.scenes_data_sets)
+
+    def report_messages(self, messages):
+        for kind, message in messages:
+            if kind == "error":
+                self.nbr_parsing_errors = self.nbr_parsing_errors + 1
+                self.parsing_error_messages.append(message)
+                helper.writeError(message)
+            elif kind == "warning":
+                helper.writeWarning(message)
+            elif self.verbose:
+                helper.writeLog(message)
 
+    def process_file(self):
+        self.apply_definition(self.parse_file())
 
-    def write_references(self, id_scene, print_log = False):
+
+    def lookup_cached_result(self, id_scene, mode):
+        """A scene whose inputs did not change since it last passed is not run again.
+
+        Returns:
+            (str, dict): the cache key of the scene (None if the cache is not
+            used) and its cached result (None if it must be run).
+        """
+        if mode != "compare" or self.result_cache is None:
+            return None, None
+        try:
+            cache_key = self.result_cache.scene_key(self.scenes_data_sets[id_scene], self.format, self.legacy_mode)
+        except OSError:
+            return None, None # missing reference: let the worker report it
+        cached_result = self.result_cache.lookup(cache_key)
+        if cached_result is not None:
+            cached_result["cached"] = True
+        return cache_key, cached_result
+
+    def scene_limits(self, id_scene):
+        """Time (s) and memory (bytes) limits of a scene, None where it has none."""
         scene = self.scenes_data_sets[id_scene]
-        if self.verbose:
-            helper.writeLog(f'Writing reference files for {scene.file_scene_path}.')
+        timeout = scene.timeout if scene.timeout is not None else self.timeout
+        max_memory = scene.max_memory if scene.max_memory is not None else self.max_memory
+        return timeout, int(max_memory * 2**20) if max_memory is not None else None
+
+    def worker_options(self, mode, disable_progress_bar = None):
+        """Keyword arguments of the RegressionWorker functions running scenes of this list."""
+        return dict(legacy=(mode == "compare" and self.legacy_mode),
+                    disable_progress_bar=self.disable_progress_bar if disable_progress_bar is None else disable_progress_bar,
+                    verbose=self.verbose, format=self.format, fork_server=self.fork_server,
+                    fail_fast=(mode == "compare" and self.fail_fast), profile=self.profile,
+                    benchmark_options=self.benchmark_options if mode == "benchmark" else None,
+                    codec=self.codec if mode == "write" else None,
+                    encoding=self.encoding if mode == "write" else "raw",
+                    precision=self.precision if mode == "write" else "float64",
+                    metrics=self.metrics if mode == "compare" else None)
+
+    def run_scene(self, id_scene, mode, disable_progress_bar = None, on_message = None, cancel = None):
+        """Run one scene of this list in its own worker process.
+
+        This only launches the worker and returns its raw result: it does not
+        touch the error counters, so it can safely be called concurrently for
+        several scenes. Use apply_result() afterwards to account for it.
+
+        Args:
+            id_scene (int): index of the scene in this list.
+            mode (str): "write", "compare" or "benchmark".
+            disable_progress_bar (bool): overrides the list setting for the
+                worker (progress bars of concurrent workers would interleave).
+            on_message (callable): called with each message of the worker, see
+                RegressionWorker.run_scene_in_subprocess().
+            cancel (threading.Event): the worker is stopped once it is set.
+
+        Returns:
+            dict: the result reported by the worker.
+        """
+        cache_key, cached_result = self.lookup_cached_result(id_scene, mode)
+        if cached_result is not None:
+            return cached_result
+
+        timeout, max_memory = self.scene_limits(id_scene)
+        if mode == "benchmark":
+            return self.run_benchmark(id_scene, timeout, max_memory, disable_progress_bar, on_message, cancel)
 
-        # Each scene is written in its own process to guarantee a clean SOFA
-        # state (SOFA does not fully reset global state between load/unload).
+        # Each scene is run in its own process to guarantee a clean SOFA
+        # state (SOFA does not fully reset global state between load/unload),
+        # identical for the write and the compare passes.
         result = RegressionWorker.run_scene_in_subprocess(
-            scene, mode="write",
-            disable_progress_bar=self.disable_progress_bar, verbose=self.verbose)
+            self.scenes_data_sets[id_scene], mode=mode, timeout=timeout, max_memory=max_memory,
+            on_message=on_message, cancel=cancel, **self.worker_options(mode, disable_progress_bar))
+        if cache_key is not None:
+            result["cache_key"] = cache_key
+        return result
+
+    def run_benchmark(self, id_scene, timeout, max_memory, disable_progress_bar, on_message, cancel):
+        """Benchmark a scene, running each repeat in its own worker (see Benchmark).
+        The limits apply to each worker. The first failed repeat is the result."""
+        options = self.worker_options("benchmark", disable_progress_bar)
+        options["benchmark_options"] = Benchmark.BenchmarkOptions(self.benchmark_options.warmup, 1)
+        results = []
+        for repeat in range(self.benchmark_options.repeats):
+            result = RegressionWorker.run_scene_in_subprocess(
+                self.scenes_data_sets[id_scene], mode="benchmark", timeout=timeout, max_memory=max_memory,
+                on_message=on_message, cancel=cancel, **options)
+            if not result.get("ok", False):
+                return result
+            results.append(result)
+        return Benchmark.merge_repeat_results(results)
+
+    def run_batch(self, ids_scene, mode, disable_progress_bar = None, on_message = None, cancel = None):
+        """Run several scenes of this list one after another in the same worker.
+
+        The scenes must have been verified batchable (see BatchRegistry). Like
+        run_scene(), this only returns the raw results.
 
-        if not result.get("ok", False):
+        Args:
+            ids_scene (list): indices of the scenes in this list, in run order.
+            mode (str): "write" or "compare".
+            disable_progress_bar (bool), on_message (callable), cancel (threading.Event):
+                see run_scene().
+
+        Returns:
+            list: the result of each scene.
+        """
+        results = [None] * len(ids_scene)
+        batch = [] # (position in ids_scene, cache key) of the scenes to run
+        for position, id_scene in enumerate(ids_scene):
+            cache_key, results[position] = self.lookup_cached_result(id_scene, mode)
+            if results[position] is None:
+                batch.append((position, cache_key))
+        if len(batch) <= 1:
+            for position, cache_key in batch:
+                results[position] = self.run_scene(ids_scene[position], mode, disable_progress_bar, on_message, cancel)
+            return results
+
+        batch_results = RegressionWorker.run_batch_in_subprocess(
+            [self.scenes_data_sets[ids_scene[position]] for position, cache_key in batch], mode=mode,
+            scene_limits=[self.scene_limits(ids_scene[position]) for position, cache_key in batch],
+            on_message=on_message, cancel=cancel, **self.worker_options(mode, disable_progress_bar))
+
+        if None in batch_results and self.batch_registry is not None:
+            # the batch crashed while running this scene: it must not be batched again
+            crashed_scene = self.scenes_data_sets[ids_scene[batch[batch_results.index(None)][0]]]
+            try:
+                self.batch_registry.record(crashed_scene, False, "its batch crashed while running it")
+            except OSError:
+                pass
+
+        for (position, cache_key), result in zip(batch, batch_results):
+            if result is None:
+                # the batch stopped before (or while) running this scene: run it alone
+                # with its own limits, to know its outcome
+                result = self.run_scene(ids_scene[position], mode, disable_progress_bar, on_message, cancel)
+            elif cache_key is not None:
+                result["cache_key"] = cache_key
+            results[position] = result
+        return results
+
+    def apply_result(self, id_scene, mode, result):
+        if mode == "write":
+            self.apply_write_result(id_scene, result)
+        elif mode == "benchmark":
+            self.apply_benchmark_result(id_scene, result)
+        else:
+            self.apply_compare_result(id_scene, result)
+
+    def keep_scenes(self, ids_scene):
+        """Only keep the given scenes in the list (e.g. the ones of a shard)."""
+        self.scenes_data_sets = [self.scenes_data_sets[i] for i in ids_scene]
+        self.scene_indices = [self.scene_indices[i] for i in ids_scene]
+
+    def apply_write_result(self, id_scene, result):
+        scene = self.scenes_data_sets[id_scene]
+        self.scene_results[id_scene] = result
+        if self.timing_history is not None:
+            self.timing_history.record(scene, result)
+        if result.get("killed") is not None:
+            scene.apply_killed_result(result)
+            helper.writeError(f"Killed while writing references for {scene.file_scene_path}: {result.get('error')}")
+        elif not result.get("ok", False):
             helper.writeError(f"While writing references for {scene.file_scene_path}: {result.get('error')}")
 
+    def apply_compare_result(self, id_scene, result):
+        scene = self.scenes_data_sets[id_scene]
+        self.scene_results[id_scene] = result
+        if self.timing_history is not None:
+            self.timing_history.record(scene, result)
+        if result.get("killed") is not None:
+            # The scene exceeded its time or memory limit.
+            self.nbr_errors = self.nbr_errors + 1
+            scene.apply_killed_result(result)
+            helper.writeError(f"Killed while comparing {scene.file_scene_path}: {result.get('error')}")
+            return
+        if not result.get("ok", False):
+            # Hard failure (scene could not be loaded / worker crashed).
+            self.nbr_errors = self.nbr_errors + 1
+            helper.writeError(f"While trying to compare {scene.file_scene_path}: {result.get('error')}")
+            return
+
+        # Bring the worker's outcome back so log_errors() reports it as usual.
+        scene.apply_worker_result(result)
+        if not result.get("result", False):
+            self.nbr_errors = self.nbr_errors + 1
+        elif self.result_cache is not None and result.get("cache_key") is not None:
+            self.result_cache.store(result["cache_key"], scene.file_scene_path, result)
+
+
+    def apply_benchmark_result(self, id_scene, result):
+        """Compare the step times of a benchmark with the baseline of the scene,
+        or write the baseline if there is none yet (or if asked to update it).
+
+        The verdict is added to the result, so that results merged from
+        several shards are not compared again.
+        """
+        scene = self.scenes_data_sets[id_scene]
+        self.scene_results[id_scene] = result
+        if result.get("killed") is not None:
+            self.nbr_errors = self.nbr_errors + 1
+            scene.apply_killed_result(result)
+            helper.writeError(f"Killed while benchmarking {scene.file_scene_path}: {result.get('error')}")
+            return
+        if not result.get("ok", False):
+            self.nbr_errors = self.nbr_errors + 1
+            helper.writeError(f"While trying to benchmark {scene.file_scene_path}: {result.get('error')}")
+            return
+
+        if "benchmark_status" not in result:
+            try:
+                baseline = None if self.benchmark_options.update_baselines else Benchmark.read_baseline(scene)
+                if baseline is None:
+                    baseline = Benchmark.write_baseline(scene, self.benchmark_options, result["statistics"])
+                    result["benchmark_status"] = "baseline written"
+                elif baseline["steps"] != scene.steps:
+                    raise ValueError(f"baseline recorded with {baseline['steps']} steps instead of {scene.steps}, "
+                                     f"update it with --write-references")
+                else:
+                    machine = Benchmark.other_machine(baseline)
+                    if machine is not None:
+                        helper.writeWarning(f"The benchmark baseline of {scene.file_scene_path} was written on {machine}, "
+                                            f"not on this machine: its step times are not comparable.")
+                    regressed, result["change"] = Benchmark.compare_with_baseline(result["statistics"], baseline["statistics"],
+                                                                                  self.benchmark_options)
+                    result["benchmark_status"] = "regressed" if regressed else "passed"
+                result["baseline"] = baseline["statistics"]
+            except (OSError, ValueError, KeyError) as e:
+                result["ok"] = False
+                result["error"] = f"Invalid benchmark baseline {Benchmark.baseline_path(scene)}: {e}"
+                self.nbr_errors = self.nbr_errors + 1
+                helper.writeError(f"While trying to benchmark {scene.file_scene_path}: {result['error']}")
+                return
+
+        scene.apply_benchmark_result(result)
+        if result["benchmark_status"] == "regressed":
+            self.nbr_errors = self.nbr_errors + 1
+
+    def log_scene_start(self, id_scene, mode):
+        """With --verbose, log that a scene starts to be run."""
+        if not self.verbose:
+            return
+        scene = self.scenes_data_sets[id_scene]
+        if mode == "write":
+            helper.writeLog(f'Writing reference files for {scene.file_scene_path}.')
+        else:
+            scene.print_info()
+
+    def write_references(self, id_scene, print_log = False):
+        self.log_scene_start(id_scene, "write")
+
+        result = self.run_scene(id_scene, "write")
+        self.apply_write_result(id_scene, result)
+
     def write_all_references(self):
         nbr_scenes = len(self.scenes_data_sets)
 
@@ -227,48 +696,72 @@ class RegressionSceneList:
 
 
     def compare_references(self, id_scene):
-        scene = self.scenes_data_sets[id_scene]
-        if self.verbose:
-            scene.print_info()
+        self.log_scene_start(id_scene, "compare")
 
-        # Each scene is compared in its own process to guarantee a clean SOFA
-        # state, identical to the one used when the references were written.
-        result = RegressionWorker.run_scene_in_subprocess(
-            scene, mode="compare", legacy=self.legacy_mode,
-            disable_progress_bar=self.disable_progress_bar, verbose=self.verbose)
+        result = self.run_scene(id_scene, "compare")
+        self.apply_compare_result(id_scene, result)
+        
 
-        if not result.get("ok", False):
-            # Hard failure (scene could not be loaded / worker crashed).
-            self.nbr_errors = self.nbr_errors + 1
-            helper.writeError(f"While trying to compare {scene.file_scene_path}: {result.get('error')}")
-            return
+    def compare_all_references(self, max_errors = None):
+        """Compare all the scenes of the list.
 
-        # Bring the worker's outcome back so log_errors() reports it as usual.
-        scene.apply_worker_result(result)
-        if not result.get("result", False):
-            self.nbr_errors = self.nbr_errors + 1
-        
+        Args:
+            max_errors (int): if set, stop once this list has reached this
+                number of errors; the remaining scenes are not run.
 
-    def compare_all_references(self):
+        Returns:
+            int: the number of scenes compared.
+        """
         nbr_scenes = len(self.scenes_data_sets)
         pbar_scenes = pbh.ProgressBarHandler(total=nbr_scenes, disable=self.disable_progress_bar)
         pbar_scenes.set_description("Compare all scenes from: " + self.file_path)
         
+        nbr_compared = 0
         for i in range(0, nbr_scenes):
+            if max_errors is not None and self.nbr_errors >= max_errors:
+                self.scenes_data_sets[i].skipped = True
+                continue
             self.compare_references(i)
+            nbr_compared = nbr_compared + 1
+            pbar_scenes.update(1)
+        pbar_scenes.close()
+
+        return nbr_compared
+
+
+    def benchmark_all_references(self):
+        nbr_scenes = len(self.scenes_data_sets)
+        pbar_scenes = pbh.ProgressBarHandler(total=nbr_scenes, disable=self.disable_progress_bar)
+        pbar_scenes.set_description("Benchmark all scenes from: " + self.file_path)
+
+        for i in range(0, nbr_scenes):
+            self.log_scene_start(i, "benchmark")
+            self.apply_benchmark_result(i, self.run_scene(i, "benchmark"))
             pbar_scenes.update(1)
         pbar_scenes.close()
 
         return nbr_scenes
 
 
-    def replay_references(self, id_scene):
+    def replay_references(self, id_scene, frame = None):
+        """Open the GUI on a scene with its references displayed aside.
+
+        Args:
+            frame (int): key frame to start the replay at, instead of t=0.
+        """
         if (id_scene < 0 or id_scene >= len(self.scenes_data_sets)):
             helper.writeError(f'Id of the scene given for replay: {id_scene} is out of range [0, {len(self.scenes_data_sets) - 1}] from input regression list file.')
             return
 
-        self.scenes_data_sets[id_scene].load_scene()
-        self.scenes_data_sets[id_scene].add_compare_state()
-        self.scenes_data_sets[id_scene].replay_references()
+        scene = self.scenes_data_sets[id_scene]
+        scene.load_scene(self.format)
+        scene.add_compare_state(self.format)
+        if frame is not None:
+            try:
+                scene.seek_replay(frame)
+            except IndexError as e:
+                helper.writeError(f'Replay of {scene.file_scene_path}: {e}')
+                return
+        scene.replay_references()
         
         
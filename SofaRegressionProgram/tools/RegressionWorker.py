@@ -15,63 +15,334 @@ write pass and the compare pass always see identical conditions.
 
 This module has two roles:
   * Parent side: `run_scene_in_subprocess()` spawns a child for one scene and
-    marshals the result back through a temporary JSON file.
+    reads what it reports on a dedicated pipe (see ResultChannel).
   * Child side: executed as `python RegressionWorker.py ...`, it sets up the
-    SOFA environment, runs a single scene (write or compare) and writes its
-    result to the file given by `--result-file`.
+    SOFA environment, runs a single scene (write or compare) and streams its
+    progress and result to the pipe given by `--result-fd`.
 
-Only the standard library is imported at module top-level so that importing
-this module in the parent does NOT import SOFA (the parent must never load or
-simulate a scene, otherwise the isolation would be defeated).
+A scene can be given a wall-clock time limit and a resident memory limit: the
+process running it is watched while it runs and killed as soon as one of them
+is exceeded, so that a hanging or leaking scene cannot block the whole run.
+Such a kill is reported as a distinct outcome ("killed").
+
+Spawning a fresh interpreter per scene means paying the Python startup, the
+SOFA import and the plugin loading for every scene. When fork() is available,
+a `ForkServer` (the "zygote") can be started instead: it is executed as
+`python RegressionWorker.py --fork-server`, imports SOFA and loads the plugins
+once without ever loading a scene, and then forks one fresh child per scene.
+Each scene still runs in its own process, started from a state in which no
+scene has ever been simulated, so the isolation is kept. When fork() is not
+available (or the server cannot start), scenes are spawned as before.
+
+Scenes verified to give bit-identical results whether they run alone or after
+other scenes (see BatchRegistry) can also be run as a batch: one worker
+(`python RegressionWorker.py --batch`, or one child of the fork server) reads
+the arguments of several scenes on its stdin and runs them one after another,
+each one loaded and unloaded in turn. The startup, SOFA import and plugin
+loading are then paid once per batch instead of once per scene. Each scene of
+a batch keeps its own limits: the parent follows the scene being run from
+the messages of the worker, and kills the batch as soon as this scene
+exceeds its limits.
+
+Only the standard library (and ResultChannel and RegressionHelper, which only
+use it) is imported at module top-level so that importing this module in the
+parent does NOT import SOFA (the parent must never load or simulate a scene, otherwise the
+isolation would be defeated).
 """
 
 import os
 import sys
 import json
+import time
+import signal
+import select
+import socket
 import argparse
+import threading
 import subprocess
-import tempfile
 
+if __name__ == "__main__":
+    # executed as a worker: make the tools package importable (program root = parent of this dir)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tools.ResultChannel as ResultChannel
+import tools.RegressionHelper as helper
 
-def _safe_remove(path):
+
+def _read_rss(pid):
+    """Current resident memory of a process in bytes, None where it cannot be read."""
     try:
-        os.remove(path)
-    except OSError:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
         pass
+    return None
 
 
-# --------------------------------------------------
-# Parent side: spawn one child process for one scene
-# --------------------------------------------------
-def run_scene_in_subprocess(scene_data, mode, legacy=False,
-                            disable_progress_bar=False, verbose=False,
-                            format="JSON", python_exe=None):
-    """Run a single scene (write or compare) in an isolated child process.
+def memory_limit_is_enforced():
+    """Whether the resident memory of a process can be read on this platform
+    (it needs /proc), and hence whether memory limits can be enforced."""
+    return _read_rss(os.getpid()) is not None
 
-    Args:
-        scene_data: the RegressionSceneData describing the scene to run.
-        mode (str): "write" to generate references, "compare" to check them.
-        legacy (bool): use the legacy reference format (compare only).
-        disable_progress_bar (bool): forwarded to the child.
-        verbose (bool): forwarded to the child.
-        format (str): reference file format ("JSON" or "CSV").
-        python_exe (str): interpreter to use for the child (defaults to the
-            current one).
+
+def _maxrss_bytes(rusage):
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+
+
+class ProcessLimits:
+    """Wall-clock time and resident memory limits of one worker process.
+
+    check() is called periodically while the process runs and tells whether it
+    must be killed. The peak memory is tracked at the same time.
+
+    A worker running a batch has the limits of the scene it is running: the
+    ones of the next scene apply from start_scene(), and its time is counted
+    from there.
+    """
+    poll_interval = 0.05  # seconds
+
+    def __init__(self, timeout=None, max_memory=None, scene_limits=None):
+        """
+        Args:
+            timeout (float): maximum wall-clock time in seconds, None for no limit.
+            max_memory (int): maximum resident memory in bytes, None for no limit.
+            scene_limits (list): (timeout, max_memory) of each scene of a batch,
+                in run order, instead of timeout and max_memory.
+        """
+        self.scene_limits = scene_limits
+        self.scene = 0 # index of the scene being run in the batch
+        self.timeout, self.max_memory = (timeout, max_memory) if scene_limits is None else scene_limits[0]
+        self.start_time = time.monotonic()
+        self.peak_memory = 0
+        self.killed = None  # "timeout" or "memory" once the process has been killed
+
+    def is_limited(self):
+        if self.scene_limits is not None:
+            return any(timeout is not None or max_memory is not None for timeout, max_memory in self.scene_limits)
+        return self.timeout is not None or self.max_memory is not None
+
+    def start_scene(self, scene):
+        """The worker of a batch started running the given scene. The first one
+        is timed from the launch of the worker, as a scene run alone."""
+        if self.scene_limits is None or scene == self.scene:
+            return
+        self.start_time = time.monotonic()
+        self.timeout, self.max_memory = self.scene_limits[scene]
+        self.scene = scene
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def check(self, pid):
+        """Return the reason why the process must be killed, or None."""
+        rss = _read_rss(pid)
+        if rss is not None:
+            self.peak_memory = max(self.peak_memory, rss)
+        if self.timeout is not None and self.elapsed() > self.timeout:
+            return "timeout"
+        if self.max_memory is not None and rss is not None and rss > self.max_memory:
+            return "memory"
+        return None
+
+    def killed_result(self, elapsed=None, peak_memory=None):
+        elapsed = self.elapsed() if elapsed is None else elapsed
+        peak_memory = self.peak_memory if peak_memory is None else peak_memory
+        if self.killed == "timeout":
+            reason = f"time limit of {self.timeout} s exceeded"
+        else:
+            reason = f"memory limit of {self.max_memory / 2**20:.0f} MB exceeded"
+        return {"ok": False, "killed": self.killed, "elapsed": elapsed, "peak_memory": peak_memory,
+                "error": f"Killed after {elapsed:.1f} s, {reason} (peak memory {peak_memory / 2**20:.0f} MB)."}
+
+
+def _wait_spawned(process, limits, cancel=None):
+    """Wait for a spawned worker, killing it as soon as it exceeds its limits
+    or the run is cancelled.
 
     Returns:
-        dict: the result reported by the child. Always contains an "ok" key.
-              For compare runs it also contains "result", "regression_failed",
-              "nbr_tested_frame", "total_run_time", "error_by_dof" and
-              "total_error".
+        (int, bool): the exit code of the process, and whether it was cancelled.
     """
-    python_exe = python_exe or sys.executable
-    worker_path = os.path.abspath(__file__)
+    if not limits.is_limited() and cancel is None:
+        return process.wait(), False
+
+    cancelled = False
+    while True:
+        if hasattr(os, "wait4"):
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                process.returncode = os.waitstatus_to_exitcode(status)
+                limits.peak_memory = max(limits.peak_memory, _maxrss_bytes(rusage))
+                return process.returncode, cancelled
+        elif process.poll() is not None:
+            # only the time limit can be enforced on this platform
+            return process.returncode, cancelled
+        if not cancelled and cancel is not None and cancel.is_set():
+            cancelled = True
+            process.kill()
+        elif limits.killed is None and limits.is_limited():
+            limits.killed = limits.check(process.pid)
+            if limits.killed is not None:
+                process.kill()
+        time.sleep(limits.poll_interval)
+
+
+def fork_is_available():
+    """Whether the fork-server mode can be used on this platform."""
+    return hasattr(os, "fork") and sys.platform != "win32"
+
+
+# --------------------------------------------------
+# Parent side: warm fork server
+# --------------------------------------------------
+class ForkServer:
+    """Parent-side handle of a warm worker process that forks one child per scene.
+
+    Requests are sent as JSON lines on the server stdin, replies come back as
+    JSON lines on a dedicated pipe (stdout/stderr stay inherited so SOFA logs
+    behave as with spawned workers). The write end of the result channel of
+    each request is passed to the server through a Unix socket, so that the
+    forked child reports directly to the parent. `submit()` is thread-safe so
+    the server can be shared by all the threads of a parallel run.
+    """
+
+    def __init__(self, python_exe=None, preload_plugins=()):
+        python_exe = python_exe or sys.executable
+        worker_path = os.path.abspath(__file__)
+
+        reply_read_fd, reply_write_fd = os.pipe()
+        self.channels, server_channels = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        cmd = [python_exe, worker_path, "--fork-server", "--reply-fd", str(reply_write_fd),
+               "--channel-fd", str(server_channels.fileno())]
+        for plugin in preload_plugins:
+            cmd.extend(["--preload-plugin", plugin])
+
+        try:
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                            pass_fds=(reply_write_fd, server_channels.fileno()))
+        except Exception:
+            os.close(reply_read_fd)
+            self.channels.close()
+            raise
+        finally:
+            os.close(reply_write_fd)
+            server_channels.close()
+        self.replies = os.fdopen(reply_read_fd, "r")
+
+        self.lock = threading.Lock()
+        self.pending = {}  # request id -> [threading.Event, exit code]
+        self.next_request_id = 0
+        self.alive = False
+
+        # The first reply tells whether SOFA could be imported in the server.
+        ready = self._read_reply()
+        if ready is None or not ready.get("ready", False):
+            error = ready.get("error") if ready else "no answer"
+            self.close()
+            raise RuntimeError(f"Fork server failed to start: {error}")
+
+        self.alive = True
+        self.reader = threading.Thread(target=self._read_replies, daemon=True)
+        self.reader.start()
 
-    fd, result_path = tempfile.mkstemp(suffix=".json", prefix="regression_result_")
-    os.close(fd)
+    def _read_reply(self):
+        line = self.replies.readline()
+        if not line:
+            return None
+        return json.loads(line)
 
-    cmd = [
-        python_exe, worker_path,
+    def _read_replies(self):
+        while True:
+            try:
+                reply = self._read_reply()
+            except ValueError:
+                reply = None
+            if reply is None:
+                break
+            with self.lock:
+                waiter = self.pending.pop(reply.get("id"), None)
+            if waiter is not None:
+                waiter[1] = reply
+                waiter[0].set()
+
+        # The server is gone: release every scene still waiting for it.
+        with self.lock:
+            self.alive = False
+            waiters = list(self.pending.values())
+            self.pending.clear()
+        for waiter in waiters:
+            waiter[0].set()
+
+    def submit(self, request, channel_fd, limits=None):
+        """Ask the server to fork a child running one scene or a batch.
+
+        Args:
+            request (dict): {"argv": the command line arguments of the worker
+                (without interpreter and script path)}, or {"batch": the
+                arguments of each scene of a batch, in run order}.
+            channel_fd (int): write end of the result channel of the child,
+                which can be closed once submitted.
+            limits (ProcessLimits): limits enforced by the server on the child.
+
+        Returns:
+            list: [threading.Event, reply] where the event is set once the reply
+            of the server is known: a dict with the "exit_code" of the child
+            and, if it was killed, "killed", "elapsed" and "peak_memory"; None
+            if the server died. None if the server is not alive anymore.
+        """
+        if limits is not None:
+            request["timeout"] = limits.timeout
+            request["max_memory"] = limits.max_memory
+
+        waiter = [threading.Event(), None]
+        with self.lock:
+            if not self.alive:
+                return None
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            self.pending[request_id] = waiter
+            request["id"] = request_id
+            try:
+                self.process.stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+                self.process.stdin.flush()
+                # the server reads one channel per request, in the same order
+                socket.send_fds(self.channels, [b"\0"], [channel_fd])
+            except OSError:
+                self.pending.pop(request_id, None)
+                self.alive = False
+                return None
+        return waiter
+
+    def close(self):
+        """Stop the server once the children still running are done."""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+        self.replies.close()
+        self.channels.close()
+
+
+def start_fork_server(python_exe=None, preload_plugins=()):
+    """Start a ForkServer, or return None if the spawn path must be used instead."""
+    if not fork_is_available():
+        return None
+    try:
+        return ForkServer(python_exe, preload_plugins)
+    except Exception as e:
+        helper.writeWarning(f"Fork server unavailable, scenes will be spawned one by one: {e}")
+        return None
+
+
+# --------------------------------------------------
+# Parent side: spawn one child process for one scene
+# --------------------------------------------------
+def _worker_arguments(scene_data, mode, legacy, disable_progress_bar, verbose, format, fail_fast,
+                      profile, benchmark_options, codec, encoding, precision, metrics):
+    """Command line arguments of a worker running one scene, see run_scene_in_subprocess()."""
+    worker_args = [
         "--mode", mode,
         "--scene", str(scene_data.file_scene_path),
         "--ref", str(scene_data.file_ref_path),
@@ -80,35 +351,332 @@ def run_scene_in_subprocess(scene_data, mode, legacy=False,
         "--meca-in-mapping", "1" if scene_data.meca_in_mapping else "0",
         "--dump-number-step", str(scene_data.dump_number_step),
         "--format", format,
-        "--result-file", result_path,
+        "--criterion", scene_data.criterion,
     ]
     if legacy:
-        cmd.append("--legacy")
+        worker_args.append("--legacy")
     if verbose:
-        cmd.append("--verbose")
+        worker_args.append("--verbose")
     if disable_progress_bar:
-        cmd.append("--disable-progress-bar")
+        worker_args.append("--disable-progress-bar")
+    if fail_fast:
+        worker_args.append("--fail-fast")
+    if profile:
+        worker_args.append("--profile")
+    if codec is not None:
+        worker_args += ["--codec", codec]
+    if encoding != "raw":
+        worker_args += ["--encoding", encoding]
+    if precision != "float64":
+        worker_args += ["--precision", precision]
+    if benchmark_options is not None:
+        worker_args += ["--warmup", str(benchmark_options.warmup), "--repeats", str(benchmark_options.repeats)]
+    if metrics:
+        worker_args += ["--metrics", ",".join(metrics)]
+    if scene_data.fields:
+        import tools.FieldCapture as FieldCapture
+        worker_args += ["--fields", FieldCapture.format_fields(scene_data.fields)]
+    return worker_args
+
+
+class _WorkerMessages:
+    """Collect the messages of a worker (see ResultChannel): its pid and, for
+    each scene, its result and the errors of its compared key frames."""
+
+    def __init__(self, on_message=None, limits=None):
+        """
+        Args:
+            on_message (callable): also called with each message, in the reader thread.
+            limits (ProcessLimits): told when the worker starts running a scene.
+        """
+        self.on_message = on_message
+        self.limits = limits
+        self.pid = None
+        self.results = {} # scene -> result
+        self.meca_objs = {} # scene -> names of its MechanicalObjects
+        self.frame_errors = {} # scene -> [frame, time, criterion of each MechanicalObject] of each key frame
+
+    def __call__(self, message):
+        event, scene = message["event"], message["scene"]
+        if event == "started":
+            self.pid = message["pid"]
+            if self.limits is not None:
+                self.limits.start_scene(scene)
+        elif event == "loaded":
+            self.meca_objs[scene] = message["meca_objs"]
+        elif event == "frame":
+            self.frame_errors.setdefault(scene, []).append([message["frame"], message["time"], message["errors"]])
+        elif event == "result":
+            self.results[scene] = message["result"]
+        if self.on_message is not None:
+            self.on_message(message)
+
+    def result(self, scene):
+        """The result of a scene, None if the worker did not report one. A failing
+        comparison comes with the errors of each of its key frames."""
+        result = self.results.get(scene)
+        if result is not None and result.get("regression_failed", False):
+            result["meca_objs"] = self.meca_objs.get(scene, [])
+            result["frame_errors"] = self.frame_errors.get(scene, [])
+        return result
+
+
+def _run_forked(fork_server, request, limits, messages, cancel):
+    """Run a worker forked from the server, reading its messages until it exits.
+
+    Returns:
+        (int, bool): the exit code of the child and whether it was cancelled,
+        or None if the server could not run it.
+    """
+    read_fd, write_fd = os.pipe()
+    reader = ResultChannel.ChannelReader(read_fd, messages)
+    reader.start()
+    # the server does not see which scene of a batch runs: the parent enforces their limits
+    server_limits = limits if limits.scene_limits is None else None
+    try:
+        waiter = fork_server.submit(request, write_fd, server_limits)
+    finally:
+        os.close(write_fd)
+
+    cancelled = False
+    if waiter is not None:
+        while not waiter[0].wait(ProcessLimits.poll_interval):
+            if messages.pid is None:
+                continue
+            if not cancelled and cancel is not None and cancel.is_set():
+                cancelled = True
+                _kill(messages.pid)
+            elif server_limits is None and limits.killed is None and limits.is_limited():
+                limits.killed = limits.check(messages.pid)
+                if limits.killed is not None:
+                    _kill(messages.pid)
+    reader.join()
+    if waiter is None or waiter[1] is None:
+        return None
+    if waiter[1].get("killed") is not None:
+        limits.killed = waiter[1]["killed"]
+    limits.peak_memory = max(limits.peak_memory, waiter[1].get("peak_memory", 0))
+    return waiter[1].get("exit_code"), cancelled
+
+
+def _kill(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def _run_spawned(cmd, limits, messages, cancel, input=None):
+    """Spawn a worker and read its messages until it exits.
+
+    Args:
+        cmd (list): command of the worker, without its --result-fd argument.
+        input (bytes): written to the stdin of the worker, if given.
+
+    Returns:
+        (int, bool): the exit code of the worker and whether it was cancelled.
+    """
+    read_fd, write_fd = os.pipe()
+    reader = ResultChannel.ChannelReader(read_fd, messages)
+    reader.start()
+    try:
+        channel_argument, popen_arguments = ResultChannel.child_arguments(write_fd)
+        try:
+            process = subprocess.Popen(cmd + ["--result-fd", channel_argument],
+                                       stdin=subprocess.PIPE if input is not None else None, **popen_arguments)
+        finally:
+            os.close(write_fd)
+        if input is not None:
+            # the worker reads its whole input before running anything
+            try:
+                process.stdin.write(input)
+            except OSError:
+                pass # the worker died early: its exit code tells
+            finally:
+                process.stdin.close()
+        return _wait_spawned(process, limits, cancel)
+    finally:
+        reader.join()
+
+
+def _run_worker_process(worker_args, batch, limits, python_exe, fork_server, on_message, cancel):
+    """Run a worker, forked from the server if possible, else spawned.
+
+    Args:
+        worker_args (list): the arguments of the worker, or of each scene of a batch.
+        batch (bool): whether worker_args is a batch.
+
+    Returns:
+        (int, bool, _WorkerMessages): the exit code of the worker, whether it
+        was cancelled, and what it reported.
+    """
+    if fork_server is not None:
+        messages = _WorkerMessages(on_message, limits)
+        outcome = _run_forked(fork_server, {"batch": worker_args} if batch else {"argv": worker_args},
+                              limits, messages, cancel)
+        if outcome is not None:
+            return outcome + (messages,)
+
+    messages = _WorkerMessages(on_message, limits)
+    cmd = [python_exe or sys.executable, os.path.abspath(__file__)]
+    if batch:
+        batch_input = "".join(json.dumps(scene_args) + "\n" for scene_args in worker_args).encode("utf-8")
+        return _run_spawned(cmd + ["--batch"], limits, messages, cancel, batch_input) + (messages,)
+    return _run_spawned(cmd + worker_args, limits, messages, cancel) + (messages,)
+
+
+def _cancelled_result():
+    return {"ok": False, "cancelled": True, "error": "Cancelled: the run was stopped."}
+
+
+def run_scene_in_subprocess(scene_data, mode, legacy=False,
+                            disable_progress_bar=False, verbose=False,
+                            format="JSON", python_exe=None, fork_server=None,
+                            fail_fast=False, timeout=None, max_memory=None, profile=False,
+                            benchmark_options=None, codec=None, encoding="raw", precision="float64",
+                            metrics=None, on_message=None, cancel=None):
+    """Run a single scene (write or compare) in an isolated child process.
+
+    Args:
+        scene_data: the RegressionSceneData describing the scene to run.
+        mode (str): "write" to generate references, "compare" to check them,
+            "benchmark" to time the steps of the scene.
+        legacy (bool): use the legacy reference format (compare only).
+        disable_progress_bar (bool): forwarded to the child.
+        verbose (bool): forwarded to the child.
+        format (str): reference file format ("JSON", "CSV" or "BINARY").
+        python_exe (str): interpreter to use for the child (defaults to the
+            current one).
+        fork_server (ForkServer): if given, the child is forked from this warm
+            server instead of being spawned.
+        fail_fast (bool): stop simulating a compared scene as soon as its
+            errors exceed the threshold.
+        timeout (float): wall-clock time limit of the child in seconds.
+        max_memory (int): resident memory limit of the child in bytes.
+        profile (bool): return every timed event of the child ("phase_events"),
+            to build a trace. See PhaseProfiler.
+        benchmark_options (Benchmark.BenchmarkOptions): warmup and repeats
+            of the benchmark mode.
+        codec (str): compression of the written references, see Codecs.
+            Defaults to the default codec of the format.
+        encoding (str), precision (str): encoding and storage precision of the
+            written BINARY references, see ReferenceFileIO.BINARYReferenceWriter.
+        metrics (list): metrics computed and reported besides the criterion of
+            the scene when comparing, see ErrorMetrics.
+        on_message (callable): called with each message of the child while it
+            runs (see ResultChannel), from another thread.
+        cancel (threading.Event): the child is killed once it is set.
+
+    Returns:
+        dict: the result reported by the child. Always contains an "ok" key
+              and the "wall_time" of the child, in ns. Successful runs also
+              contain "load_time" and "total_run_time" (time in animate(), in
+              ns). Benchmark runs contain the step time "statistics", see
+              Benchmark.step_time_statistics(), and the "repeat_step_times". For compare runs it also contains "result", "regression_failed",
+              "nbr_tested_frame", "error_by_dof",
+              "total_error", "failed_frame", "failed_time", "stopped_early",
+              the "criterion" and the accumulated "metrics" (see ErrorMetrics),
+              the accumulated errors of the captured fields ("field_errors")
+              and the ones exceeding their tolerance ("failed_fields", see
+              FieldCapture).
+              Results of a child which ran contain the time spent in each
+              phase ("phases") and the "worker_pid". The "launch_time" (ns
+              since the epoch) and "launch_thread" locate the run in a trace.
+              A child killed because of its limits gives a result with
+              "killed" ("timeout" or "memory"), "elapsed" (s) and
+              "peak_memory" (bytes). A failing comparison also has the names
+              of the MechanicalObjects ("meca_objs") and the "frame_errors" of
+              every compared key frame. A cancelled run gives a result with
+              "cancelled".
+    """
+    if cancel is not None and cancel.is_set():
+        return _cancelled_result()
+
+    worker_args = _worker_arguments(scene_data, mode, legacy, disable_progress_bar, verbose, format,
+                                    fail_fast, profile, benchmark_options, codec, encoding, precision, metrics)
 
     # stdout/stderr are inherited so SOFA logs and progress bars behave exactly
     # as before (and the parent's --quiet redirection propagates to the child).
+    limits = ProcessLimits(timeout, max_memory)
+    start_time = time.time_ns()
+    worker_args += ["--launch-time", str(start_time)]
+    launch = {"launch_time": start_time, "launch_thread": threading.get_ident()}
     try:
-        completed = subprocess.run(cmd)
+        returncode, cancelled, messages = _run_worker_process(worker_args, False, limits, python_exe, fork_server,
+                                                              on_message, cancel)
     except Exception as e:
-        _safe_remove(result_path)
         return {"ok": False, "error": f"Failed to launch worker subprocess: {e}"}
+    wall_time = time.time_ns() - start_time
+
+    result = messages.result(0)
+    if limits.killed is not None:
+        result = limits.killed_result(elapsed=wall_time / 1e9)
+    elif result is None:
+        if cancelled:
+            result = _cancelled_result()
+        else:
+            result = {"ok": False, "error": f"Worker produced no result (exit code {returncode})."}
+    result["wall_time"] = wall_time
+    result.update(launch)
+    return result
+
 
-    result = None
+def run_batch_in_subprocess(scenes_data, mode, legacy=False,
+                            disable_progress_bar=False, verbose=False,
+                            format="JSON", python_exe=None, fork_server=None,
+                            fail_fast=False, scene_limits=None, profile=False,
+                            benchmark_options=None, codec=None, encoding="raw", precision="float64",
+                            metrics=None, on_message=None, cancel=None):
+    """Run several scenes one after another in the same child process.
+
+    Only the scenes verified to give the same results alone and after other
+    scenes may be batched, see BatchRegistry.
+
+    Args:
+        scenes_data (list): the RegressionSceneData of the scenes, in run order.
+        scene_limits (list): the (timeout, max_memory) of each scene, in
+            seconds and bytes (None for no limit). Each scene is killed, with
+            the whole batch, as soon as it exceeds its own limits.
+        on_message (callable): see run_scene_in_subprocess(). The "scene" of
+            the messages is the index of the scene in scenes_data.
+        Other arguments: see run_scene_in_subprocess().
+
+    Returns:
+        list: the result of each scene, see run_scene_in_subprocess(). Their
+        "wall_time" and "launch_time" are the ones of the scene in the batch.
+        A scene which exceeded its limits gets a "killed" result. When the
+        batch crashed, the scene it was running has no result (None), and
+        neither have the scenes following a crashed or killed one: they must
+        be run alone.
+    """
+    if cancel is not None and cancel.is_set():
+        return [_cancelled_result() for scene_data in scenes_data]
+
+    start_time = time.time_ns()
+    batch_worker_args = [_worker_arguments(scene_data, mode, legacy, disable_progress_bar, verbose, format, fail_fast,
+                                           profile, benchmark_options, codec, encoding, precision, metrics)
+                         + ["--launch-time", str(start_time)]
+                         for scene_data in scenes_data]
+
+    limits = ProcessLimits(scene_limits=scene_limits or [(None, None)] * len(scenes_data))
     try:
-        with open(result_path, "r") as f:
-            result = json.load(f)
+        returncode, cancelled, messages = _run_worker_process(batch_worker_args, True, limits, python_exe, fork_server,
+                                                              on_message, cancel)
     except Exception:
-        result = None
-    _safe_remove(result_path)
+        return [None] * len(scenes_data)
 
-    if result is None:
-        return {"ok": False,
-                "error": f"Worker produced no result (exit code {completed.returncode})."}
-    return result
+    results = [messages.result(scene) for scene in range(len(scenes_data))]
+    # a scene run after the one which stopped the batch reported no result either
+    if None in results:
+        first_missing = results.index(None)
+        results[first_missing:] = [_cancelled_result() if cancelled else None] * (len(results) - first_missing)
+        if limits.killed is not None and limits.scene == first_missing:
+            results[first_missing] = limits.killed_result()
+            results[first_missing]["wall_time"] = int(results[first_missing]["elapsed"] * 1e9)
+    for result in results:
+        if result is not None:
+            result["launch_thread"] = threading.get_ident()
+    return results
 
 
 # --------------------------------------------------
@@ -116,41 +684,97 @@ def run_scene_in_subprocess(scene_data, mode, legacy=False,
 # --------------------------------------------------
 def _make_worker_parser():
     parser = argparse.ArgumentParser(description="Regression per-scene worker (internal)")
-    parser.add_argument("--mode", choices=["write", "compare"], required=True)
+    parser.add_argument("--mode", choices=["write", "compare", "benchmark"], required=True)
     parser.add_argument("--scene", required=True)
     parser.add_argument("--ref", required=True)
     parser.add_argument("--steps", type=int, required=True)
     parser.add_argument("--epsilon", type=float, required=True)
     parser.add_argument("--meca-in-mapping", dest="meca_in_mapping", choices=["0", "1"], required=True)
     parser.add_argument("--dump-number-step", dest="dump_number_step", type=int, required=True)
-    parser.add_argument("--format", default="JSON")
-    parser.add_argument("--result-file", dest="result_file", required=True)
+    parser.add_argument("--format", choices=["JSON", "CSV", "BINARY"], default="JSON")
+    parser.add_argument("--codec", default=None)
+    parser.add_argument("--encoding", choices=["raw", "xor"], default="raw")
+    parser.add_argument("--precision", choices=["float64", "float32"], default="float64")
+    parser.add_argument("--criterion", default="error_by_dof")
+    parser.add_argument("--metrics", type=lambda text: text.split(","), default=[])
+    parser.add_argument("--fields", default="", help="see FieldCapture.parse_fields()")
+    parser.add_argument("--result-fd", dest="result_fd", help="see ResultChannel.child_arguments()")
     parser.add_argument("--legacy", action="store_true")
     parser.add_argument("--verbose", action="store_true")
     parser.add_argument("--disable-progress-bar", dest="disable_progress_bar", action="store_true")
+    parser.add_argument("--fail-fast", dest="fail_fast", action="store_true")
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--launch-time", dest="launch_time", type=int)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=5)
     return parser
 
 
-def _worker_main():
-    args = _make_worker_parser().parse_args()
+def setup_environment(preload_plugins=()):
+    """Make SOFA and the tools package importable and import them.
 
-    result = {"ok": False, "error": None}
-    try:
-        # SOFA and the tools package must be imported inside this fresh process.
-        if "SOFA_ROOT" not in os.environ:
-            raise RuntimeError("SOFA_ROOT environment variable is not set.")
+    Called by the workers, and by the orchestrator before replaying a scene
+    (the only SOFA code it runs in its own process).
+    Imports are cached by Python: calling this again in a forked child is free.
+    """
+    if "SOFA_ROOT" not in os.environ:
+        raise RuntimeError("SOFA_ROOT environment variable is not set.")
+
+    sofapython3_path = os.path.join(os.environ["SOFA_ROOT"], "lib", "python3", "site-packages")
+    if sofapython3_path not in sys.path:
+        sys.path.append(sofapython3_path)
+
+    # Make the "tools" package importable (program root = parent of this dir).
+    program_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if program_root not in sys.path:
+        sys.path.insert(0, program_root)
+
+    import SofaRuntime  # noqa: F401  (registers the py3 scene loader)
+    import tools.RegressionSceneData  # noqa: F401
 
-        sofapython3_path = os.path.join(os.environ["SOFA_ROOT"], "lib", "python3", "site-packages")
-        if sofapython3_path not in sys.path:
-            sys.path.append(sofapython3_path)
+    for plugin in preload_plugins:
+        SofaRuntime.importPlugin(plugin)
 
-        # Make the "tools" package importable (program root = parent of this dir).
-        program_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        if program_root not in sys.path:
-            sys.path.insert(0, program_root)
 
-        import SofaRuntime  # noqa: F401  (registers the py3 scene loader)
+def _scene_event_handler(channel, scene_index):
+    """Forward the events of a scene to the result channel, with at most one
+    "progress" message every ResultChannel.progress_interval seconds."""
+    next_progress_time = [0.0]
+
+    def handle(event, fields):
+        if event == "progress":
+            now = time.monotonic()
+            if now < next_progress_time[0]:
+                return
+            next_progress_time[0] = now + ResultChannel.progress_interval
+        channel.send(event, scene_index, **fields)
+    return handle
+
+
+def _run_worker(args, channel, entry_time=None, batched=False, scene_index=0):
+    """Run one scene as described by the worker arguments and report it on the result channel.
+
+    Args:
+        args: the parsed worker arguments.
+        channel (ResultChannel.ChannelWriter): where the events and the result are sent.
+        entry_time (int): time.time_ns() when the process started running this
+            module's code, the end of the "startup" phase.
+        batched (bool): the scene is run in a batch: it is unloaded once done,
+            and its own wall time is reported (the parent only knows the one
+            of the whole batch).
+        scene_index (int): index of the scene in its batch.
+    """
+    result = {"ok": False, "error": None}
+    scene = None
+    import_start = time.time_ns()
+    try:
+        channel.send("started", scene_index, pid=os.getpid())
+        # SOFA and the tools package must be imported inside this fresh process.
+        setup_environment()
         import tools.RegressionSceneData as RegressionSceneData
+        import tools.FieldCapture as FieldCapture
+        import tools.PhaseProfiler as PhaseProfiler
+        import_end = time.time_ns()
 
         scene = RegressionSceneData.RegressionSceneData(
             file_scene_path=args.scene,
@@ -161,43 +785,231 @@ def _worker_main():
             dump_number_step=args.dump_number_step,
             disable_progress_bar=args.disable_progress_bar,
             verbose=args.verbose,
+            criterion=args.criterion,
+            fields=FieldCapture.parse_fields(args.fields),
         )
+        scene.metrics = args.metrics
+
+        scene.fail_fast = args.fail_fast
+        scene.event_handler = _scene_event_handler(channel, scene_index)
+        scene.profiler = PhaseProfiler.PhaseProfiler(record_events=args.profile)
+        if args.launch_time is not None and entry_time is not None:
+            scene.profiler.add("startup", args.launch_time, entry_time - args.launch_time)
+        scene.profiler.add("import", import_start, import_end - import_start)
+
+        if args.mode == "benchmark":
+            import tools.Benchmark as Benchmark
+            repeat_step_times = scene.benchmark_steps(args.warmup, args.repeats)
+            statistics = Benchmark.step_time_statistics(repeat_step_times)
+            result = {
+                "ok": True,
+                "total_run_time": int(sum(sum(times) for times in repeat_step_times)),
+                "statistics": statistics,
+                "repeat_step_times": repeat_step_times,
+                "error": None,
+            }
+            return 0
 
         scene.load_scene(args.format)
 
         if args.mode == "write":
-            scene.write_references(args.format)
-            result = {"ok": True, "error": None}
+            scene.write_references(args.format, args.codec, args.encoding, args.precision)
+            result = {
+                "ok": True,
+                "load_time": int(scene.load_time),
+                "total_run_time": int(scene.total_run_time),
+                "error": None,
+            }
         else:  # compare
             if args.legacy:
                 passed = scene.compare_legacy_references()
             else:
                 passed = scene.compare_references(args.format)
+            if batched:
+                scene.unload_scene()
 
             result = {
                 "ok": True,
                 "result": bool(passed),
                 "regression_failed": bool(scene.regression_failed),
                 "nbr_tested_frame": int(scene.nbr_tested_frame),
+                "load_time": int(scene.load_time),
                 "total_run_time": int(scene.total_run_time),
                 "error_by_dof": [float(v) for v in scene.error_by_dof],
                 "total_error": [float(v) for v in scene.total_error],
+                "criterion": scene.criterion,
+                "metrics": scene.metric_values,
+                "field_errors": scene.field_errors,
+                "failed_fields": scene.failed_fields,
+                "failed_frame": scene.failed_frame,
+                "failed_time": scene.failed_time,
+                "stopped_early": bool(scene.stopped_early),
                 "error": None,
             }
     except Exception as e:
         import traceback
         result = {"ok": False, "error": str(e), "traceback": traceback.format_exc()}
     finally:
+        result["worker_pid"] = os.getpid()
+        if batched:
+            launch_time = args.launch_time if entry_time is not None and args.launch_time is not None else import_start
+            result["launch_time"] = launch_time
+            result["wall_time"] = time.time_ns() - launch_time
+        if scene is not None:
+            result["phases"] = scene.profiler.summary()
+            if scene.profiler.record_events:
+                result["phase_events"] = scene.profiler.events
         try:
-            with open(args.result_file, "w") as f:
-                json.dump(result, f)
-        except Exception:
-            pass
+            channel.send("result", scene_index, result=result)
+        except OSError:
+            pass # the parent is gone
+
+    # The outcome is communicated through the result channel, so always exit 0.
+    return 0
+
+
+def _worker_main():
+    entry_time = time.time_ns()
+    args = _make_worker_parser().parse_args()
+    if args.result_fd is None:
+        sys.exit("--result-fd is required")
+    sys.exit(_run_worker(args, ResultChannel.open_writer(args.result_fd), entry_time))
+
+
+def _run_batch(batch_worker_args, channel, entry_time=None):
+    """Run the scenes of a batch one after another in this process.
+
+    Args:
+        batch_worker_args (list): the worker arguments of each scene.
+        channel (ResultChannel.ChannelWriter): shared by the scenes of the batch.
+        entry_time (int): see _run_worker(), only the first scene has a
+            "startup" phase.
+    """
+    parser = _make_worker_parser()
+    for i, worker_args in enumerate(batch_worker_args):
+        _run_worker(parser.parse_args(worker_args), channel, entry_time if i == 0 else None, batched=True,
+                    scene_index=i)
+    return 0
+
+
+def _make_batch_parser():
+    parser = argparse.ArgumentParser(description="Regression batch worker (internal)")
+    parser.add_argument("--batch", action="store_true", required=True)
+    parser.add_argument("--result-fd", dest="result_fd", required=True)
+    return parser
+
+
+def _batch_main():
+    """Run the scenes whose worker arguments are given as JSON lines on stdin."""
+    entry_time = time.time_ns()
+    args = _make_batch_parser().parse_args()
+    batch_worker_args = [json.loads(line) for line in sys.stdin.read().splitlines() if line.strip()]
+    sys.exit(_run_batch(batch_worker_args, ResultChannel.open_writer(args.result_fd), entry_time))
+
+
+# --------------------------------------------------
+# Fork server side: import SOFA once, fork per scene
+# --------------------------------------------------
+def _make_fork_server_parser():
+    parser = argparse.ArgumentParser(description="Regression fork server (internal)")
+    parser.add_argument("--fork-server", dest="fork_server", action="store_true", required=True)
+    parser.add_argument("--reply-fd", dest="reply_fd", type=int, required=True)
+    parser.add_argument("--channel-fd", dest="channel_fd", type=int, required=True)
+    parser.add_argument("--preload-plugin", dest="preload_plugins", action="append", default=[])
+    return parser
+
+
+def _fork_scene(request, channel_fd, closed_fds):
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    entry_time = time.time_ns()
+
+    # Child: run exactly one scene (or one batch), then leave without running
+    # any cleanup inherited from the server.
+    exit_code = 1
+    try:
+        for fd in closed_fds:
+            os.close(fd)
+        channel = ResultChannel.ChannelWriter(channel_fd)
+        if "batch" in request:
+            exit_code = _run_batch(request["batch"], channel, entry_time)
+        else:
+            exit_code = _run_worker(_make_worker_parser().parse_args(request["argv"]), channel, entry_time)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+def _fork_server_main():
+    args = _make_fork_server_parser().parse_args()
+    reply = os.fdopen(args.reply_fd, "w", buffering=1)
+
+    try:
+        setup_environment(args.preload_plugins)
+    except Exception as e:
+        reply.write(json.dumps({"ready": False, "error": str(e)}) + "\n")
+        sys.exit(1)
+    reply.write(json.dumps({"ready": True}) + "\n")
+
+    request_fd = sys.stdin.fileno()
+    channels = socket.socket(fileno=args.channel_fd)
+    pending_input = b""
+    requests_open = True
+    children = {}  # pid -> (request id, ProcessLimits)
+
+    while requests_open or children:
+        if requests_open:
+            readable, _, _ = select.select([request_fd], [], [], 0.05)
+            if readable:
+                chunk = os.read(request_fd, 65536)
+                if not chunk:
+                    requests_open = False
+                pending_input += chunk
+                while b"\n" in pending_input:
+                    line, pending_input = pending_input.split(b"\n", 1)
+                    if not line.strip():
+                        continue
+                    request = json.loads(line)
+                    limits = ProcessLimits(request.get("timeout"), request.get("max_memory"))
+                    # the result channel of the request follows it on the channel socket
+                    _, channel_fds, _, _ = socket.recv_fds(channels, 1, 1)
+                    pid = _fork_scene(request, channel_fds[0], (request_fd, args.reply_fd, args.channel_fd))
+                    os.close(channel_fds[0])
+                    children[pid] = (request["id"], limits)
+        else:
+            time.sleep(ProcessLimits.poll_interval)
+
+        # Enforce the limits of the running children.
+        for pid, (request_id, limits) in children.items():
+            if limits.is_limited() and limits.killed is None:
+                limits.killed = limits.check(pid)
+                if limits.killed is not None:
+                    os.kill(pid, signal.SIGKILL)
+
+        # Reap the finished children and report them.
+        while children:
+            pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            if pid not in children:
+                continue
+            request_id, limits = children.pop(pid)
+            limits.peak_memory = max(limits.peak_memory, _maxrss_bytes(rusage))
+            answer = {"id": request_id, "exit_code": os.waitstatus_to_exitcode(status),
+                      "peak_memory": limits.peak_memory}
+            if limits.killed is not None:
+                answer.update(killed=limits.killed, elapsed=limits.elapsed())
+            reply.write(json.dumps(answer) + "\n")
 
-    # The outcome is communicated through the result file, so always exit 0
-    # unless the result could not be written at all.
     sys.exit(0)
 
 
 if __name__ == "__main__":
-    _worker_main()
+    if "--fork-server" in sys.argv[1:]:
+        _fork_server_main()
+    elif "--batch" in sys.argv[1:]:
+        _batch_main()
+    else:
+        _worker_main()
@@ -0,0 +1,43 @@
+import numpy as np
+
+import tools.ReferenceFileIO as reference_io
+import Sofa
+
+
+class ReplayState(Sofa.Core.Controller):
+    """Display the reference frames of a MechanicalObject in a point cloud.
+
+    The reference is loaded once as one contiguous (frames, points, dof) array
+    (memory mapped for BINARY references), and each key frame is assigned to
+    the point cloud as an array, without conversion to Python lists.
+    """
+    def __init__(self, node, slave_mo, state_filename, format = "JSON", **kwargs):
+        super().__init__(**kwargs)
+        self.node = node
+        self.slave_mo = slave_mo
+        self.frame_step = -1 # index of the displayed key frame
+        self.t_sim = 0.0
+
+        self.keyframes, self.ref_values = reference_io.read_indexed_reference(state_filename, format)
+        
+        if len(self.keyframes) > 0 and self.keyframes.times[0] == 0.0: # frame 0.0
+            self.show_frame(0)
+
+    def show_frame(self, frame_index):
+        self.slave_mo.position = np.asarray(self.ref_values[frame_index], dtype=np.float64)
+        self.frame_step = frame_index
+
+    def seek(self, frame_index):
+        """Jump to a key frame: display it and continue the replay from its time."""
+        if not 0 <= frame_index < len(self.keyframes):
+            raise IndexError(f"key frame {frame_index} out of range [0, {len(self.keyframes) - 1}]")
+        self.t_sim = float(self.keyframes.times[frame_index])
+        self.show_frame(frame_index)
+           
+    def onAnimateEndEvent(self, event):
+       dt = float(self.node.getRootContext().dt.value)
+       self.t_sim += dt
+
+       frame_index = self.keyframes.find(self.t_sim)
+       if frame_index >= 0 and frame_index != self.frame_step:
+           self.show_frame(frame_index)
@@ -0,0 +1,154 @@
+"""
+Persistent cache of passing compare results.
+
+Most runs change nothing that affects most scenes. A scene whose inputs are
+exactly the same as in a previous passing run does not need to be simulated
+again: its previous result is reported instead, as a cached pass.
+
+The cache key of a scene is a hash of:
+  * the content of the scene file,
+  * the content of all its reference files,
+  * the parameters of its line in the .regression-tests file (steps,
+    epsilon, criterion, meca_in_mapping, dump_number_step, fields) and the compare options,
+  * a fingerprint of the SOFA build found under SOFA_ROOT,
+  * a fingerprint of this regression program.
+
+Other files used by a scene (meshes, imported python modules...) are not part
+of the key: the cache must be cleared explicitly after changing them.
+
+Only passing results are stored, so a failing scene is always run again.
+"""
+
+import os
+import glob
+import json
+import time
+import hashlib
+import threading
+
+cache_file_name = "result_cache.json"
+cache_version = 1
+
+
+def _hash_file(hasher, file_path):
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+
+
+def sofa_build_fingerprint(sofa_root):
+    """Hash the name, size and modification time of every file of the SOFA build
+    (lib/ and bin/ of SOFA_ROOT). Rebuilding or updating SOFA changes it."""
+    hasher = hashlib.sha256()
+    for sub_dir in ("lib", "bin"):
+        for root, dirs, files in os.walk(os.path.join(sofa_root, sub_dir)):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                hasher.update(f"{os.path.relpath(file_path, sofa_root)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def program_fingerprint():
+    """Hash the sources of the regression program: changing the way scenes are
+    compared must not reuse results computed by another version."""
+    hasher = hashlib.sha256()
+    program_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for file_path in sorted(glob.glob(os.path.join(program_root, "tools", "*.py"))):
+        hasher.update(os.path.basename(file_path).encode("utf-8"))
+        _hash_file(hasher, file_path)
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_entries = 5000, sofa_root = None):
+        """Open (or create) the cache stored in the given directory.
+
+        Args:
+            cache_dir (str): directory of the cache file.
+            max_entries (int): maximum number of results kept. The least
+                recently used ones are evicted first.
+            sofa_root (str): SOFA build to fingerprint. Defaults to $SOFA_ROOT.
+        """
+        self.cache_dir = cache_dir
+        self.cache_path = os.path.join(cache_dir, cache_file_name)
+        self.max_entries = max(1, int(max_entries))
+        self.sofa_root = sofa_root if sofa_root is not None else os.environ.get("SOFA_ROOT", "")
+        self.entries = {} # key -> {"scene", "last_used", "result"}
+        self.lock = threading.Lock()
+        self.environment_fingerprint = None
+        self.nbr_hits = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == cache_version:
+            self.entries = data.get("entries", {})
+
+    def save(self):
+        """Write the cache back to disk, evicting the least recently used entries
+        beyond max_entries."""
+        with self.lock:
+            if len(self.entries) > self.max_entries:
+                keys = sorted(self.entries, key=lambda key: self.entries[key]["last_used"], reverse=True)
+                self.entries = {key: self.entries[key] for key in keys[:self.max_entries]}
+            data = {"version": cache_version, "entries": self.entries}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def clear(self):
+        """Invalidate every cached result."""
+        with self.lock:
+            self.entries = {}
+        self.save()
+
+    def get_environment_fingerprint(self):
+        with self.lock:
+            if self.environment_fingerprint is None:
+                self.environment_fingerprint = sofa_build_fingerprint(self.sofa_root) + program_fingerprint()
+            return self.environment_fingerprint
+
+    def scene_key(self, scene_data, format, legacy):
+        """Compute the cache key of a scene for the given compare options."""
+        hasher = hashlib.sha256()
+        hasher.update(self.get_environment_fingerprint().encode("utf-8"))
+        hasher.update(f"{scene_data.steps}|{scene_data.epsilon!r}|{scene_data.criterion}|{scene_data.meca_in_mapping}|"
+                      f"{scene_data.dump_number_step}|{sorted(scene_data.fields.items())}|{format}|{legacy}\n".encode("utf-8"))
+        _hash_file(hasher, scene_data.file_scene_path)
+        for ref_path in sorted(glob.glob(glob.escape(scene_data.file_ref_path) + ".reference*")):
+            # files left by an interrupted write (see ReferenceFileIO)
+            if ref_path.endswith((".partial", ".partial.frames")):
+                continue
+            hasher.update(os.path.basename(ref_path).encode("utf-8"))
+            _hash_file(hasher, ref_path)
+        return hasher.hexdigest()
+
+    def lookup(self, key):
+        """Return the cached passing result of this key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry["last_used"] = time.time()
+            self.nbr_hits = self.nbr_hits + 1
+            return dict(entry["result"])
+
+    def store(self, key, scene_path, result):
+        """Remember a passing result. Failing results are never cached."""
+        if not (result.get("ok", False) and result.get("result", False)):
+            return
+        kept_result = {k: v for k, v in result.items() if k not in ("cache_key", "cached", "phase_events")}
+        with self.lock:
+            self.entries[key] = {"scene": scene_path, "last_used": time.time(), "result": kept_result}
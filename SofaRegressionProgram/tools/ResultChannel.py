@@ -0,0 +1,114 @@
+"""
+Message channel between the orchestrator and its worker processes.
+
+A worker reports on a dedicated pipe while it runs, instead of writing one
+result file when it exits. Messages are framed: a 4-byte big-endian length
+followed by a UTF-8 JSON object. Each message has an "event" and the "scene"
+it is about (its index in the batch, 0 when the worker runs a single scene):
+  * "started": the worker begins the scene, with its "pid",
+  * "loaded": the scene is loaded, with its "load_time" (ns) and the names of
+    its MechanicalObjects ("meca_objs"),
+  * "progress": the number of steps simulated so far ("step") and the time
+    spent in animate() ("animate_time", ns), at most every progress_interval
+    seconds,
+  * "frame": a key frame was compared, with its index ("frame"), its
+    simulation "time" and the value of the criterion of the scene (see
+    ErrorMetrics) for each MechanicalObject at this frame ("errors"),
+  * "result": the final "result" of the scene, see RegressionWorker.
+
+The parent reads the messages in a thread while the worker runs, so that it
+can show the progress of the whole run, stop a worker early, and report the
+errors of each key frame of a failing scene.
+"""
+
+import os
+import sys
+import json
+import struct
+import threading
+
+_header = struct.Struct(">I")
+
+# minimum time between two "progress" messages of a scene, in seconds
+progress_interval = 0.25
+
+
+class ChannelWriter:
+    """Worker side of a channel. Only one thread of one process writes to it."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def send(self, event, scene, **fields):
+        payload = json.dumps(dict(fields, event=event, scene=scene)).encode("utf-8")
+        data = memoryview(_header.pack(len(payload)) + payload)
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ChannelReader(threading.Thread):
+    """Parent side of a channel: reads the messages until every writer closed
+    the channel (i.e. the worker exited) and passes them to a callback."""
+
+    def __init__(self, fd, on_message):
+        """
+        Args:
+            fd (int): read end of the channel, closed once the channel is drained.
+            on_message (callable): called with each message, in the reader thread.
+        """
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.on_message = on_message
+        self.error = None # first invalid message or callback failure, if any
+
+    def run(self):
+        buffer = bytearray()
+        try:
+            while True:
+                chunk = os.read(self.fd, 1 << 16)
+                if not chunk:
+                    break
+                buffer += chunk
+                while len(buffer) >= _header.size:
+                    size = _header.unpack_from(buffer)[0]
+                    if len(buffer) < _header.size + size:
+                        break
+                    payload = bytes(buffer[_header.size:_header.size + size])
+                    del buffer[:_header.size + size]
+                    # the channel is always drained, so that the worker never blocks on it
+                    try:
+                        self.on_message(json.loads(payload))
+                    except Exception as e:
+                        if self.error is None:
+                            self.error = e
+        finally:
+            os.close(self.fd)
+
+
+def child_arguments(write_fd):
+    """Pass the write end of a channel to a spawned worker.
+
+    Returns:
+        (str, dict): the value of the --result-fd argument of the worker, and
+        the arguments of subprocess.Popen making it inherit the channel.
+    """
+    if sys.platform == "win32":
+        import msvcrt
+        import subprocess
+        handle = msvcrt.get_osfhandle(write_fd)
+        os.set_handle_inheritable(handle, True)
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.lpAttributeList = {"handle_list": [handle]}
+        return f"handle:{handle}", {"startupinfo": startupinfo}
+    return str(write_fd), {"pass_fds": (write_fd,)}
+
+
+def open_writer(value):
+    """Open the channel given to a worker by child_arguments()."""
+    if value.startswith("handle:"):
+        import msvcrt
+        return ChannelWriter(msvcrt.open_osfhandle(int(value[len("handle:"):]), 0))
+    return ChannelWriter(int(value))
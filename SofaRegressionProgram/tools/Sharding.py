@@ -0,0 +1,76 @@
+"""
+Cost-balanced split of the scenes over several machines (`--shard i/N`).
+
+Every shard computes the same split from the same inputs: the scenes found in
+the input folder and their reference files, which are the same on every
+machine running the same checkout. The timing history is not used: it is
+local to each machine, and two machines with different histories would split
+the scenes differently, running some scenes twice and others never.
+
+The cost of a scene is its number of steps times the size of its reference
+files (a proxy of the mesh size). The scenes are assigned longest first to the
+currently least loaded shard (LPT scheduling).
+"""
+
+import os
+import glob
+
+
+def parse_shard(shard):
+    """Parse a "i/N" shard specification (1 <= i <= N).
+
+    Returns:
+        (int, int): the 0-based shard index and the number of shards.
+    """
+    try:
+        index, count = (int(v) for v in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"invalid shard '{shard}', expecting i/N")
+    if count <= 0 or index < 1 or index > count:
+        raise ValueError(f"invalid shard '{shard}', expecting 1 <= i <= N")
+    return index - 1, count
+
+
+def reference_size(scene_data):
+    """Size in bytes of the reference files of a scene (0 if there is none)."""
+    size = 0
+    for ref_path in glob.glob(glob.escape(scene_data.file_ref_path) + ".reference*"):
+        try:
+            size += os.path.getsize(ref_path)
+        except OSError:
+            pass
+    return size
+
+
+def estimate_scene_costs(scenes):
+    """Expected cost of each scene: its number of steps times the size of its references.
+
+    Args:
+        scenes (list): RegressionSceneData of the scenes.
+
+    Returns:
+        list: the cost of each scene.
+    """
+    return [scene.steps * max(reference_size(scene), 1) for scene in scenes]
+
+
+def assign_shards(costs, keys, nbr_shards):
+    """Split items into nbr_shards groups of roughly equal total cost.
+
+    Args:
+        costs (list): cost of each item.
+        keys (list): identifier of each item, used to break ties so that
+            every machine computes the same split. Items with the same cost
+            and key keep their order.
+        nbr_shards (int): number of groups.
+
+    Returns:
+        list: the shard index of each item.
+    """
+    loads = [0.0] * nbr_shards
+    assignment = [0] * len(costs)
+    for item in sorted(range(len(costs)), key=lambda i: (-costs[i], keys[i])):
+        shard = min(range(nbr_shards), key=lambda s: (loads[s], s))
+        assignment[item] = shard
+        loads[shard] += costs[item]
+    return assignment
@@ -0,0 +1,111 @@
+"""
+Persistent history of the time taken by each scene.
+
+The wall time of the worker, the time spent in animate() and the time spent
+loading the scene are recorded after each run and kept in a local JSON file
+between runs. The expected cost of a scene is used to schedule parallel runs
+longest-first: starting the slow scenes first avoids ending a run with a
+single slow scene holding the critical path while the other workers are idle.
+
+Scenes are identified by their path relative to the input folder, so that a
+history can be shared between machines with different checkouts. The timings
+depend on the machine and on the scenes run, so there is no default history:
+one file is given per machine and input folder (--timing-history).
+
+Only complete runs are recorded: the times of the scenes stopped early
+(fail-fast, cancelled by --max-failures) and of the benchmarks, which repeat
+the simulation, would make their expected times wrong.
+"""
+
+import os
+import json
+import time
+import threading
+
+history_version = 1
+
+# weight of the last run in the expected times (exponential moving average)
+smoothing_factor = 0.5
+
+
+class TimingHistory:
+    def __init__(self, history_path, root_dir):
+        """Open (or create) a timing history.
+
+        Args:
+            history_path (str): JSON file of the history.
+            root_dir (str): folder the scene paths are made relative to.
+        """
+        self.history_path = history_path
+        self.root_dir = os.path.abspath(root_dir)
+        self.entries = {} # scene key -> {"wall_time", "animate_time", "load_time", "nbr_runs", "last_run"}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.history_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == history_version:
+            self.entries = data.get("entries", {})
+
+    def save(self):
+        with self.lock:
+            data = {"version": history_version, "entries": self.entries}
+
+        history_dir = os.path.dirname(self.history_path)
+        if history_dir:
+            os.makedirs(history_dir, exist_ok=True)
+        tmp_path = self.history_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.history_path)
+
+    def scene_key(self, scene_data):
+        relative_path = os.path.relpath(os.path.abspath(scene_data.file_scene_path), self.root_dir)
+        return relative_path.replace(os.sep, "/") + f"|{scene_data.steps}"
+
+    def record(self, scene_data, result):
+        """Record the timings of a worker result. Cached results are ignored,
+        as well as the failed, stopped early or benchmark ones, whose timings
+        are not representative."""
+        if result.get("cached", False) or not result.get("ok", False) or "wall_time" not in result:
+            return
+        if result.get("stopped_early", False) or result.get("cancelled", False) or "statistics" in result:
+            return
+
+        measured = {
+            "wall_time": result["wall_time"] / 1e9,
+            "animate_time": result.get("total_run_time", 0) / 1e9,
+            "load_time": result.get("load_time", 0) / 1e9,
+        }
+        key = self.scene_key(scene_data)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = dict(measured, nbr_runs=0)
+            else:
+                for name, value in measured.items():
+                    entry[name] = smoothing_factor * value + (1.0 - smoothing_factor) * entry.get(name, value)
+            entry["nbr_runs"] = entry["nbr_runs"] + 1
+            entry["last_run"] = time.time()
+            self.entries[key] = entry
+
+    def expected_wall_time(self, scene_data):
+        """Expected wall time of a scene in seconds, or None if it never ran."""
+        with self.lock:
+            entry = self.entries.get(self.scene_key(scene_data))
+            return None if entry is None else entry["wall_time"]
+
+    def order_longest_first(self, scenes):
+        """Sort scene data longest expected time first. Scenes without history
+        come first since they may be the longest; ties keep the input order.
+
+        Returns:
+            list: the indices of the scenes in the order they should be started.
+        """
+        expected = [self.expected_wall_time(scene) for scene in scenes]
+        return sorted(range(len(scenes)),
+                      key=lambda i: (expected[i] is not None, -(expected[i] or 0.0)))